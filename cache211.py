@@ -0,0 +1,159 @@
+# BuildingSync(R), Copyright (c) 2015-2020, Alliance for Sustainable Energy, LLC.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# (1) Redistributions of source code must retain the above copyright notice, this
+#     list of conditions and the following disclaimer.
+#
+# (2) Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# (3) Neither the name of the copyright holder nor the names of any contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission from the respective party.
+#
+# (4) Other than as required in clauses (1) and (2), distributions in any form of
+#     modifications or other derivative works may not use the "BuildingSync"
+#     trademark or any other confusingly similar designation without specific
+#     prior written permission from Alliance for Sustainable Energy, LLC.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDER(S) AND ANY CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER(S), ANY CONTRIBUTORS, THE
+# UNITED STATES GOVERNMENT, OR THE UNITED STATES DEPARTMENT OF ENERGY, NOR ANY
+# OF THEIR EMPLOYEES, BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import zlib
+
+# Set to False to keep everything in memory
+enabled = True
+# Default size limit for each kind of cached object, least recently used entries are removed first
+max_size = 256 * 1024 * 1024
+
+
+def cache_dir():
+    """Get the directory used for the on-disk cache
+
+    :return: the directory name, or None if the on-disk cache is turned off
+
+    The directory can be set with the STD211_CACHE_DIR environment variable, and an empty
+    value turns the on-disk cache off. The default is std211-translator in the user cache
+    directory ($XDG_CACHE_HOME or ~/.cache).
+    """
+    if not enabled:
+        return None
+    directory = os.environ.get('STD211_CACHE_DIR')
+    if directory is None:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        directory = os.path.join(base, 'std211-translator')
+    if not directory:
+        return None
+    return directory
+
+
+def entry_path(kind, key):
+    directory = cache_dir()
+    if directory is None:
+        return None
+    return os.path.join(directory, kind, key)
+
+
+def load(kind, key):
+    """Load an object from the on-disk cache
+
+    :param kind: name of the group of cached objects (a subdirectory of the cache directory)
+    :param key: key of the object, must be usable as a file name
+    :return: the cached object, or None if it is not available
+    """
+    path = entry_path(kind, key)
+    if path is None:
+        return None
+    # Imported here, pickle isn't needed to start the translator when the cache isn't used
+    import pickle
+    try:
+        with open(path, 'rb') as fp:
+            obj = pickle.loads(zlib.decompress(fp.read()))
+    except (OSError, EOFError, zlib.error, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+    # Mark the entry as recently used for the eviction in prune
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return obj
+
+
+def store(kind, key, obj):
+    """Save an object to the on-disk cache
+
+    :param kind: name of the group of cached objects (a subdirectory of the cache directory)
+    :param key: key of the object, must be usable as a file name
+    :param obj: the object to save, must be picklable
+    :return: True if the object was saved, False otherwise
+
+    Failures to write (e.g. a read-only file system) are not errors, the object is just not cached.
+    """
+    path = entry_path(kind, key)
+    if path is None:
+        return False
+    import pickle
+    data = zlib.compress(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write and rename so that readers never see a partial entry
+        tmppath = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmppath, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmppath, path)
+    except OSError:
+        return False
+    return True
+
+
+def prune(kind, size=None):
+    """Remove the least recently used entries until the cache is under a size limit
+
+    :param kind: name of the group of cached objects to prune
+    :param size: size limit in bytes, defaults to max_size
+    :return: number of entries removed
+    """
+    directory = cache_dir()
+    if directory is None:
+        return 0
+    if size is None:
+        size = max_size
+    entries = []
+    total = 0
+    try:
+        with os.scandir(os.path.join(directory, kind)) as it:
+            for entry in it:
+                if not entry.is_file() or entry.name.endswith('.tmp'):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+    except OSError:
+        return 0
+    removed = 0
+    entries.sort()
+    for mtime, entry_size, path in entries:
+        if total <= size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= entry_size
+        removed += 1
+    return removed
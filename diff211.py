@@ -0,0 +1,197 @@
+# BuildingSync(R), Copyright (c) 2015-2020, Alliance for Sustainable Energy, LLC.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# (1) Redistributions of source code must retain the above copyright notice, this
+#     list of conditions and the following disclaimer.
+#
+# (2) Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# (3) Neither the name of the copyright holder nor the names of any contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission from the respective party.
+#
+# (4) Other than as required in clauses (1) and (2), distributions in any form of
+#     modifications or other derivative works may not use the "BuildingSync"
+#     trademark or any other confusingly similar designation without specific
+#     prior written permission from Alliance for Sustainable Energy, LLC.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDER(S) AND ANY CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER(S), ANY CONTRIBUTORS, THE
+# UNITED STATES GOVERNMENT, OR THE UNITED STATES DEPARTMENT OF ENERGY, NOR ANY
+# OF THEIR EMPLOYEES, BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import copy
+import lxml.etree as et
+
+# A difference between two documents: 'Added', 'Changed' or 'Removed', the path to the element, and the
+# element as it was and as it is now (None where there isn't one). Changed means the text or the
+# attributes of the element itself changed, its children are compared separately.
+Change = collections.namedtuple('Change', ['kind', 'path', 'old', 'new'])
+
+# What identifies elements that don't have an ID, by local name. Each part is the local name of a child
+# whose text is used, or child/@attribute.
+identities = {'TimeSeries': ('ResourceUseID/@IDref', 'ReadingType', 'TimeSeriesReadingQuantity',
+                             'StartTimeStamp', 'EndTimeStamp'),
+              'UserDefinedField': ('FieldName',),
+              'Measure': ('LongDescription',)}
+
+
+# Namespace of the elements of a diff document, BuildingSync has no elements for differences
+namespace = 'http://github.com/BuildingSync/std211-translator/diff'
+
+
+def localname(tag):
+    return tag[tag.find('}') + 1:]
+
+
+def identify(element):
+    """Get what identifies an element among its siblings
+
+    :param element: element to identify
+    :return: local name of the element and a tuple of (part, value) pairs, empty if only the position
+             identifies it
+    """
+    name = localname(element.tag)
+    if element.get('ID') is not None:
+        return name, (('@ID', element.get('ID')),)
+    parts = identities.get(name)
+    if parts is None:
+        return name, ()
+    children = {}
+    for child in element.iterchildren(tag=et.Element):
+        children.setdefault(localname(child.tag), child)
+    identity = []
+    for part in parts:
+        child_name, _, attribute = part.partition('/@')
+        child = children.get(child_name)
+        if child is None:
+            value = None
+        elif attribute:
+            value = child.get(attribute)
+        else:
+            value = child.text
+        identity.append((part, value))
+    return name, tuple(identity)
+
+
+def quote(value):
+    """Quote a value as an XPath string literal
+
+    XPath has no escapes, so a value with both kinds of quote is put together with concat().
+    """
+    if '"' not in value:
+        return '"%s"' % value
+    if "'" not in value:
+        return "'%s'" % value
+    return 'concat(%s)' % ', \'"\', '.join('"%s"' % part for part in value.split('"'))
+
+
+def keyed_children(element):
+    """Key the children of an element by what identifies them
+
+    :param element: parent element
+    :return: dictionary of key to (child, path step) in document order
+
+    Children with the same identity (including children that are only identified by their position)
+    are told apart by how many came before them.
+    """
+    keyed = collections.OrderedDict()
+    seen = collections.Counter()
+    for child in element.iterchildren(tag=et.Element):
+        name, identity = identify(child)
+        seen[name, identity] += 1
+        count = seen[name, identity]
+        step = name + ''.join('[%s=%s]' % (part, quote(value)) for part, value in identity if value is not None)
+        if count > 1:
+            step += '[%d]' % count
+        keyed[child.tag, identity, count] = (child, step)
+    return keyed
+
+
+def own_text(element):
+    # Whitespace around children is only layout
+    if len(element):
+        return (element.text or '').strip()
+    return element.text or ''
+
+
+def compare(old, new, path, changes):
+    if own_text(old) != own_text(new) or dict(old.attrib) != dict(new.attrib):
+        changes.append(Change('Changed', path, old, new))
+    old_children = keyed_children(old)
+    new_children = keyed_children(new)
+    for key, (child, step) in old_children.items():
+        if key not in new_children:
+            changes.append(Change('Removed', path + '/' + step, child, None))
+    for key, (child, step) in new_children.items():
+        found = old_children.get(key)
+        if found is None:
+            changes.append(Change('Added', path + '/' + step, None, child))
+        else:
+            compare(found[0], child, path + '/' + step, changes)
+
+
+def diff_elements(old, new):
+    """Find the differences between two versions of a document
+
+    :param old: root element of the previous version
+    :param new: root element of the current version
+    :return: list of Change tuples, empty if the documents are the same
+
+    Children are matched by their ID, or for TimeSeries, user defined fields and measures by the
+    children that identify them (see identities), and otherwise by position. Matched elements are
+    compared all the way down, so a changed bill shows up as a changed reading in the one TimeSeries
+    and an added measure as one Added subtree. Paths are made of local names with the identities as
+    predicates, like Building[@ID="Building1"] or UserDefinedField[FieldName="Cost"], with the values
+    quoted as XPath string literals.
+    """
+    changes = []
+    path = '/' + localname(new.tag)
+    if old.tag != new.tag:
+        return [Change('Removed', '/' + localname(old.tag), old, None), Change('Added', path, None, new)]
+    compare(old, new, path, changes)
+    return changes
+
+
+def diff_document(changes, nsmap=None):
+    """Build a document with just the differences
+
+    :param changes: list of Change tuples from diff_elements
+    :param nsmap: namespace prefixes for the root of the document, e.g. those of the compared documents
+                  (optional, the diff namespace gets the prefix diff)
+    :return: root element of the document
+
+    Each change becomes an Added, Changed or Removed element (in the diff namespace) with the path in a
+    path attribute. Added holds a copy of the new subtree and Changed a copy of the element without its
+    children, Removed is empty.
+    """
+    def tag(name):
+        return '{%s}%s' % (namespace, name)
+
+    nsmap = dict(nsmap or {})
+    nsmap['diff'] = namespace
+    root = et.Element(tag('BuildingSyncDiff'), nsmap=nsmap)
+    for change in changes:
+        el = et.SubElement(root, tag(change.kind), path=change.path)
+        if change.kind == 'Added':
+            added = copy.deepcopy(change.new)
+            added.tail = None
+            el.append(added)
+        elif change.kind == 'Changed':
+            changed = et.SubElement(el, change.new.tag, attrib=dict(change.new.attrib))
+            changed.text = change.new.text if len(change.new) == 0 else None
+    return root
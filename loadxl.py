@@ -33,10 +33,48 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-import openpyxl
-import zipfile
+import importlib
 import os
-import xml.etree.ElementTree as et
+import posixpath
+import re
+import zlib
+
+
+class LazyModule:
+    """Stand-in for a module that imports it when one of its attributes is first used
+
+    :param name: name of the module
+
+    openpyxl takes most of the time it takes to start the translator, and isn't needed at all for some
+    things (--help, translating from the cache), so it is imported this way, along with the zipfile and
+    XML modules that are only used to read workbooks. Nothing is put in sys.modules until the real
+    import happens, and that is an ordinary import, so other code importing the same modules (from any
+    thread) isn't affected.
+    """
+
+    __slots__ = ('_name', '_module')
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+
+openpyxl = LazyModule('openpyxl')
+zipfile = LazyModule('zipfile')
+et = LazyModule('xml.etree.ElementTree')
+
+
+def preload():
+    """Import openpyxl now rather than at first use (e.g. before starting worker processes)"""
+    import openpyxl.reader.excel
+    import openpyxl.styles.numbers
+    import openpyxl.utils.datetime
 
 
 class Control:
@@ -70,89 +108,274 @@ def normpath(path):
     return npath
 
 
-def load_workbook(filename, control_sheets=None):
-    """Load an Excel spreadsheet into memory including controls and textboxes
+def cast_cached_value(sheet, cellxml):
+    """Convert the cached value of a formula cell to the matching Python type
+
+    :param sheet: openpyxl worksheet that contains the cell
+    :param cellxml: the cell (<c>) element from the worksheet XML
+    :return: the value Excel computed for the formula when the file was last saved, None if there isn't one
+             or it is an error (#N/A, #REF! and so on)
+    """
+    value = cellxml.findtext('s:v', None, ns)
+    data_type = cellxml.attrib.get('t', 'n')
+    if data_type == 'str':
+        return value if value is not None else ''
+    if value is None:
+        return None
+    if data_type == 'b':
+        return bool(int(value))
+    if data_type == 'e':
+        return None
+    if data_type == 'n':
+        if '.' in value or 'E' in value or 'e' in value:
+            value = float(value)
+        else:
+            value = int(value)
+        cell = sheet[cellxml.attrib['r']]
+        if openpyxl.styles.numbers.is_date_format(cell.number_format):
+            return openpyxl.utils.datetime.from_excel(value, sheet.parent.epoch)
+    return value
+
+
+def read_cached_values(sheet, sheettree):
+    """Collect the cached values of all the formula cells in a worksheet
+
+    :param sheet: openpyxl worksheet that contains the cells
+    :param sheettree: parsed worksheet XML
+    :return: dictionary of cached values keyed by (row, column)
+
+    Cells without a usable cached value are left out, so the formula is used for them.
+    """
+    cached = {}
+    for cellxml in sheettree.iterfind('s:sheetData/s:row/s:c', ns):
+        if cellxml.find('s:f', ns) is None:
+            continue
+        value = cast_cached_value(sheet, cellxml)
+        if value is not None:
+            cached[openpyxl.utils.cell.coordinate_to_tuple(cellxml.attrib['r'])] = value
+    return cached
+
+
+def find_sheet_parts(archive):
+    """Find the archive member that holds each worksheet
+
+    :param archive: zipfile.ZipFile of the Excel file
+    :return: dictionary of archive member names keyed by sheet name
+    """
+    rels = et.fromstring(archive.read('xl/_rels/workbook.xml.rels')).findall('ns0:Relationship', ns)
+    targets = {}
+    for rel in rels:
+        target = rel.attrib['Target']
+        if target.startswith('/'):
+            target = target[1:]
+        else:
+            target = 'xl/' + target
+        targets[rel.attrib['Id']] = normpath(target)
+    parts = {}
+    for sheet in et.fromstring(archive.read('xl/workbook.xml')).findall('s:sheets/s:sheet', ns):
+        relid = sheet.attrib['{%s}id' % ns['r']]
+        if relid in targets:
+            parts[sheet.attrib['name']] = targets[relid]
+    return parts
+
+
+def rels_part(part):
+    """Find the name of the relationships part that belongs to a part
+
+    :param part: archive member name, e.g. xl/worksheets/sheet1.xml
+    :return: archive member name of the relationships, e.g. xl/worksheets/_rels/sheet1.xml.rels
+    """
+    head, tail = posixpath.split(part)
+    return posixpath.join(head, '_rels', tail + '.rels')
+
+
+def resolve_target(part, target):
+    """Resolve a relationship target relative to the part that refers to it
+
+    :param part: archive member name of the part that has the relationship
+    :param target: Target attribute of the relationship
+    :return: archive member name of the target
+    """
+    if target.startswith('/'):
+        return target[1:]
+    return normpath(posixpath.join(posixpath.dirname(part), target))
+
+
+# Parts that every sheet depends on, a change to these means every sheet has to be read again
+shared_parts = ['xl/styles.xml']
+
+# The shared strings are compared one at a time, only those that a sheet uses count towards its CRC. These
+# expressions pick out each shared string (<si>) in xl/sharedStrings.xml, the index of the shared string
+# in each shared string cell (<c t="s"><v>index</v></c>) of a sheet, and the defined names in the
+# workbook, which is much quicker than parsing the XML
+shared_string_re = re.compile(rb'<(?:\w+:)?si\b(?:[^>]*/>|.*?</(?:\w+:)?si>)', re.S)
+shared_string_cell_re = re.compile(rb'<(?:\w+:)?c\b[^>]*\bt=["\']s["\'][^>]*>\s*<(?:\w+:)?v>(\d+)<')
+defined_names_re = re.compile(rb'<(?:\w+:)?definedNames\b.*?</(?:\w+:)?definedNames>', re.S)
+
+
+def sheet_crcs(filename):
+    """Compute a CRC for each worksheet from the CRCs of the parts it depends on
+
+    The CRCs of the sheets, drawings, control properties and styles come from the central directory of
+    the archive. The shared strings are shared by all the sheets, so only the strings each sheet refers
+    to go into its CRC, and the defined names (named ranges, which the lookup tables are read through)
+    go into every one. The sheets and the shared strings are only scanned for that, not parsed.
+
+    :param filename: file name of Excel file
+    :return: dictionary of CRCs keyed by sheet name
+    """
+    crcs = {}
+    with zipfile.ZipFile(filename) as archive:
+        part_crcs = {info.filename: info.CRC for info in archive.infolist()}
+        shared = [part_crcs.get(part, 0) for part in shared_parts]
+        names = defined_names_re.search(archive.read('xl/workbook.xml'))
+        shared.append(zlib.crc32(names.group(0)) if names else 0)
+        strings = []
+        if 'xl/sharedStrings.xml' in part_crcs:
+            strings = [zlib.crc32(match.group(0))
+                       for match in shared_string_re.finditer(archive.read('xl/sharedStrings.xml'))]
+        for name, part in find_sheet_parts(archive).items():
+            parts = [part]
+            relspart = rels_part(part)
+            if relspart in part_crcs:
+                parts.append(relspart)
+                for rel in et.fromstring(archive.read(relspart)).findall('ns0:Relationship', ns):
+                    if rel.attrib.get('TargetMode') == 'External':
+                        continue
+                    parts.append(resolve_target(part, rel.attrib['Target']))
+            values = shared + [part_crcs.get(part, 0) for part in parts]
+            if part in part_crcs:
+                used = {int(index) for index in shared_string_cell_re.findall(archive.read(part))}
+                values.extend(strings[index] if index < len(strings) else 0 for index in sorted(used))
+            crc = 0
+            for value in values:
+                crc = zlib.crc32(value.to_bytes(4, 'little'), crc)
+            crcs[name] = crc
+    return crcs
+
+
+# Defined by sheet_subset_reader on first use, it is a subclass of an openpyxl class
+SheetSubsetReader = None
+
+
+def sheet_subset_reader():
+    """Get the openpyxl reader class that skips all but some of the worksheets"""
+    global SheetSubsetReader
+    if SheetSubsetReader is not None:
+        return SheetSubsetReader
+    from openpyxl.reader.excel import ExcelReader
+
+    class SheetSubsetReader(ExcelReader):
+        """openpyxl reader that skips all but some of the worksheets"""
+
+        def __init__(self, fn, sheetnames, **kwargs):
+            super().__init__(fn, **kwargs)
+            self.sheetnames = sheetnames
+
+        def read_workbook(self):
+            super().read_workbook()
+            positions = {}
+            sheets = []
+            for position, sheet in enumerate(self.parser.sheets):
+                if sheet.name in self.sheetnames:
+                    positions[position] = len(sheets)
+                    sheets.append(sheet)
+            self.parser.sheets = sheets
+            # Sheet-local names (print areas and titles) refer to sheets by position, renumber them
+            names = []
+            for defn in self.wb.defined_names.definedName:
+                if defn.localSheetId is not None:
+                    if defn.localSheetId not in positions:
+                        continue
+                    defn.localSheetId = positions[defn.localSheetId]
+                names.append(defn)
+            self.wb.defined_names.definedName = names
+
+    return SheetSubsetReader
+
+
+def load_workbook(filename, control_sheets=None, sheets=None):
+    """Load an Excel spreadsheet into memory including controls, textboxes, and cached formula values
 
     :param filename: file name of Excel file read
     :param control_sheets: if not none, the list of names of spreadsheets to process. If not specified, all sheets will be processed
-    :return: openpyxl workbook object with appended controls and textboxes
+    :param sheets: if not none, the list of names of spreadsheets to load at all. If not specified, all sheets will be loaded
+    :return: openpyxl workbook object with appended controls, textboxes, cached values, and part CRCs
     """
-    workbook = openpyxl.load_workbook(filename)  # ,read_only=True,keep_vba=True)
+    if sheets is None:
+        workbook = openpyxl.load_workbook(filename)  # ,read_only=True,keep_vba=True)
+    else:
+        reader = sheet_subset_reader()(filename, sheets)
+        reader.read()
+        workbook = reader.wb
     if not control_sheets:
         control_sheets = workbook.sheetnames
-    sheets = []
-    for number, name in enumerate(workbook.sheetnames):
-        if name in control_sheets:
-            sheets.append((number + 1, name))
-    archive = zipfile.ZipFile(filename)  # workbook._archive
-    for number, sheetname in sheets:
-        sheet = workbook[sheetname]
-        sheet.controls = {}
-        sheet.textboxes = {}
-        # Find and read the sheet
-        sheetxml = 'sheet%d.xml' % number
-        for path in archive.namelist():
-            if path.endswith(sheetxml):
-                break
-        else:
-            continue
-        xmltxt = archive.read(path)
-        # Read the controls in the sheet
-        controlxml = et.fromstring(xmltxt).findall('.//s:control', ns)
-        for control in controlxml:
-            obj = Control(control.attrib['name'],
-                          shapeId=control.attrib['shapeId'],
-                          relId=control.attrib['{%s}id' % ns['r']])
-            sheet.controls[obj.name] = obj
-        # Find and read the relationships sheet
-        sheetxml = 'sheet%d.xml.rels' % number
-        for path in archive.namelist():
-            if path.endswith(sheetxml):
-                break
-        else:
-            continue
-        # Get the relationship for the sheet itself
-        drawingxml = et.fromstring(xmltxt).findall('.//s:drawing', ns)
-        if len(drawingxml) != 1:
-            continue
-        drawingId = drawingxml[0].attrib['{%s}id' % ns['r']]
-        # Now for the controls
-        xmltxt = archive.read(path)
-        rels = et.fromstring(xmltxt).findall('.//ns0:Relationship', ns)
-        drawingfile = None
-        for rel in rels:
-            if rel.attrib['Id'] == drawingId:
-                drawingfile = rel.attrib['Target']
-                if drawingfile.startswith('..'):
-                    drawingfile = '../' + drawingfile
-                drawingfile = normpath(path.replace(sheetxml, drawingfile))
-        # Mine the drawing file for the names of the controls
-        if drawingfile:
-            xmltxt = archive.read(drawingfile)
-            drawing = et.fromstring(xmltxt)
-            anchors = drawing.findall('.//xdr:absoluteCellAnchor', ns)
-            anchors.extend(drawing.findall('.//xdr:twoCellAnchor', ns))
-            anchors.extend(drawing.findall('.//xdr:oneCellAnchor', ns))
-            for anchor in anchors:
-                t = anchor.findall('.//a:t', ns)
-                if not t:
-                    continue
-                cnvpr = anchor.findall('.//xdr:cNvPr', ns)[0]
-                try:
-                    sheet.controls[cnvpr.attrib['name']].text = t[0].text
-                except KeyError:
-                    sheet.textboxes[cnvpr.attrib['name']] = t[0].text
-        # Find and get info from the individual property files
-        for name, control in sheet.controls.items():
+    with zipfile.ZipFile(filename) as archive:  # workbook._archive
+        # The central directory has a CRC for every part, keep them to fingerprint content without reading it
+        workbook.part_crcs = {info.filename: info.CRC for info in archive.infolist()}
+        workbook.sheet_parts = find_sheet_parts(archive)
+        for sheetname in workbook.sheetnames:
+            if sheetname not in control_sheets:
+                continue
+            sheet = workbook[sheetname]
+            sheet.controls = {}
+            sheet.textboxes = {}
+            sheet.cached_values = {}
+            # Find and read the sheet
+            sheetpart = workbook.sheet_parts.get(sheetname)
+            if sheetpart not in workbook.part_crcs:
+                continue
+            sheettree = et.fromstring(archive.read(sheetpart))
+            # Keep the values Excel computed for formulas, openpyxl only gives the formula text
+            sheet.cached_values = read_cached_values(sheet, sheettree)
+            # Read the controls in the sheet
+            controlxml = sheettree.findall('.//s:control', ns)
+            for control in controlxml:
+                obj = Control(control.attrib['name'],
+                              shapeId=control.attrib['shapeId'],
+                              relId=control.attrib['{%s}id' % ns['r']])
+                sheet.controls[obj.name] = obj
+            # Find and read the relationships sheet
+            path = rels_part(sheetpart)
+            if path not in workbook.part_crcs:
+                continue
+            # Get the relationship for the sheet itself
+            drawingxml = sheettree.findall('.//s:drawing', ns)
+            if len(drawingxml) != 1:
+                continue
+            drawingId = drawingxml[0].attrib['{%s}id' % ns['r']]
+            # Now for the controls
+            xmltxt = archive.read(path)
+            rels = et.fromstring(xmltxt).findall('.//ns0:Relationship', ns)
+            drawingfile = None
             for rel in rels:
-                if rel.attrib['Id'] == control.relId:
-                    propfile = rel.attrib['Target']
-                    if propfile.startswith('..'):
-                        propfile = '../' + propfile
-                    propfile = normpath(path.replace(sheetxml, propfile))
-                    xmltxt = archive.read(propfile)
-                    form = et.fromstring(xmltxt)
-                    if 'checked' in form.attrib:
-                        if form.attrib['checked'] == 'Checked':
-                            control.checked = True
+                if rel.attrib['Id'] == drawingId:
+                    drawingfile = resolve_target(sheetpart, rel.attrib['Target'])
+            # Mine the drawing file for the names of the controls
+            if drawingfile:
+                xmltxt = archive.read(drawingfile)
+                drawing = et.fromstring(xmltxt)
+                anchors = drawing.findall('.//xdr:absoluteCellAnchor', ns)
+                anchors.extend(drawing.findall('.//xdr:twoCellAnchor', ns))
+                anchors.extend(drawing.findall('.//xdr:oneCellAnchor', ns))
+                for anchor in anchors:
+                    t = anchor.findall('.//a:t', ns)
+                    if not t:
+                        continue
+                    cnvpr = anchor.findall('.//xdr:cNvPr', ns)[0]
+                    try:
+                        sheet.controls[cnvpr.attrib['name']].text = t[0].text
+                    except KeyError:
+                        sheet.textboxes[cnvpr.attrib['name']] = t[0].text
+            # Find and get info from the individual property files
+            for name, control in sheet.controls.items():
+                for rel in rels:
+                    if rel.attrib['Id'] == control.relId:
+                        propfile = resolve_target(sheetpart, rel.attrib['Target'])
+                        xmltxt = archive.read(propfile)
+                        form = et.fromstring(xmltxt)
+                        if 'checked' in form.attrib:
+                            if form.attrib['checked'] == 'Checked':
+                                control.checked = True
     return workbook
+
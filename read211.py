@@ -33,15 +33,39 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-import openpyxl
 import loadxl
+import cache211
+import diff211
+import schema211
+import tags211
+import contextlib
 import datetime
+import functools
+import glob
+import hashlib
+import importlib.util
+import itertools
 import os
+import sys
+import time
 import warnings
 import calendar
+import collections
+import copy
 import lxml.etree as et
+from io import BytesIO
+openpyxl = loadxl.openpyxl
+# Only needed for some outputs and caching, imported when first used (see loadxl.LazyModule)
+bz2 = loadxl.LazyModule('bz2')
+gzip = loadxl.LazyModule('gzip')
+json = loadxl.LazyModule('json')
+lzma = loadxl.LazyModule('lzma')
+pickle = loadxl.LazyModule('pickle')
+# zstd compression is optional, the package is only looked for here
+zstandard = loadxl.LazyModule('zstandard') if importlib.util.find_spec('zstandard') is not None else None
 # import xml.etree.ElementTree as et
-from xml.dom import minidom
+
+__version__ = '0.0.2'
 
 # Known limitations:
 # 1) Some of the keys are not scrubbed for those asterisks
@@ -54,7 +78,8 @@ from xml.dom import minidom
 # 8) "All - Delivered Energy" is a bit complicated, only support what's in the template
 # 9) Unit conversions, particularly for metered and delivered energy, are too complicated
 
-# This table could be read from the spreadsheet
+# The unit tables below are defaults, the values from the 'Drop Down Lists' sheet
+# are used when it is available (see read_lookup_tables)
 metered_energy_bsync_units = {'Electricity': 'kWh',
                               'Natural Gas': 'therms',
                               'Purchased Steam': 'lbs',
@@ -90,7 +115,6 @@ metered_energy_type_lookup = {'Electricity': 'Electricity',
                               'Coal': 'Coal',
                               'Other': 'Other'}
 
-# This table could be read from the spreadsheet
 delivered_energy_default_units = {'Oil': 'Gallons',
                                   'Propane': 'Gallons',
                                   'Coal': 'Mass ton',
@@ -157,6 +181,16 @@ bsync_unit_lookup = {'kWh': 'kWh',
                      'gallons (Propane)': 'Gallons'}
 # 'cubic feet (Propane)': 2.516}
 
+default_lookup_tables = {'Metered Energy BuildingSync Units': metered_energy_bsync_units,
+                         'Metered Energy Default Units': metered_energy_default_units,
+                         'Conversion to kBtu': conversion_to_kBtu}
+
+# Lookup tables by template fingerprint, backed by the on-disk cache. The least recently used are dropped
+# past the size limit, long-running processes see many workbooks
+template_lookup_tables = collections.OrderedDict()
+# Maximum number of templates in template_lookup_tables
+template_lookup_tables_size = 16
+
 energysources_labels = ['Energy Source',
                         'ID',
                         None,
@@ -247,6 +281,21 @@ def tuple_from_coordinate(coordinate):
     return col, row
 
 
+def cellvalue(cell):
+    '''Get the value of a cell, preferring what Excel computed for formulas
+
+    Formula cells hold the formula text in openpyxl, loadxl keeps the value
+    that was cached when the workbook was last saved. If there is no cached
+    value (e.g. the file was never opened in Excel), the formula is returned.
+    '''
+    if cell.data_type == 'f':
+        try:
+            return cell.parent.cached_values[(cell.row, cell.column)]
+        except (AttributeError, KeyError):
+            pass
+    return cell.value
+
+
 class ScanFailure(Exception):
     pass
 
@@ -259,19 +308,27 @@ class MissingRequired(Exception):
     pass
 
 
+class InvalidIDs(Exception):
+    pass
+
+
+class IDWarning(UserWarning):
+    pass
+
+
 def cellrange(worksheet, mincol=None, minrow=None, maxcol=None, maxrow=None):
     if minrow == maxrow:
         for row in worksheet.iter_rows(min_row=minrow, min_col=mincol,
                                        max_col=maxcol, max_row=maxrow):
-            return [el.value for el in row]
+            return [cellvalue(el) for el in row]
     elif mincol == maxcol:
         for col in worksheet.iter_cols(min_row=minrow, min_col=mincol,
                                        max_col=maxcol, max_row=maxrow):
-            return [el.value for el in col]
+            return [cellvalue(el) for el in col]
     results = []
     for row in worksheet.iter_rows(min_row=minrow, min_col=mincol,
                                    max_col=maxcol, max_row=maxrow):
-        results.append([el.value for el in row])
+        results.append([cellvalue(el) for el in row])
     return results
 
 
@@ -299,33 +356,33 @@ def getlabeledvalues(worksheet, cellrange, labelcolor=0, IP=True,
     if not hasunits:
         for row in worksheet.iter_rows(min_row=minrow, min_col=labelcol,
                                        max_col=valuecol, max_row=maxrow):
-            if row[0].value is not None and row[-1].value is not None:
+            if cellvalue(row[0]) is not None and cellvalue(row[-1]) is not None:
                 if variablelength:
                     if (row[0].fill.start_color.index != labelcolor or
                             row[-1].fill.start_color.index != valuecolor):
                         break
-                result[row[0].value] = row[-1].value
+                result[cellvalue(row[0])] = cellvalue(row[-1])
     else:
         for row in worksheet.iter_rows(min_row=minrow, min_col=labelcol,
                                        max_col=valuecol + 1, max_row=maxrow):
-            if row[0].value is not None and row[-2].value is not None:
+            if cellvalue(row[0]) is not None and cellvalue(row[-2]) is not None:
                 if variablelength:
                     if (row[0].fill.start_color.index != labelcolor or
                             row[-2].fill.start_color.index != valuecolor):
                         break
-                if row[-1].value is not None:
+                if cellvalue(row[-1]) is not None:
                     # Handle the units, this could get ugly
-                    units = row[-1].value
+                    units = cellvalue(row[-1])
 
                     if units == '=IF(Instructions!$B$18="IP","sq ft","sq m")':
                         if IP:
                             units = 'sq ft'
                         else:
                             units = 'sq m'
-                    key = row[0].value.rstrip() + (' (%s)' % units)
-                    result[key] = row[-2].value
+                    key = cellvalue(row[0]).rstrip() + (' (%s)' % units)
+                    result[key] = cellvalue(row[-2])
                 else:
-                    result[row[0].value] = row[-2].value
+                    result[cellvalue(row[0])] = cellvalue(row[-2])
     return result
 
 
@@ -348,15 +405,15 @@ def getlist(worksheet, cellrange, variablelength=False, fillcolor=8):
         for row in worksheet.iter_rows(min_row=rangetuple[1], min_col=listcol,
                                        max_col=listcol, max_row=rangetuple[3]):
             if variablelength:
-                if not row[0].value or row[0].fill.start_color.index != fillcolor:
+                if not cellvalue(row[0]) or row[0].fill.start_color.index != fillcolor:
                     break
-            result.append(row[0].value)
+            result.append(cellvalue(row[0]))
     elif diff[1] == 0:
         listrow = rangetuple[1]
         for col in worksheet.iter_cols(min_col=rangetuple[0], min_row=listrow,
                                        max_row=listrow, max_col=rangetuple[2]):
             if variablelength:
-                if not col[0].value or col[0].fill.start_color.index != fillcolor:
+                if not cellvalue(col[0]) or col[0].fill.start_color.index != fillcolor:
                     break
             result.append(col[0])
     return result
@@ -380,13 +437,13 @@ def getinfo(worksheet, cellrange, variablelength=False, fillcolor=8,
         for row in worksheet.iter_rows(min_col=rangetuple[0], min_row=rangetuple[1],
                                        max_col=rangetuple[2], max_row=rangetuple[3]):
             if variablelength:
-                if (not row[0].value
+                if (not cellvalue(row[0])
                         or row[0].fill.start_color.index != fillcolor):
                     break
             elif not keepemptyrows:
-                if not row[0].value:
+                if not cellvalue(row[0]):
                     continue
-            data = [el.value for el in row[1:]]
+            data = [cellvalue(el) for el in row[1:]]
             if not keepemptyrows:
                 count = 0
                 for el in data:
@@ -399,19 +456,19 @@ def getinfo(worksheet, cellrange, variablelength=False, fillcolor=8,
                     data = dict(zip(labels[1:], data))
                 else:
                     data = dict([el for el in zip(labels[1:], data) if el[1] is not None])
-            result[row[0].value] = data
+            result[cellvalue(row[0])] = data
     else:
         listrow = rangetuple[1]
         for col in worksheet.iter_cols(min_col=rangetuple[0], min_row=rangetuple[1],
                                        max_row=rangetuple[3], max_col=rangetuple[2]):
             if variablelength:
-                if (not col[0].value
+                if (not cellvalue(col[0])
                         or col[0].fill.start_color.index != fillcolor):
                     break
             elif not keepemptyrows:
-                if not col[0].value:
+                if not cellvalue(col[0]):
                     continue
-            data = [el.value for el in col[1:]]
+            data = [cellvalue(el) for el in col[1:]]
             if not keepemptyrows:
                 count = 0
                 for el in data:
@@ -424,7 +481,7 @@ def getinfo(worksheet, cellrange, variablelength=False, fillcolor=8,
                     data = dict(zip(labels[1:], data))
                 else:
                     data = dict([el for el in zip(labels[1:], data) if el[1] is not None])
-            result[col[0].value] = data
+            result[cellvalue(col[0])] = data
     return result
 
 
@@ -446,13 +503,13 @@ def gettable(worksheet, cellrange, variablelength=False, fillcolor=8,
         for row in worksheet.iter_rows(min_col=rangetuple[0], min_row=rangetuple[1],
                                        max_col=rangetuple[2], max_row=rangetuple[3]):
             if variablelength:
-                if (not row[0].value
+                if (not cellvalue(row[0])
                         or row[0].fill.start_color.index != fillcolor):
                     break
             elif not keepempty:
-                if not row[0].value:
+                if not cellvalue(row[0]):
                     continue
-            data = [el.value for el in row]
+            data = [cellvalue(el) for el in row]
             if not keepempty:
                 count = 0
                 for el in data:
@@ -468,13 +525,13 @@ def gettable(worksheet, cellrange, variablelength=False, fillcolor=8,
         for col in worksheet.iter_cols(min_col=rangetuple[0], min_row=rangetuple[1],
                                        max_row=rangetuple[3], max_col=rangetuple[2]):
             if variablelength:
-                if (not col[0].value
+                if (not cellvalue(col[0])
                         or col[0].fill.start_color.index != fillcolor):
                     break
             elif not keepempty:
-                if not col[0].value:
+                if not cellvalue(col[0]):
                     continue
-            data = [el.value for el in col]
+            data = [cellvalue(el) for el in col]
             if not keepempty:
                 count = 0
                 for el in data:
@@ -506,13 +563,13 @@ def getlistinfo(worksheet, cellrange, variablelength=False, fillcolor=8,
         for row in worksheet.iter_rows(min_col=rangetuple[0], min_row=rangetuple[1],
                                        max_col=rangetuple[2], max_row=rangetuple[3]):
             if variablelength:
-                if (not row[0].value
+                if (not cellvalue(row[0])
                         or row[0].fill.start_color.index != fillcolor):
                     break
             elif not keepempty:
-                if not row[0].value:
+                if not cellvalue(row[0]):
                     continue
-            data = [el.value for el in row]
+            data = [cellvalue(el) for el in row]
 
             if not keepempty:
                 count = 0
@@ -536,13 +593,13 @@ def getlistinfo(worksheet, cellrange, variablelength=False, fillcolor=8,
         for col in worksheet.iter_cols(min_col=rangetuple[0], min_row=rangetuple[1],
                                        max_row=rangetuple[3], max_col=rangetuple[2]):
             if variablelength:
-                if (not col[0].value
+                if (not cellvalue(col[0])
                         or col[0].fill.start_color.index != fillcolor):
                     break
             elif not keepempty:
-                if not col[0].value:
+                if not cellvalue(col[0]):
                     continue
-            data = [el.value for el in col[1:]]
+            data = [cellvalue(el) for el in col[1:]]
             if not keepempty:
                 count = 0
                 for el in data:
@@ -567,7 +624,7 @@ def gettabular(worksheet, mincol, minrow, maxcol, maxrow):
     results = []
     for row in worksheet.iter_rows(min_row=minrow, min_col=mincol,
                                    max_col=maxcol, max_row=maxrow):
-        results.append([el.value for el in row])
+        results.append([cellvalue(el) for el in row])
     return results
 
 
@@ -583,7 +640,7 @@ def scanRowForEmpty(worksheet, col, row, maxcol=256):
     count = 0
     for col in worksheet.iter_cols(min_col=col, min_row=row,
                                    max_row=row):
-        if not col[0].value:
+        if not cellvalue(col[0]):
             return count
         count += 1
 
@@ -596,8 +653,8 @@ def scanForExpandableColumnTable(worksheet, mincol=1, minrow=1, maxrow=1,
         count = 0
         data = []
         for el in col:
-            data.append(el.value)
-            if el.value:
+            data.append(cellvalue(el))
+            if cellvalue(el):
                 count += 1
         if count < minentries:
             return result
@@ -610,7 +667,7 @@ def scanForHeaderRow(worksheet, mincol, minrow, header):
     count = 0
     for row in worksheet.iter_rows(min_col=mincol, min_row=minrow,
                                    max_col=maxcol):
-        data = [el.value for el in row]
+        data = [cellvalue(el) for el in row]
         if data == header:
             return minrow + count
         count += 1
@@ -622,7 +679,7 @@ def scan_for_cell_value(worksheet, mincol=None, minrow=None, maxcol=None,
     for row in worksheet.iter_rows(min_col=mincol, min_row=minrow,
                                    max_col=maxcol, max_row=maxrow):
         for el in row:
-            if el.value == value:
+            if cellvalue(el) == value:
                 return tuple_from_coordinate(el.coordinate)
     raise ScanFailure('Failed to find cell value')
 
@@ -641,7 +698,7 @@ def read_all_building(worksheet):
     # Scrub any dates
     for key, value in bldg_info.items():
         if isinstance(value, datetime.datetime):
-            bldg_info[key] = str(value)
+            bldg_info[key] = format_value(value)
     # Excluded space
     excluded_spaces = getlist(worksheet, 'E24:E26', variablelength=True)
     # Space Function
@@ -673,7 +730,7 @@ def read_all_building(worksheet):
     # Look for Facility Description - Notable Conditions
     cellcol, cellrow = scan_for_cell_value(worksheet, mincol=1, minrow=54, maxcol=1,
                                            value='Facility Description - Notable Conditions')
-    description = worksheet.cell(column=cellcol, row=cellrow + 1).value
+    description = cellvalue(worksheet.cell(column=cellcol, row=cellrow + 1))
 
     # Package the data
     bldg_info['Occupancy'] = occupancy
@@ -721,7 +778,7 @@ def read_all_metered_energy(worksheet):
     # There's a lot of hardcoding here, it is not clear how this sheet
     # would be expanded
     header_info = getlabeledvalues(worksheet, 'A5:C8')
-    methodology = worksheet['A12'].value
+    methodology = cellvalue(worksheet['A12'])
     electricity_labels = ['Start Date', 'End Date', 'Days', 'Use', 'Peak', 'Cost']
     other_labels = ['Start Date', 'End Date', 'Days', 'Use', 'Cost']
     data = {}
@@ -782,7 +839,7 @@ def read_all_delivered_energy(worksheet):
     cellcol, cellrow = scan_for_cell_value(worksheet, mincol=1, minrow=cellrow + 1,
                                            maxcol=1,
                                            value='Estimated Annual Use**')
-    estimated_annual_use = worksheet.cell(column=cellcol + 2, row=cellrow).value
+    estimated_annual_use = cellvalue(worksheet.cell(column=cellcol + 2, row=cellrow))
     header_info['Estimated Annual Use**'] = estimated_annual_use
     return {'Definition': header_info, 'Data': delivered}
 
@@ -1161,11 +1218,122 @@ def read_L2_eem_summary(worksheet):
             'Potential Capital Recommendations': potentialcapital}
 
 
-def read_std211_xlsx(workbook, IP=True):
+def template_fingerprint(workbook):
+    '''Compute a fingerprint of the lookup table content of a workbook
+
+    The fingerprint is made from the CRC of the 'Drop Down Lists' sheet part (from the
+    zip central directory, see loadxl.load_workbook) and the text of the named ranges the
+    conversions come from, so nothing has to be read to work it out. Workbooks made from
+    the same template have the same fingerprint, whatever has been entered in them.
+    Workbooks that weren't loaded with loadxl have no fingerprint (None).
+    '''
+    part = getattr(workbook, 'sheet_parts', {}).get('Drop Down Lists')
+    part_crcs = getattr(workbook, 'part_crcs', {})
+    if part not in part_crcs:
+        return None
+    sha = hashlib.sha1(('%s:%08x' % (part, part_crcs[part])).encode('utf-8'))
+    for name in ['EnergyUnits', 'EnergyConversionRates']:
+        if name in workbook.defined_names:
+            sha.update(workbook.defined_names[name].attr_text.encode('utf-8'))
+    return sha.hexdigest()
+
+
+def read_named_range(workbook, name):
+    values = []
+    if name not in workbook.defined_names:
+        return values
+    for sheetname, cells in workbook.defined_names[name].destinations:
+        values.extend(getlist(workbook[sheetname], cells.replace('$', '')))
+    return values
+
+
+def read_lookup_tables(workbook):
+    '''Read the unit and conversion tables from the 'Drop Down Lists' sheet
+
+    The default energy units for each type of metered energy are next to the
+    'Metered Energy Types' list, and the conversions to kBtu are in the
+    EnergyUnits and EnergyConversionRates named ranges. The BuildingSync units
+    are derived from the default units.
+    '''
+    worksheet = workbook['Drop Down Lists']
+    # Look for the list headers in the first row
+    cellcol, cellrow = scan_for_cell_value(worksheet, minrow=1, maxrow=1,
+                                           value='Metered Energy Types')
+    default_units = {}
+    for row in worksheet.iter_rows(min_col=cellcol, min_row=cellrow + 1,
+                                   max_col=cellcol + 1):
+        metered_type = cellvalue(row[0])
+        if not metered_type or not isinstance(metered_type, str):
+            break
+        default_units[metered_type] = cellvalue(row[1]) or ''
+    bsync_units = {}
+    for metered_type, units in default_units.items():
+        bsync_units[metered_type] = bsync_unit_lookup.get(units, 'Unknown')
+    conversions = {}
+    for units, rate in zip(read_named_range(workbook, 'EnergyUnits'),
+                           read_named_range(workbook, 'EnergyConversionRates')):
+        if units is not None and rate is not None:
+            conversions[units] = rate
+    return {'Metered Energy BuildingSync Units': bsync_units or metered_energy_bsync_units,
+            'Metered Energy Default Units': default_units or metered_energy_default_units,
+            'Conversion to kBtu': conversions or conversion_to_kBtu}
+
+
+def get_lookup_tables(workbook):
+    '''Get the lookup tables for a workbook, reading them only for templates that haven't been seen
+
+    Tables are cached in memory and on disk by template fingerprint. Workbooks without
+    a 'Drop Down Lists' sheet get the default tables.
+    '''
+    if 'Drop Down Lists' not in workbook.sheetnames:
+        return default_lookup_tables
+    fingerprint = template_fingerprint(workbook)
+    if fingerprint in template_lookup_tables:
+        template_lookup_tables.move_to_end(fingerprint)
+        return template_lookup_tables[fingerprint]
+    tables = None
+    if fingerprint is not None:
+        tables = cache211.load('tables', fingerprint)
+    if tables is None:
+        try:
+            tables = read_lookup_tables(workbook)
+        except ScanFailure:
+            # Not the layout we know, stick with the defaults
+            return default_lookup_tables
+        if fingerprint is None:
+            return tables
+        cache211.store('tables', fingerprint, tables)
+    template_lookup_tables[fingerprint] = tables
+    while len(template_lookup_tables) > template_lookup_tables_size:
+        template_lookup_tables.popitem(last=False)
+    return tables
+
+
+def std211_readers(IP=True):
+    '''List the readers for the Standard 211 sheets as (key, sheet name, reader) tuples'''
+    return [('All - Building', 'All - Building', read_all_building),
+            ('All - Metered Energy', 'All - Metered Energy', read_all_metered_energy),
+            ('All - Delivered Energy', 'All - Delivered Energy', read_all_delivered_energy),
+            ('All - Space Functions', 'All - Space Functions', read_space_functions),
+            ('L1 - EEM Summary', 'L1 - EEM Summary', read_L1_eem_summary),
+            ('L2 - Envelope', 'L2 - Envelope', functools.partial(read_L2_envelope, IP=IP)),
+            ('L2 - HVAC', 'L2 - HVAC', read_L2_hvac),
+            ('L2 - Equipment Inventory', 'L2 Equipment Inventory', read_L2_equipment_inventory),
+            ('L2 - Lighting Elec & Plug Loads', 'L2 - Lighting Elec & Plug Loads', read_L2_lighting),
+            ('L2 - EEM Summary', 'L2 - EEM Summary', read_L2_eem_summary)]
+
+
+# The sheet that each section of the Standard 211 data is read from
+std211_sheets = {key: sheetname for key, sheetname, reader in std211_readers()}
+std211_sheets['Lookup Tables'] = 'Drop Down Lists'
+
+
+def read_std211_xlsx(workbook, IP=True, sections=None):
     '''Read Standard 211 information from an Excel workbook into a dictionary.
 
     :param workbook: Excel workbook object from openpyxl/loadxl
     :param IP: Boolean determining unit handling, True uses IP units (Defaults to True)
+    :param sections: if not None, the list of sections (keys of the dictionary) to read, otherwise read them all
     :return: dictionary object containing data
 
     Pull data from a spreadsheet object and populate a dictionary. Due to the use of checkboxes in a number of sheets,
@@ -1174,31 +1342,145 @@ def read_std211_xlsx(workbook, IP=True):
     '''
 
     std211 = {}
-    #
-    # Read the 'All - Building' sheet
-    std211['All - Building'] = read_all_building(workbook['All - Building'])
-    # Read the 'All - Metered Energy' sheet
-    std211['All - Metered Energy'] = read_all_metered_energy(workbook['All - Metered Energy'])
-    # Read the 'All - Delivered Energy' sheet
-    std211['All - Delivered Energy'] = read_all_delivered_energy(workbook['All - Delivered Energy'])
-    # Read the 'All - Space Functions' sheet
-    std211['All - Space Functions'] = read_space_functions(workbook['All - Space Functions'])
-    # Read the 'L1 - EEM Summary' sheet
-    std211['L1 - EEM Summary'] = read_L1_eem_summary(workbook['L1 - EEM Summary'])
-    # Read the 'L2 - Envelope' sheet
-    std211['L2 - Envelope'] = read_L2_envelope(workbook['L2 - Envelope'], IP=IP)
-    # Read the 'L2 - HVAC' sheet
-    std211['L2 - HVAC'] = read_L2_hvac(workbook['L2 - HVAC'])
-    # Read the 'L2 - Equipment Inventory' sheet
-    std211['L2 - Equipment Inventory'] = read_L2_equipment_inventory(workbook['L2 Equipment Inventory'])
-    # Read the 'L2 - Lighting Elec & Plug Loads' sheet
-    std211['L2 - Lighting Elec & Plug Loads'] = read_L2_lighting(workbook['L2 - Lighting Elec & Plug Loads'])
-    # Read the 'L2 - EEM Summary' sheet
-    std211['L2 - EEM Summary'] = read_L2_eem_summary(workbook['L2 - EEM Summary'])
+    for key, sheetname, reader in std211_readers(IP=IP):
+        if sections is not None and key not in sections:
+            continue
+        std211[key] = reader(workbook[sheetname])
+    # Get the unit tables that go with this version of the template
+    if sections is None or 'Lookup Tables' in sections:
+        std211['Lookup Tables'] = get_lookup_tables(workbook)
     # Done!
     return std211
 
 
+def read_std211_by_sheet(filename, verbose=False, IP=True, sections=None):
+    '''Read Standard 211 information from an Excel file, loading one sheet at a time.
+
+    :param filename: name of input Excel file
+    :param verbose: Boolean flag controlling output during loading (defaults to False)
+    :param IP: Boolean determining unit handling, True uses IP units (Defaults to True)
+    :param sections: if not None, the list of sections (keys of the dictionary) to read, otherwise read them all
+    :return: dictionary object containing data
+
+    Each sheet is loaded on its own (see loadxl.load_workbook) and dropped once it has been read, so
+    only one sheet is ever in memory. The shared strings and styles are loaded again for every sheet,
+    which makes this slower than reading the whole workbook at once.
+    '''
+    std211 = {}
+    for key, sheetname in std211_sheets.items():
+        if sections is not None and key not in sections:
+            continue
+        if verbose:
+            wb = loadxl.load_workbook(filename, sheets=[sheetname])
+        else:
+            warnings.simplefilter("ignore")
+            wb = loadxl.load_workbook(filename, sheets=[sheetname])
+            warnings.simplefilter("default")
+        std211.update(read_std211_xlsx(wb, IP=IP, sections=[key]))
+        del wb
+    return std211
+
+
+# Version of the workbook readers. The cached workbook data is keyed with this, so bump it whenever a
+# change to the readers (here or in loadxl) changes what they return. Mapping changes don't need it,
+# the cached data is read before mapping.
+reader_version = 1
+
+
+def std211_cache_key(filename, IP=True):
+    '''Compute the cache key for the Standard 211 data in a workbook
+
+    The key is a hash of the workbook contents, the reader version (see reader_version), and the
+    unit setting.
+    '''
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            sha.update(chunk)
+    sha.update(('%s:%s' % (reader_version, IP)).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def load_std211(filename, verbose=False, IP=True, cache=True, lowmem=False, incremental=True):
+    '''Read Standard 211 information from an Excel file, using the on-disk cache if possible.
+
+    :param filename: name of input Excel file
+    :param verbose: Boolean flag controlling output during loading (defaults to False)
+    :param IP: Boolean determining unit handling, True uses IP units (Defaults to True)
+    :param cache: Boolean determining if the cache is used (defaults to True)
+    :param lowmem: Boolean determining if the workbook is loaded one sheet at a time to use less memory
+                   (defaults to False, see read_std211_by_sheet)
+    :param incremental: Boolean determining if sheets read from the same path before are reused (defaults
+                        to True, see load_std211_incremental), turn it off for files that aren't revisions
+                        of one workbook
+    :return: dictionary object containing data
+
+    Loading the workbook and reading the data are by far the most time consuming
+    steps of a translation, so the result is cached by the content of the workbook.
+    Translating the same workbook again (e.g. with different options) skips both.
+    '''
+    key = None
+    if cache:
+        key = std211_cache_key(filename, IP=IP)
+        std211 = cache211.load('std211', key)
+        if std211 is not None:
+            return std211
+        if incremental:
+            std211 = load_std211_incremental(filename, verbose=verbose, IP=IP, lowmem=lowmem)
+        else:
+            std211 = load_std211(filename, verbose=verbose, IP=IP, cache=False, lowmem=lowmem)
+        if cache211.store('std211', key, std211):
+            cache211.prune('std211')
+        return std211
+    if lowmem:
+        return read_std211_by_sheet(filename, verbose=verbose, IP=IP)
+    if verbose:
+        wb = loadxl.load_workbook(filename)
+    else:
+        warnings.simplefilter("ignore")
+        wb = loadxl.load_workbook(filename)
+        warnings.simplefilter("default")
+    return read_std211_xlsx(wb, IP=IP)
+
+
+def load_std211_incremental(filename, verbose=False, IP=True, lowmem=False):
+    '''Read Standard 211 information from an Excel file, only reading the sheets that changed since the last time.
+
+    :param filename: name of input Excel file
+    :param verbose: Boolean flag controlling output during loading (defaults to False)
+    :param IP: Boolean determining unit handling, True uses IP units (Defaults to True)
+    :param lowmem: Boolean determining if the changed sheets are loaded one at a time (defaults to False)
+    :return: dictionary object containing data
+
+    A workbook is usually revised and resubmitted a sheet at a time. The CRCs of the
+    parts that each sheet depends on come from the zip central directory, and along
+    with the data read from each sheet they are cached by the path of the file. When
+    the same file is translated again, only the sheets with different CRCs are loaded
+    and read.
+    '''
+    crcs = loadxl.sheet_crcs(filename)
+    statekey = hashlib.sha1(('%s:%s:%s' % (os.path.abspath(filename), reader_version, IP))
+                            .encode('utf-8')).hexdigest()
+    state = cache211.load('sheets', statekey) or {'crcs': {}, 'sections': {}}
+    sections = [key for key, sheetname in std211_sheets.items()
+                if key not in state['sections'] or crcs.get(sheetname) != state['crcs'].get(sheetname)]
+    if sections and lowmem:
+        state['sections'].update(read_std211_by_sheet(filename, verbose=verbose, IP=IP, sections=sections))
+    elif sections:
+        sheetnames = [std211_sheets[key] for key in sections]
+        if verbose:
+            wb = loadxl.load_workbook(filename, sheets=sheetnames)
+        else:
+            warnings.simplefilter("ignore")
+            wb = loadxl.load_workbook(filename, sheets=sheetnames)
+            warnings.simplefilter("default")
+        state['sections'].update(read_std211_xlsx(wb, IP=IP, sections=sections))
+        state['crcs'] = crcs
+        if cache211.store('sheets', statekey, state):
+            cache211.prune('sheets')
+    return {key: state['sections'][key] for key in std211_sheets}
+
+
 def process_zip(pc):
     separators = ['-', ' ']
     for sep in separators:
@@ -1328,81 +1610,261 @@ def determine_frequency(start, end):
     return frequency
 
 
+# Tags are looked up in the registry rather than qualified on every call, unknown names raise a KeyError
+bsync_tags = tags211.tags
+
+
 def qualify(name):
-    return et.QName("http://buildingsync.net/schemas/bedes-auc/2019", name)
+    return bsync_tags[name]
 
 
 def createSubElement(parent, name):
-    return et.SubElement(parent, et.QName("http://buildingsync.net/schemas/bedes-auc/2019", name))
+    return et.SubElement(parent, bsync_tags[name])
 
 
 def createElement(name):
-    return et.Element(et.QName("http://buildingsync.net/schemas/bedes-auc/2019", name))
+    return et.Element(bsync_tags[name])
 
 
-def bsync_lighting_system_lookup(src_type):
+def lamp_type_prototype(lamp, label=None):
     lamp_type = createElement('LampType')
-    if src_type == 'CFL':
-        createSubElement(lamp_type, 'CompactFluorescent')
-    elif src_type == 'Fluorescent T5/High output T5':  # Meh
-        el = createSubElement(lamp_type, 'LinearFluorescent')
-        el = createSubElement(el, 'LampLabel')
-        el.text = 'T5'
-    elif src_type == 'Fluorescent T8/Super T8':  # Meh
-        el = createSubElement(lamp_type, 'LinearFluorescent')
-        el = createSubElement(el, 'LampLabel')
-        el.text = 'T8'
-    elif src_type == 'Fluorescent T12/High output T12':  # Meh
-        el = createSubElement(lamp_type, 'LinearFluorescent')
-        el = createSubElement(el, 'LampLabel')
-        el.text = 'T12'
-    elif src_type == 'High pressure sodium':
-        el = createSubElement(lamp_type, 'HighIntensityDischarge')
-        el = createSubElement(el, 'LampLabel')
-        el.text = 'Sodium Vapor High Pressure'
-    elif src_type == 'Incandescent/Halogen':
-        createSubElement(lamp_type, 'Halogen')  # Meh
-    elif src_type == 'Induction':
-        createSubElement(lamp_type, 'Induction')
-    elif src_type == 'LED':
-        el = createSubElement(lamp_type, 'SolidStateLighting')
-        el = createSubElement(el, 'LampLabel')
-        el.text = 'LED'
-    elif src_type == 'Mercury vapor':
-        el = createSubElement(lamp_type, 'HighIntensityDischarge')
-        el = createSubElement(el, 'LampLabel')
-        el.text = 'Mercury Vapor'
-    elif src_type == 'Metal halide':
-        el = createSubElement(lamp_type, 'HighIntensityDischarge')
-        el = createSubElement(el, 'LampLabel')
-        el.text = 'Metal Halide'
-    else:  # src_type == 'Other':
-        createSubElement(lamp_type, 'Unknown')
+    el = createSubElement(lamp_type, lamp)
+    if label is not None:
+        createSubElement(el, 'LampLabel').text = label
     return lamp_type
 
 
-def bsync_lighting_control_lookup(control_type):
-    control = None
-    if control_type == 'Manual':
-        control = createElement('LightingControlTypeManual')
-        control.text = 'Unknown'
-    elif control_type == 'Occupancy sensor':
-        control = createElement('LightingControlTypeOccupancy')
-        control.text = 'Unknown'
-    elif control_type == 'Photocell':
-        control = createElement('LightingControlTypeDaylighting')  # Meh
-        control.text = 'Unknown'
-    elif control_type == 'Timer':
-        control = createElement('LightingControlTypeTimer')
-        control.text = 'Unknown'
-    # elif control_type == 'BAS':
-    # elif control_type == 'Advanced':
-    # elif control_type == 'Other':
+def lighting_control_prototype(tag):
+    control = createElement(tag)
+    control.text = 'Unknown'
     return control
 
 
+# Prototype LampType elements for the lighting source types, copied for each lighting system
+lamp_type_prototypes = {'CFL': lamp_type_prototype('CompactFluorescent'),
+                        'Fluorescent T5/High output T5': lamp_type_prototype('LinearFluorescent', 'T5'),  # Meh
+                        'Fluorescent T8/Super T8': lamp_type_prototype('LinearFluorescent', 'T8'),  # Meh
+                        'Fluorescent T12/High output T12': lamp_type_prototype('LinearFluorescent', 'T12'),  # Meh
+                        'High pressure sodium': lamp_type_prototype('HighIntensityDischarge',
+                                                                    'Sodium Vapor High Pressure'),
+                        'Incandescent/Halogen': lamp_type_prototype('Halogen'),  # Meh
+                        'Induction': lamp_type_prototype('Induction'),
+                        'LED': lamp_type_prototype('SolidStateLighting', 'LED'),
+                        'Mercury vapor': lamp_type_prototype('HighIntensityDischarge', 'Mercury Vapor'),
+                        'Metal halide': lamp_type_prototype('HighIntensityDischarge', 'Metal Halide')}
+# Anything else, including 'Other'
+unknown_lamp_type_prototype = lamp_type_prototype('Unknown')
+
+# Prototype lighting control elements, 'BAS', 'Advanced' and 'Other' have nowhere to go
+lighting_control_prototypes = {'Manual': lighting_control_prototype('LightingControlTypeManual'),
+                               'Occupancy sensor': lighting_control_prototype('LightingControlTypeOccupancy'),
+                               'Photocell': lighting_control_prototype('LightingControlTypeDaylighting'),  # Meh
+                               'Timer': lighting_control_prototype('LightingControlTypeTimer')}
+
+
+def bsync_lighting_system_lookup(src_type):
+    return copy.deepcopy(lamp_type_prototypes.get(src_type, unknown_lamp_type_prototype))
+
+
+def bsync_lighting_control_lookup(control_type):
+    control = lighting_control_prototypes.get(control_type)
+    if control is None:
+        return None
+    return copy.deepcopy(control)
+
+
+# The XML declarations that start the plain and pretty-printed output
+xml_declaration = b'<?xml version="1.0" encoding="UTF-8"?>'
+pretty_xml_declaration = b'<?xml version="1.0" encoding="utf-8"?>\n'
+
+
 def prettystring(element):
-    return minidom.parseString(et.tostring(element, encoding='utf-8')).toprettyxml(indent='  ', encoding='utf-8')
+    # lxml indents with two spaces, the same layout minidom's toprettyxml gave without a second parse
+    return pretty_xml_declaration + et.tostring(element, encoding='utf-8', pretty_print=True)
+
+
+# Compression used for output file names with these extensions
+compression_extensions = {'.gz': 'gzip',
+                          '.bz2': 'bz2',
+                          '.xz': 'xz',
+                          '.zst': 'zstd'}
+
+
+def output_compression(filename):
+    """Determine the compression for an output file from its extension (None if there isn't any)"""
+    return compression_extensions.get(os.path.splitext(filename)[1].lower())
+
+
+@contextlib.contextmanager
+def open_output(filename, compression=None, atomic=False):
+    """Open a binary output file that compresses what is written to it
+
+    :param filename: name of the file
+    :param compression: 'gzip', 'bz2', 'xz' or 'zstd' (defaults to None, determined by the extension)
+    :param atomic: Boolean determining if the output is written to a temporary file next to filename and
+                   renamed when it is complete (defaults to False)
+    :return: context manager for the binary file object
+
+    The data is compressed as it is written. The gzip header has no timestamp, so the same output
+    compresses to the same file. zstd needs the zstandard package. With atomic, nothing ever sees half an
+    output file, and if writing fails the file that was there before is left alone.
+    """
+    if compression is None:
+        compression = output_compression(filename)
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression needs the zstandard package')
+    if compression not in (None, 'gzip', 'bz2', 'xz', 'zstd'):
+        raise ValueError('Unknown compression "%s"' % compression)
+    path = '%s.%d.tmp' % (filename, os.getpid()) if atomic else filename
+    try:
+        with open(path, 'wb') as fp:
+            if compression is None:
+                yield fp
+            elif compression == 'gzip':
+                with gzip.GzipFile(filename, mode='wb', fileobj=fp, mtime=0) as compressed:
+                    yield compressed
+            elif compression == 'bz2':
+                with bz2.BZ2File(fp, 'wb') as compressed:
+                    yield compressed
+            elif compression == 'xz':
+                with lzma.LZMAFile(fp, 'wb') as compressed:
+                    yield compressed
+            else:
+                with zstandard.ZstdCompressor().stream_writer(fp) as compressed:
+                    yield compressed
+    except BaseException:
+        if atomic and os.path.exists(path):
+            os.remove(path)
+        raise
+    if atomic:
+        os.replace(path, filename)
+
+
+@contextlib.contextmanager
+def open_input(filename, compression=None):
+    """Open a binary input file, decompressing it as it is read
+
+    :param filename: name of the file
+    :param compression: 'gzip', 'bz2', 'xz' or 'zstd' (defaults to None, determined by the extension)
+    :return: context manager for the binary file object
+    """
+    if compression is None:
+        compression = output_compression(filename)
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression needs the zstandard package')
+    if compression not in (None, 'gzip', 'bz2', 'xz', 'zstd'):
+        raise ValueError('Unknown compression "%s"' % compression)
+    with open(filename, 'rb') as fp:
+        if compression is None:
+            yield fp
+        elif compression == 'gzip':
+            with gzip.GzipFile(fileobj=fp, mode='rb') as compressed:
+                yield compressed
+        elif compression == 'bz2':
+            with bz2.BZ2File(fp, 'rb') as compressed:
+                yield compressed
+        elif compression == 'xz':
+            with lzma.LZMAFile(fp, 'rb') as compressed:
+                yield compressed
+        else:
+            with zstandard.ZstdDecompressor().stream_reader(fp) as compressed:
+                yield compressed
+
+
+def read_buildingsync(filename, groupspaces=False, cache=True):
+    """Get a BuildingSync document from a file
+
+    :param filename: name of a BuildingSync XML file (compressed or not, see open_input) or of an Excel file
+    :param groupspaces: Boolean determining if spaces should be combined by HVAC type (defaults to False)
+    :param cache: Boolean determining if the cache of workbook data is used (defaults to True)
+    :return: root element of the document
+
+    An Excel file is translated, using the cached workbook data if it is there.
+    """
+    if os.path.splitext(filename)[1].lower() in ('.xlsx', '.xlsm'):
+        return map_to_buildingsync(load_std211(filename, cache=cache), groupspaces=groupspaces)
+    with open_input(filename) as fp:
+        return et.parse(fp, et.XMLParser(remove_blank_text=True)).getroot()
+
+
+def write_buildingsync_diff(previous, element, fileobj, pretty=False):
+    """Write just the differences from a previous translation.
+
+    :param previous: root element of the previous BuildingSync document (see read_buildingsync)
+    :param element: BuildingSync XML object, as returned by map_to_buildingsync
+    :param fileobj: binary file object (or file name) to write the differences to
+    :param pretty: Boolean determining if the output is pretty-printed (defaults to False)
+    :return: list of diff211.Change tuples
+
+    The differences are written as a BuildingSyncDiff document (see diff211.diff_document), so the size
+    of the output goes with the size of the change and not of the document.
+    """
+    changes = diff211.diff_elements(previous, element)
+    root = element.getroottree().getroot()
+    write_buildingsync(diff211.diff_document(changes, nsmap=root.nsmap), fileobj, pretty=pretty)
+    return changes
+
+
+def write_buildingsync(element, fileobj, pretty=False):
+    """Write BuildingSync XML to a binary file.
+
+    :param element: BuildingSync XML object, as returned by map_to_buildingsync
+    :param fileobj: binary file object (or file name) to write the XML to
+    :param pretty: Boolean determining if the output is pretty-printed (defaults to False)
+
+    The declaration and the UTF-8 encoded document are written straight to the file, there's
+    no intermediate string. A file name with a compressed extension (see open_output) is compressed.
+    """
+    if isinstance(fileobj, str):
+        with open_output(fileobj) as fp:
+            return write_buildingsync(element, fp, pretty=pretty)
+    if pretty:
+        fileobj.write(pretty_xml_declaration)
+    else:
+        fileobj.write(xml_declaration)
+    element.getroottree().write(fileobj, encoding='utf-8', xml_declaration=False, pretty_print=pretty)
+
+
+class HashingWriter:
+    """Binary file object that hashes everything written through it
+
+    :param fileobj: binary file object to pass the data on to (optional)
+    :param algorithm: name of the hashlib algorithm (defaults to 'sha256')
+    """
+    __slots__ = ['fileobj', 'hash']
+
+    def __init__(self, fileobj=None, algorithm='sha256'):
+        self.fileobj = fileobj
+        self.hash = hashlib.new(algorithm)
+
+    def write(self, data):
+        self.hash.update(data)
+        if self.fileobj is not None:
+            self.fileobj.write(data)
+        return len(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def write_buildingsync_canonical(element, fileobj=None):
+    """Write BuildingSync XML in canonical form and hash it as it is written.
+
+    :param element: BuildingSync XML object, as returned by map_to_buildingsync
+    :param fileobj: binary file object (or file name) to write the XML to (optional, just hash it if None)
+    :return: hex SHA-256 digest of the canonical XML
+
+    The output is Canonical XML 1.0 (no declaration, attributes sorted, namespace declarations only
+    where they are first used, empty elements written as start and end tags), so the same document is
+    always the same bytes and the digest can be used to spot duplicates or as a cache key. The hash is
+    taken from the chunks on their way to the file, not from a second read.
+    """
+    if isinstance(fileobj, str):
+        with open_output(fileobj) as fp:
+            return write_buildingsync_canonical(element, fp)
+    sink = HashingWriter(fileobj)
+    element.getroottree().write_c14n(sink, with_comments=False)
+    return sink.hexdigest()
 
 
 def easymap(dictionary, inkey, outkey, parent, f=lambda x: x):
@@ -1421,7 +1883,7 @@ def easyremap(dictionary, inkey, outkey, parent, remap, f=lambda x: x):
 
 def addel(outkey, parent, value):
     el = createSubElement(parent, outkey)
-    el.text = str(value)
+    el.text = format_value(value)
 
 
 def addudf(parent, key, value, create=True):
@@ -1437,23 +1899,71 @@ def addudf(parent, key, value, create=True):
     el.text = value
 
 
-def appendudf(udfs, key, dictionary, prefix=None):
-    if key in dictionary:
-        udf = createSubElement(udfs, 'UserDefinedField')
-        el = createSubElement(udf, 'FieldName')
-        store_key = key
-        if prefix:
-            store_key = prefix + key
-        el.text = store_key
-        el = createSubElement(udf, 'FieldValue')
-        el.text = str(dictionary[key])
-
-
 def easymapudf(dictionary, inkey, outkey, parent, f=lambda x: x):
     if inkey in dictionary and dictionary[inkey]:
         addudf(parent, outkey, f(dictionary[inkey]))
 
 
+class UDFAccumulator:
+    """Collect the user defined fields for one element and write them all at once
+
+    UserDefinedFields is the last child of every element that has one, so the mappers add the fields as they
+    go and then emit the block when everything else is in place. That saves looking for the block on every
+    field, and the block always ends up where the schema wants it.
+    """
+    __slots__ = ['fields']
+
+    def __init__(self):
+        self.fields = []
+
+    def __len__(self):
+        return len(self.fields)
+
+    def add(self, name, value):
+        self.fields.append((name, value))
+
+    def map(self, dictionary, inkey, name, f=None):
+        # Same as easymapudf, missing keys and empty values are skipped
+        value = dictionary.get(inkey)
+        if value:
+            self.fields.append((name, value if f is None else f(value)))
+
+    def element(self):
+        """Build the UserDefinedFields element, or None if there are no fields"""
+        if not self.fields:
+            return None
+        udfs = createElement('UserDefinedFields')
+        for name, value in self.fields:
+            udf = createSubElement(udfs, 'UserDefinedField')
+            createSubElement(udf, 'FieldName').text = name
+            createSubElement(udf, 'FieldValue').text = value
+        return udfs
+
+    def emit(self, parent):
+        """Append the UserDefinedFields element (if any) to parent"""
+        if self.fields:
+            parent.append(self.element())
+
+
+def format_value(value):
+    """Format a workbook value as text, the same way every time
+
+    Datetimes are rounded to the nearest second, since Excel serial dates come back a fraction of a second
+    either side of the time in the cell. Floats get the shortest text that reads back as the same number,
+    with negative zero written as zero. Anything else is just str.
+    """
+    if isinstance(value, datetime.datetime):
+        value = (value + datetime.timedelta(microseconds=500000)).replace(microsecond=0)
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, float) and value == 0:
+        return '0.0'
+    return str(value)
+
+
+def isformula(value, prefix='='):
+    return isinstance(value, str) and value.startswith(prefix)
+
+
 def yn2tf(s):
     return {'Y': 'true', 'N': 'false'}[s]
 
@@ -1462,169 +1972,388 @@ def repercentage(s):
     return str(s * 100) + '%'
 
 
+# BuildingSync condition and capacity units enumerations, keyed by the lower case Standard 211 text
+bsync_conditions = {'excellent': 'Excellent',
+                   'good': 'Good',
+                   'average': 'Average',
+                   'poor': 'Poor'}
+
+bsync_capacity_units = {"cfh": "cfh",
+                       "ft3/min": "ft3/min",
+                       "cfm": "ft3/min",
+                       "kcf/h": "kcf/h",
+                       "mcf/day": "MCF/day",
+                       "gpm": "gpm",
+                       "w": "W",
+                       "kw": "kW",
+                       "hp": "hp",
+                       "mw": "MW",
+                       "btu/hr": "Btu/hr",
+                       "cal/h": "cal/h",
+                       "ft-lbf/h": "ft-lbf/h",
+                       "ft-lbf/min": "ft-lbf/min",
+                       "btu/s": "Btu/s",
+                       "kbtu/hr": "kBtu/hr",
+                       "mmbtu/hr": "MMBtu/hr",
+                       "therms/h": "therms/h",
+                       "lbs/h": "lbs/h",
+                       "klbs/h": "Klbs/h",
+                       "mlbs/h": "Mlbs/h",
+                       "cooling ton": "Cooling ton",
+                       "cooling tons": "Cooling ton",
+                       "tons": "Cooling ton",
+                       "ton": "Cooling ton"}
+
+
 def bsync_condition_lookup(condition):
-    return {'excellent': 'Excellent',
-            'good': 'Good',
-            'average': 'Average',
-            'poor': 'Poor'}.get(condition.lower(), 'Other')
+    return bsync_conditions.get(condition.lower(), 'Other')
 
 
 def bsync_capacity_units_lookup(units):
-    return {"cfh": "cfh",
-            "ft3/min": "ft3/min",
-            "cfm": "ft3/min",
-            "kcf/h": "kcf/h",
-            "mcf/day": "MCF/day",
-            "gpm": "gpm",
-            "w": "W",
-            "kw": "kW",
-            "hp": "hp",
-            "mw": "MW",
-            "btu/hr": "Btu/hr",
-            "cal/h": "cal/h",
-            "ft-lbf/h": "ft-lbf/h",
-            "ft-lbf/min": "ft-lbf/min",
-            "btu/s": "Btu/s",
-            "kbtu/hr": "kBtu/hr",
-            "mmbtu/hr": "MMBtu/hr",
-            "therms/h": "therms/h",
-            "lbs/h": "lbs/h",
-            "klbs/h": "Klbs/h",
-            "mlbs/h": "Mlbs/h",
-            "cooling ton": "Cooling ton",
-            "cooling tons": "Cooling ton",
-            "tons": "Cooling ton",
-            "ton": "Cooling ton"}.get(units.lower(), 'Other')
-
-
-def map_equipment_inventory(inventory):
+    return bsync_capacity_units.get(units.lower(), 'Other')
+
+
+class IDRegistry:
+    """Record the IDs and IDrefs given out while mapping, so they can be checked in one pass at the end
+
+    The mappers set ID and IDref attributes through allocate and refer rather than directly. Nothing is
+    looked up in the tree, the registry keeps the IDs and the referenced IDs in dictionaries.
+    """
+
+    def __init__(self):
+        # ID -> tag of the element that has it
+        self.ids = {}
+        # (ID, tag) of the elements that reuse an ID
+        self.duplicates = []
+        # IDref -> tag of the first element that refers to it
+        self.refs = {}
+
+    def allocate(self, element, value):
+        """Give element the ID value"""
+        element.attrib['ID'] = value
+        if value in self.ids:
+            self.duplicates.append((value, element.tag))
+        else:
+            self.ids[value] = element.tag
+        return value
+
+    def refer(self, element, value, text=False):
+        """Make element refer to the ID value, in the IDref attribute or (if text is True) the text"""
+        if text:
+            element.text = value
+        else:
+            element.attrib['IDref'] = value
+        if value not in self.refs:
+            self.refs[value] = element.tag
+
+    def update(self, other):
+        """Add the IDs and IDrefs recorded by another registry"""
+        for value, tag in other.ids.items():
+            if value in self.ids:
+                self.duplicates.append((value, tag))
+            else:
+                self.ids[value] = tag
+        self.duplicates.extend(other.duplicates)
+        for value, tag in other.refs.items():
+            if value not in self.refs:
+                self.refs[value] = tag
+
+    def problems(self):
+        """List the duplicate, invalid and dangling IDs
+
+        :return: list of descriptions of the problems, empty if there are none
+        """
+        problems = []
+        for value, tag in self.duplicates:
+            problems.append('ID "%s" of %s is already used by %s' % (value, et.QName(tag).localname,
+                                                                     et.QName(self.ids[value]).localname))
+        for value, tag in self.ids.items():
+            if not tags211.ncname.fullmatch(value):
+                problems.append('ID "%s" of %s is not a valid XML ID' % (value, et.QName(tag).localname))
+        for value, tag in self.refs.items():
+            if value not in self.ids:
+                problems.append('IDref "%s" of %s does not match any ID' % (value, et.QName(tag).localname))
+        return problems
+
+
+def check_ids(ids, strict=False):
+    """Check the IDs and IDrefs recorded while mapping
+
+    :param ids: IDRegistry to check
+    :param strict: Boolean determining if problems raise InvalidIDs rather than warn (defaults to False)
+    :return: list of descriptions of the problems
+    """
+    problems = ids.problems()
+    if problems:
+        if strict:
+            raise InvalidIDs('; '.join(problems))
+        for problem in problems:
+            warnings.warn(problem, IDWarning)
+    return problems
+
+
+# A mapping rule says where the value for a key in the Standard 211 data goes: the slot (parent element) it goes
+# in, the BuildingSync element or UDF it becomes, and the function that converts it to text (None for as is).
+# UDFs have no slot, they go to the accumulator that is passed to apply_rules.
+MappingRule = collections.namedtuple('MappingRule', ['slot', 'inkey', 'outkey', 'udf', 'convert'])
+
+
+def maprule(inkey, outkey, convert=None, slot=0):
+    return MappingRule(slot, inkey, outkey, False, convert)
+
+
+def udfrule(inkey, outkey, convert=None):
+    return MappingRule(None, inkey, outkey, True, convert)
+
+
+def compile_rules(rules):
+    """Compile a list of mapping rules into a plan for apply_rules
+
+    :param rules: list of MappingRule tuples
+    :return: tuple of (slot, inkey, tag or UDF name, udf, convert) tuples
+
+    Element names are looked up in the tag registry here, so a misspelled name fails at import.
+    """
+    plan = []
+    for rule in rules:
+        outkey = rule.outkey
+        if not rule.udf:
+            outkey = qualify(outkey)
+        plan.append((rule.slot, rule.inkey, outkey, rule.udf, rule.convert))
+    return tuple(plan)
+
+
+def apply_rules(plan, dictionary, udfs, *slots):
+    """Map the values in a dictionary with a compiled plan
+
+    :param plan: compiled mapping rules
+    :param dictionary: the Standard 211 data to map
+    :param udfs: UDFAccumulator that collects the UDF rules
+    :param slots: the parent elements that the rules refer to by position
+
+    As with easymap and easymapudf, keys that are missing or have empty values are skipped.
+    """
+    for slot, inkey, outkey, udf, convert in plan:
+        value = dictionary.get(inkey)
+        if not value:
+            continue
+        if convert is not None:
+            value = convert(value)
+        if udf:
+            udfs.add(outkey, value)
+        else:
+            et.SubElement(slots[slot], outkey).text = value
+
+
+def inventory_udf_rules(items):
+    return [udfrule(item, 'ASHRAE Std 211 %s' % item, str) for item in items]
+
+
+# How each type of equipment in 'L2 Equipment Inventory' is mapped: the system element, the path of elements
+# below it, and the rules. Slot 0 is the system and the others follow the path.
+inventory_mappings = {
+    'Heating Plant Type': ('HVACSystem', ('Plants', 'HeatingPlant'), compile_rules(
+        [maprule('Condition       (excellent, good, average, poor)', 'HeatingPlantCondition',
+                 bsync_condition_lookup, slot=2)] +
+        inventory_udf_rules(['Description', 'Location', 'Units', 'Rated efficiency (as applicable)',
+                             'Output Capacity', 'Area Served', 'Approx Year Installed']))),
+    'Cooling Plant Type': ('HVACSystem', ('Plants', 'CoolingPlant'), compile_rules(
+        [maprule('Condition       (excellent, good, average, poor)', 'CoolingPlantCondition',
+                 bsync_condition_lookup, slot=2)] +
+        inventory_udf_rules(['Description', 'Location', 'Units', 'Rated efficiency (as applicable)',
+                             'Output Capacity', 'Area Served', 'Approx Year Installed']))),
+    'Boiler Type': ('HVACSystem', ('Plants', 'HeatingPlant', 'Boiler'), compile_rules(
+        [maprule('Output Capacity', 'OutputCapacity', str, slot=3),
+         maprule('Units', 'CapacityUnits', bsync_capacity_units_lookup, slot=3),
+         maprule('Rated efficiency (as applicable)', 'ThermalEfficiency', str, slot=3),
+         maprule('Condition       (excellent, good, average, poor)', 'HeatingPlantCondition',
+                 bsync_condition_lookup, slot=2)] +
+        inventory_udf_rules(['Description', 'Location', 'Area Served', 'Approx Year Installed']))),
+    'Delivery Type': ('HVACSystem', ('HeatingAndCoolingSystems', 'Delivery'), compile_rules(
+        [maprule('Output Capacity', 'Capacity', str, slot=2),
+         maprule('Units', 'CapacityUnits', bsync_capacity_units_lookup, slot=2),
+         maprule('Approx Year Installed', 'YearInstalled', str, slot=2),
+         udfrule('Type', 'ASHRAE Std 211 Type', lambda x: x.replace(' Type', ''))] +
+        inventory_udf_rules(['Description', 'Location', 'Rated efficiency (as applicable)',
+                             'Area Served', 'Condition       (excellent, good, average, poor)']))),
+    'Heat Recovery Type': ('HeatRecoverySystem', (), compile_rules(
+        [maprule('Rated efficiency (as applicable)', 'HeatRecoveryEfficiency', str),
+         maprule('Approx Year Installed', 'YearInstalled', str)] +
+        inventory_udf_rules(['Description', 'Location', 'Units', 'Output Capacity', 'Area Served',
+                             'Condition       (excellent, good, average, poor)']))),
+    'DX System Type': ('HVACSystem', ('HeatingAndCoolingSystems', 'CoolingSource', 'CoolingSourceType', 'DX'),
+                       compile_rules(
+        [maprule('Output Capacity', 'Capacity', str, slot=2),
+         maprule('Units', 'CapacityUnits', bsync_capacity_units_lookup, slot=2),
+         maprule('Approx Year Installed', 'YearInstalled', str, slot=2)] +
+        inventory_udf_rules(['Description', 'Location', 'Rated efficiency (as applicable)',
+                             'Area Served', 'Condition       (excellent, good, average, poor)'])))}
+inventory_mappings['Cooling Delivery Type'] = inventory_mappings['Delivery Type']
+inventory_mappings['Heating Delivery Type'] = inventory_mappings['Delivery Type']
+del inventory_mappings['Delivery Type']
+
+
+def map_equipment_inventory(inventory, ids=None):
+    if ids is None:
+        ids = IDRegistry()
     hvacsystems = []
     heatrecoverysystems = []
 
-    items = ['Description', 'Location', 'Type', 'Units', 'Rated efficiency (as applicable)',
-             'Output Capacity', 'Area Served', 'Approx Year Installed',
-             'Condition       (excellent, good, average, poor)']
-
     for name, data in inventory.items():
         if 'Type' not in data:
             # Could try something else here, but skip for now
             continue
-        if data['Type'] == 'Heating Plant Type':
-            system = createElement('HVACSystem')
-            system.attrib['ID'] = name
-            el = createSubElement(system, 'Plants')
-            el = createSubElement(el, 'HeatingPlant')
-            easymap(data, 'Condition       (excellent, good, average, poor)', 'HeatingPlantCondition', el,
-                    bsync_condition_lookup)
-            items = ['Description', 'Location', 'Units', 'Rated efficiency (as applicable)',
-                     'Output Capacity', 'Area Served', 'Approx Year Installed']
-            for item in items:
-                easymapudf(data, item, 'ASHRAE Std 211 %s' % item, system, str)
-            hvacsystems.append(system)
-        elif data['Type'] == 'Cooling Plant Type':
-            system = createElement('HVACSystem')
-            system.attrib['ID'] = name
-            el = createSubElement(system, 'Plants')
-            el = createSubElement(el, 'CoolingPlant')
-            easymap(data, 'Condition       (excellent, good, average, poor)', 'CoolingPlantCondition', el,
-                    bsync_condition_lookup)
-            items = ['Description', 'Location', 'Units', 'Rated efficiency (as applicable)',
-                     'Output Capacity', 'Area Served', 'Approx Year Installed']
-            for item in items:
-                easymapudf(data, item, 'ASHRAE Std 211 %s' % item, system, str)
-            hvacsystems.append(system)
-        elif data['Type'] == 'Boiler Type':
-            system = createElement('HVACSystem')
-            system.attrib['ID'] = name
-            el = createSubElement(system, 'Plants')
-            hp = createSubElement(el, 'HeatingPlant')
-            el = createSubElement(hp, 'Boiler')
-
-            easymap(data, 'Output Capacity', 'OutputCapacity', el, str)
-            easymap(data, 'Units', 'CapacityUnits', el, bsync_capacity_units_lookup)
-            easymap(data, 'Rated efficiency (as applicable)', 'ThermalEfficiency', el, str)
-
-            easymap(data, 'Condition       (excellent, good, average, poor)', 'HeatingPlantCondition', hp,
-                    bsync_condition_lookup)
-            items = ['Description', 'Location', 'Area Served', 'Approx Year Installed']
-            for item in items:
-                easymapudf(data, item, 'ASHRAE Std 211 %s' % item, system, str)
-            hvacsystems.append(system)
-        elif data['Type'] in ['Cooling Delivery Type', 'Heating Delivery Type']:
-            typestring = data['Type'].replace(' Type', '')
-            system = createElement('HVACSystem')
-            system.attrib['ID'] = name
-            el = createSubElement(system, 'HeatingAndCoolingSystems')
-            el = createSubElement(el, 'Delivery')
-
-            easymap(data, 'Output Capacity', 'Capacity', el, str)
-            easymap(data, 'Units', 'CapacityUnits', el, bsync_capacity_units_lookup)
-            easymap(data, 'Approx Year Installed', 'YearInstalled', el, str)
-
-            addudf(system, 'ASHRAE Std 211 Type', typestring)
-
-            items = ['Description', 'Location', 'Rated efficiency (as applicable)',
-                     'Area Served', 'Condition       (excellent, good, average, poor)']
-            for item in items:
-                easymapudf(data, item, 'ASHRAE Std 211 %s' % item, system, str)
-            hvacsystems.append(system)
-        elif data['Type'] == 'Heat Recovery Type':
-            system = createElement('HeatRecoverySystem')
-            system.attrib['ID'] = name
-
-            easymap(data, 'Rated efficiency (as applicable)', 'HeatRecoveryEfficiency', el, str)
-            easymap(data, 'Approx Year Installed', 'YearInstalled', el, str)
-
-            items = ['Description', 'Location', 'Units', 'Output Capacity', 'Area Served',
-                     'Condition       (excellent, good, average, poor)']
-            for item in items:
-                easymapudf(data, item, 'ASHRAE Std 211 %s' % item, system, str)
+        # Anything else is treated as a DX system
+        systemtag, path, plan = inventory_mappings.get(data['Type'], inventory_mappings['DX System Type'])
+        system = createElement(systemtag)
+        ids.allocate(system, name)
+        slots = [system]
+        for tag in path:
+            slots.append(createSubElement(slots[-1], tag))
+        udfs = UDFAccumulator()
+        apply_rules(plan, data, udfs, *slots)
+        udfs.emit(system)
+        if systemtag == 'HeatRecoverySystem':
             heatrecoverysystems.append(system)
-        else:  # elif data['Type'] == 'DX System Type':
-            system = createElement('HVACSystem')
-            system.attrib['ID'] = name
-            el = createSubElement(system, 'HeatingAndCoolingSystems')
-            cs = createSubElement(el, 'CoolingSource')
-            el = createSubElement(cs, 'CoolingSourceType')
-            createSubElement(el, 'DX')
-
-            easymap(data, 'Output Capacity', 'Capacity', cs, str)
-            easymap(data, 'Units', 'CapacityUnits', cs, bsync_capacity_units_lookup)
-            easymap(data, 'Approx Year Installed', 'YearInstalled', cs, str)
-
-            items = ['Description', 'Location', 'Rated efficiency (as applicable)',
-                     'Area Served', 'Condition       (excellent, good, average, poor)']
-            for item in items:
-                easymapudf(data, item, 'ASHRAE Std 211 %s' % item, system, str)
+        else:
             hvacsystems.append(system)
     return {'HVACSystem': hvacsystems, 'HeatRecoverySystem': heatrecoverysystems}
 
 
-def map_to_buildingsync(obj, groupspaces=False):
-    """Map a dictionary of Standard 211 data into the BuildingSync XML object.
+def format_timestamps(dates, formatted=None):
+    """Format dates as BuildingSync timestamps
 
-    :param obj: dictionary of Standard 211 data
-    :param groupspaces: Boolean determining if spaces should be combined by HVAC type (defaults to False)
-    :return: BuildingSync XML object (lxml.etree.ElemenTree)
+    :param dates: iterable of dates
+    :param formatted: dictionary of dates already formatted, added to and returned (optional)
+    :return: dictionary of timestamp strings keyed by date
 
-    Map a dictionary of Standard 211 data, as extracted using the read_std211_xlsx
-    function, into an XML object.
+    Each distinct date is formatted once, and bills mostly start on the date that the one before ended.
     """
-    #
-    allbuilding = obj['All - Building']
-    spacefunctions = obj['All - Space Functions']
-    metered_energy = obj['All - Metered Energy']
-    delivered_energy = obj['All - Delivered Energy']
-    summary = obj['L1 - EEM Summary']
-    envelope = obj['L2 - Envelope']
-    hvac = obj['L2 - HVAC']
-    summary_L2 = obj['L2 - EEM Summary']
-    lighting_plug_loads = obj['L2 - Lighting Elec & Plug Loads']
-    inventory = obj['L2 - Equipment Inventory']
-    #
-    # All - Building
-    #
-    # Give the address
+    if formatted is None:
+        formatted = {}
+    for date in dates:
+        if date not in formatted:
+            formatted[date] = date.strftime('%Y-%m-%dT00:00:00')
+    return formatted
+
+
+def timeseries_prototype(reading_type, quantity, refname, ids, interval=True):
+    """Make a TimeSeries element with the fields that are the same for every reading in a table filled in
+
+    :param reading_type: ReadingType text
+    :param quantity: TimeSeriesReadingQuantity text
+    :param refname: ID of the ResourceUse the readings are for
+    :param ids: IDRegistry to record the IDref in
+    :param interval: if True, include EndTimeStamp and IntervalFrequency
+    :return: TimeSeries element with empty timestamps, frequency and reading
+    """
+    ts = createElement('TimeSeries')
+    createSubElement(ts, 'ReadingType').text = reading_type
+    createSubElement(ts, 'TimeSeriesReadingQuantity').text = quantity
+    createSubElement(ts, 'StartTimeStamp')
+    if interval:
+        createSubElement(ts, 'EndTimeStamp')
+        createSubElement(ts, 'IntervalFrequency')
+    createSubElement(ts, 'IntervalReading')
+    ids.refer(createSubElement(ts, 'ResourceUseID'), refname)
+    return ts
+
+
+def map_timeseries(metered_energy, delivered_energy, ids=None):
+    """Generate the TimeSeries elements for the metered and delivered energy data.
+
+    :param metered_energy: dictionary of 'All - Metered Energy' data
+    :param delivered_energy: dictionary of 'All - Delivered Energy' data
+    :param ids: IDRegistry to record the IDrefs in (optional)
+    :return: generator of TimeSeries elements, one per bill per quantity
+
+    The elements are copied from a prototype for each table and quantity, so only the timestamps, frequency
+    and reading are filled in per bill.
+    """
+    keys = {'Utility #1': {'Use': 'Energy', 'Cost': 'Currency', 'Peak': 'Energy'},
+            'Utility #2': {'Use': 'Energy', 'Cost': 'Currency'},
+            'Utility #3': {'Use': 'Energy', 'Cost': 'Currency'}}
+
+    reading_type = {'Use': 'Total',
+                    'Cost': 'Total',
+                    'Peak': 'Peak'}
+
+    if ids is None:
+        ids = IDRegistry()
+
+    for name in ['Utility #1', 'Utility #2', 'Utility #3']:
+        if name in metered_energy:
+            refname = 'Std211ResourceUse' + name.replace(' #', '')
+            if 'Data' in metered_energy[name]:
+                data = metered_energy[name]['Data']
+                timestamps = format_timestamps(pt['Start Date'] for pt in data)
+                format_timestamps((pt['End Date'] for pt in data), timestamps)
+                prototypes = [(inkey, timeseries_prototype(reading_type[inkey], outkey, refname, ids))
+                              for inkey, outkey in keys[name].items()]
+                for pt in data:
+                    start = pt['Start Date']
+                    end = pt['End Date']
+                    # Compute the frequency, we don't handle 'Unknown'
+                    frequency = determine_frequency(start, end)
+                    for inkey, prototype in prototypes:
+                        ts = copy.deepcopy(prototype)
+                        el_start, el_end, el_frequency, el_reading = ts[2:6]
+                        el_start.text = timestamps[start]
+                        el_end.text = timestamps[end]
+                        el_frequency.text = frequency
+                        el_reading.text = str(pt[inkey])
+                        yield ts
+
+    if delivered_energy:
+        refname = 'Std211ResourceUseDelivered1'
+        if 'Data' in delivered_energy:
+            data = delivered_energy['Data']
+            timestamps = format_timestamps(pt['Delivery date'] for pt in data)
+            prototypes = [(inkey, timeseries_prototype('Total', outkey, refname, ids, interval=False))
+                          for inkey, outkey in {'Volume': 'Other', 'Cost': 'Currency'}.items()]
+            for pt in data:
+                start = timestamps[pt['Delivery date']]
+                for inkey, prototype in prototypes:
+                    ts = copy.deepcopy(prototype)
+                    el_start, el_reading = ts[2:4]
+                    el_start.text = start
+                    el_reading.text = str(pt[inkey])
+                    yield ts
+
+
+def resolve_energy_definitions(metered_energy, delivered_energy, tables):
+    """Fill in the default units and conversions for metered and delivered energy.
+
+    :param metered_energy: dictionary of 'All - Metered Energy' data
+    :param delivered_energy: dictionary of 'All - Delivered Energy' data
+    :param tables: dictionary of lookup tables
+    :return: metered and delivered energy dictionaries with the defaults filled in
+
+    The inputs are not modified, the definitions that need defaults are copied.
+    """
+    metered_energy = dict(metered_energy)
+    for name in ['Utility #1', 'Utility #2', 'Utility #3']:
+        if name in metered_energy:
+            utility = metered_energy[name] = dict(metered_energy[name])
+            definition = utility['Definition'] = dict(utility['Definition'])
+            # The formulas only show up if Excel never cached a value for them
+            if isformula(definition['Units'], "=INDEX('Drop Down Lists'!"):
+                # Use default
+                definition['Units'] = tables['Metered Energy Default Units'][utility['Type']]
+            if isformula(definition['kBtu/unit'], '=IFERROR(INDEX(EnergyConversionRates,MATCH'):
+                # Use default
+                definition['kBtu/unit'] = str(tables['Conversion to kBtu'][definition['Units']])
+    if delivered_energy:
+        delivered_energy = dict(delivered_energy)
+        definition = delivered_energy['Definition'] = dict(delivered_energy['Definition'])
+        if isformula(definition['Conversion to kBTU'], "=IFERROR(INDEX("):
+            # Use default
+            definition['Conversion to kBTU'] = str(tables['Conversion to kBtu'][definition['Units']])
+    return metered_energy, delivered_energy
+
+
+def map_address(allbuilding, ids=None):
+    """Map the address from 'All - Building' to an Address element (or None if there isn't one)"""
     address = createElement('Address')
     if 'Street*' in allbuilding:
         el = createSubElement(address, 'StreetAddressDetail')
@@ -1645,42 +2374,74 @@ def map_to_buildingsync(obj, groupspaces=False):
         el.text = postalcodeplus4
     # street address, city, state, zip5, zip5-4
     if len(address) == 0:
-        address = None
-    # Create contacts if they are present
+        return None
+    return address
+
+
+def map_contacts(allbuilding, ids=None):
+    """Map the people named in 'All - Building' to a Contacts element"""
+    if ids is None:
+        ids = IDRegistry()
     contacts = createElement('Contacts')
-    auditor = None
     if 'Energy Auditor' in allbuilding:
         auditor = createSubElement(contacts, 'Contact')
-        auditor.attrib['ID'] = 'EnergyAuditor'
+        ids.allocate(auditor, 'EnergyAuditor')
         addel('ContactRole', auditor, 'Energy Auditor')
         addel('ContactName', auditor, allbuilding['Energy Auditor'])
-    keycontact = None
     if 'Key Contact' in allbuilding:
         keycontact = createSubElement(contacts, 'Contact')
-        keycontact.attrib['ID'] = 'KeyContact'
+        ids.allocate(keycontact, 'KeyContact')
         addel('ContactRole', keycontact, 'Other')
         addel('ContactName', keycontact, allbuilding['Key Contact'])
         addudf(keycontact, 'ASHRAE Standard 211 Role', 'Key Contact')
     if 'Client Name' in allbuilding:
         client = createSubElement(contacts, 'Contact')
-        client.attrib['ID'] = 'Client'
+        ids.allocate(client, 'Client')
         addel('ContactRole', client, 'Other')
         addel('ContactName', client, allbuilding['Client Name'])
         addudf(client, 'ASHRAE Standard 211 Role', 'Client')
     if 'Building Owner' in allbuilding:
         owner = createSubElement(contacts, 'Contact')
-        owner.attrib['ID'] = 'BuildingOwner'
+        ids.allocate(owner, 'BuildingOwner')
         addel('ContactRole', owner, 'Other')
         addel('ContactName', owner, allbuilding['Building Owner'])
         addudf(owner, 'ASHRAE Standard 211 Role', 'Owner')
+    return contacts
+
+
+building_name_plan = compile_rules([
+    maprule('Building Name*', 'PremisesName'),
+    maprule('Building Description - Notable Conditions', 'PremisesNotes')])
+
+building_plan = compile_rules([
+    maprule('Conditioned Floors Above grade', 'ConditionedFloorsAboveGrade', str),
+    maprule('Conditioned Floors Below grade', 'ConditionedFloorsBelowGrade', str),
+    maprule('Building automation system? (Y/N)', 'BuildingAutomationSystem', yn2tf),
+    maprule('Historical landmark status? (Y/N)', 'HistoricalLandmark', yn2tf),
+    maprule('Year of construction*', 'YearOfConstruction', str),
+    maprule('Year of Prior Energy Audit', 'YearOfLastEnergyAudit', str),
+    maprule('Last Renovation*', 'YearOfLastMajorRemodel', str),
+    udfrule('Primary Building use type*', 'ASHRAE Standard 211 Primary Building Use Type'),
+    udfrule('Year Last Commissioned', 'ASHRAE Standard 211 Year Last Commissioned', str),
+    udfrule('Percent owned (%)', 'ASHRAE Standard 211 Percent Owned', repercentage),
+    udfrule('Percent leased (%)', 'ASHRAE Standard 211 Percent Leased', repercentage),
+    udfrule('Total Number of Floors', 'ASHRAE Standard 211 Total Number of Floors', str),
+    udfrule('Excluded Spaces', 'ASHRAE Standard 211 Excluded Spaces', ', '.join)])
 
+
+def map_building(allbuilding, ids=None):
+    """Map 'All - Building' to a Buildings element, without the Subsections
+
+    The Subsections element goes in front of the UserDefinedFields when the sections are assembled.
+    """
+    if ids is None:
+        ids = IDRegistry()
     buildings = createElement('Buildings')
     building = createSubElement(buildings, 'Building')
-    building.attrib['ID'] = 'Building'
+    ids.allocate(building, 'Building')
+    udfs = UDFAccumulator()
 
-    easymap(allbuilding, 'Building Name*', 'PremisesName', building)
-    easymap(allbuilding, 'Building Description - Notable Conditions',
-            'PremisesNotes', building)
+    apply_rules(building_name_plan, allbuilding, udfs, building)
     # OccupancyClassification should go here, but it can't: the enums don't match
     if 'Occupancy' in allbuilding:
         occupancy = allbuilding['Occupancy']
@@ -1707,14 +2468,6 @@ def map_to_buildingsync(obj, groupspaces=False):
             addel('SpatialUnitType', units, 'Apartment units')
             addel('NumberOfUnits', units, str(occupancy['Number of Dwelling Units in Building (Multifamily Only)']))
 
-    easymap(allbuilding, 'Conditioned Floors Above grade',
-            'ConditionedFloorsAboveGrade', building, f=str)
-    easymap(allbuilding, 'Conditioned Floors Below grade',
-            'ConditionedFloorsBelowGrade', building, f=str)
-    easymap(allbuilding, 'Building automation system? (Y/N)',
-            'BuildingAutomationSystem', building, yn2tf)
-    easymap(allbuilding, 'Historical landmark status? (Y/N)',
-            'HistoricalLandmark', building, yn2tf)
     # Map to FloorAreas
     floorareas = createElement('FloorAreas')
     if 'Total conditioned area' in allbuilding:
@@ -1741,17 +2494,29 @@ def map_to_buildingsync(obj, groupspaces=False):
             addel('FloorAreaCustomName', floorarea, key)
             addel('FloorAreaValue', floorarea, value)
 
-    easymap(allbuilding, 'Year of construction*',
-            'YearOfConstruction', building, f=str)
+    # The rest of the elements and then the UDFs
+    apply_rules(building_plan, allbuilding, udfs, building)
+
+    if 'Occupancy' in allbuilding:
+        udfs.map(allbuilding['Occupancy'],
+                 '% of Dwelling Units currently Occupied (Multifamily Only)',
+                 'ASHRAE Standard 211 Percent Dwelling Units Currently Occupied',
+                 f=repercentage)
+    udfs.emit(building)
+    return buildings
 
-    easymap(allbuilding, 'Year of Prior Energy Audit',
-            'YearOfLastEnergyAudit', building, f=str)
 
-    easymap(allbuilding, 'Last Renovation*',
-            'YearOfLastMajorRemodel', building, f=str)
-    #
-    # All - Space Functions
-    #
+space_plan = compile_rules([
+    udfrule('Function type', 'ASHRAE Standard 211 Function Type'),
+    udfrule('Original intended use', 'ASHRAE Standard 211 Original Intended Use'),
+    udfrule('Percent Conditioned Area', 'ASHRAE Standard 211 Percent Conditioned Area', repercentage),
+    udfrule('Approximate Plug Loads (W/sf)', 'ASHRAE Standard 211 Approximate Plug Loads', str),
+    udfrule('Principal HVAC Type', 'ASHRAE Standard 211 Principal HVAC Type', str),
+    udfrule('Principal Lighting Type', 'ASHRAE Standard 211 Principal Lighting Type', str)])
+
+
+def map_spaces(spacefunctions, groupspaces=False, ids=None):
+    """Map 'All - Space Functions' to a ThermalZones element (or None if there are no spaces)"""
     # subsections = createElement('Subsections')
     spaces = []
     phvac = {}
@@ -1784,17 +2549,9 @@ def map_to_buildingsync(obj, groupspaces=False):
             addel('FloorAreaType', floorarea, 'Gross')
             addel('FloorAreaValue', floorarea, str(value['Gross Floor Area']))
         # Now for the UDFs
-        easymapudf(value, 'Function type',
-                   'ASHRAE Standard 211 Function Type', element)
-        easymapudf(value, 'Original intended use',
-                   'ASHRAE Standard 211 Original Intended Use', element)
-        easymapudf(value, 'Percent Conditioned Area',
-                   'ASHRAE Standard 211 Percent Conditioned Area', element,
-                   f=repercentage)
-        easymapudf(value, 'Approximate Plug Loads (W/sf)',
-                   'ASHRAE Standard 211 Approximate Plug Loads', element, f=str)
-        easymapudf(value, 'Principal HVAC Type',
-                   'ASHRAE Standard 211 Principal HVAC Type', element, f=str)
+        udfs = UDFAccumulator()
+        apply_rules(space_plan, value, udfs, element)
+        udfs.emit(element)
         if value['Principal HVAC Type']:
             if value['Principal HVAC Type'] in phvac:
                 phvac[value['Principal HVAC Type']].append(element)
@@ -1802,39 +2559,221 @@ def map_to_buildingsync(obj, groupspaces=False):
                 phvac[value['Principal HVAC Type']] = [element]
         else:
             nohvac.append(element)
-        easymapudf(value, 'Principal Lighting Type',
-                   'ASHRAE Standard 211 Principal Lighting Type', element, f=str)
         spaces.append(element)
-    subsections = []
-    subsection = None
-
-    # Map the building shape if it is given
-    if 'General Building Shape*' in envelope:
-        subsections = createSubElement(building, 'Subsections')
-        subsection = createSubElement(subsections, 'Subsection')
-        addel('FootprintShape', subsection, envelope['General Building Shape*'])
 
-    hvacsystems = None
-    lightingsystems = None
-    dhwsystems = None
-    heatrecoverysystems = None
-    wallsystems = None
-    roofsystems = None
-    ceilingsystems = None
-    foundationsystems = None
-    fenestrationsystems = None
-    plugloads = None
-
-    # L2 - HVAC, make one system to represent all of it.
-    if len(hvac) > 0:
+    thermalzones = None
+    if len(spaces) > 0:
+        if groupspaces:
+            # Group spaces by the principle HVAC type
+            thermalzones = createElement('ThermalZones')
+            for phvactype, spcs in phvac.items():
+                tz = createSubElement(thermalzones, 'ThermalZone')
+                tzspaces = createSubElement(tz, 'Spaces')
+                for space in spcs:
+                    tzspaces.append(space)
+            # Anything with nothing gets its own zone
+            for space in nohvac:
+                tz = createElement('ThermalZone')
+                tzspaces = createSubElement(tz, 'Spaces')
+                tzspaces.append(space)
+        else:
+            # Every space gets its own thermal zone
+            thermalzones = createElement('ThermalZones')
+            for space in spaces:
+                tz = createSubElement(thermalzones, 'ThermalZone')
+                tzspaces = createSubElement(tz, 'Spaces')
+                tzspaces.append(space)
+    if thermalzones is not None and len(thermalzones) == 0:
+        return None
+    return thermalzones
+
+
+wall_plan = compile_rules([
+    maprule('Total exposed above grade wall area R value', 'WallRValue', str),
+    udfrule('Wall Constructions', 'ASHRAE Standard 211 Wall Construction', ', '.join)])
+
+fenestration_plan = compile_rules([
+    udfrule('Fenestration Frame Types', 'ASHRAE Standard 211 Fenestration Frame Types', ', '.join),
+    udfrule('Fenestration Glass Types', 'ASHRAE Standard 211 Fenestration Glass Types', ', '.join),
+    udfrule('Fenestration Seal Condition', 'ASHRAE Standard 211 Fenestration Seal Condition'),
+    udfrule('Description of Exterior doors**', 'ASHRAE Standard 211 Description of Exterior doors')])
+
+roof_plan = compile_rules([
+    maprule('Roof area R value', 'RoofRValue', str),
+    udfrule('Cool Roof (Y/N)', 'ASHRAE Standard 211 Cool Roof (Y/N)'),
+    udfrule('Roof condition', 'ASHRAE Standard 211 Roof Condition'),
+    udfrule('Roof Construction', 'ASHRAE Standard 211 Roof Construction', ', '.join)])
+
+foundation_plan = compile_rules([
+    udfrule('Foundation Type', 'ASHRAE Standard 211 Foundation Type', ', '.join),
+    udfrule('Floor Construction', 'ASHRAE Standard 211 Floor Construction', ', '.join)])
+
+# Envelope values that go in the subsection UDFs as they are (even if empty)
+envelope_udf_keys = ('Below grade wall area (sq ft)',
+                     'Below grade wall area (sq m)',
+                     'Overall Enclosure Tightness Assessment',
+                     'Description of Exterior doors**',
+                     'Below grade wall area R value',
+                     'Above grade wall common area with other conditioned buildings (ft2)',
+                     'Above grade wall common area with other conditioned buildings (m2)')
+# 'Fenestration Seal Condition'
+
+
+def map_envelope(envelope, ids=None):
+    """Map 'L2 - Envelope' to the envelope systems and the building subsection contents
+
+    :param envelope: dictionary of 'L2 - Envelope' data
+    :return: dictionary with the list of elements that go in the Subsection ('Subsection') and the
+             WallSystems, FenestrationSystems, RoofSystems, CeilingSystems and FoundationSystems (or None)
+    """
+    if ids is None:
+        ids = IDRegistry()
+    subsection = []
+    result = {'Subsection': subsection,
+              'WallSystems': None,
+              'FenestrationSystems': None,
+              'RoofSystems': None,
+              'CeilingSystems': None,
+              'FoundationSystems': None}
+
+    # Map the building shape if it is given
+    if 'General Building Shape*' in envelope:
+        el = createElement('FootprintShape')
+        el.text = str(envelope['General Building Shape*'])
+        subsection.append(el)
+
+    # Handle sides
+    if ('Total exposed above grade wall area (sq ft)' in envelope or
+            'Total exposed above grade wall area R value' in envelope or
+            'Glazing area, approx % of exposed wall area [10, 25, 50, 75, 90, 100]*' in envelope or
+            'Wall Constructions' in envelope or
+            'Fenestration Frame Types' in envelope or
+            'Fenestration Glass Types' in envelope or
+            'Fenestration Seal Condition' in envelope):
+        # Something is there to put in sides, make what we need
+        sides = createElement('Sides')
+        subsection.append(sides)
+        side = createSubElement(sides, 'Side')
+        # Make a wall system if needed
+        wallsystem = None
+        if ('Total exposed above grade wall area (sq ft)' in envelope or
+                'Total exposed above grade wall area R value' in envelope or
+                'Glazing area, approx % of exposed wall area [10, 25, 50, 75, 90, 100]*' in envelope or
+                'Wall Constructions' in envelope):
+            wallsystems = result['WallSystems'] = createElement('WallSystems')
+            wallsystem = createSubElement(wallsystems, 'WallSystem')
+            ids.allocate(wallsystem, 'Wall1')
+            udfs = UDFAccumulator()
+            apply_rules(wall_plan, envelope, udfs, wallsystem)
+            udfs.emit(wallsystem)
+        # Make window stuff
+        fenestrationsystem = None
+        if ('Fenestration Frame Types' in envelope or
+                'Fenestration Glass Types' in envelope):
+            fenestrationsystems = result['FenestrationSystems'] = createElement('FenestrationSystems')
+            fenestrationsystem = createSubElement(fenestrationsystems, 'FenestrationSystem')
+            ids.allocate(fenestrationsystem, 'Fenestration1')
+            udfs = UDFAccumulator()
+            apply_rules(fenestration_plan, envelope, udfs, fenestrationsystem)
+            udfs.emit(fenestrationsystem)
+        # Fill in the side information
+        if wallsystem is not None:
+            wallid = createSubElement(side, 'WallID')
+            ids.refer(wallid, wallsystem.attrib['ID'])
+            if 'Total exposed above grade wall area (sq ft)' in envelope:
+                addel('WallArea', wallid,
+                      str(envelope['Total exposed above grade wall area (sq ft)']))
+        if fenestrationsystem is not None:
+            windowid = createSubElement(side, 'WindowID')
+            ids.refer(windowid, fenestrationsystem.attrib['ID'])
+            if 'Glazing area, approx % of exposed wall area [10, 25, 50, 75, 90, 100]*' in envelope:
+                addel('WindowToWallRatio', windowid,
+                      str(envelope['Glazing area, approx % of exposed wall area [10, 25, 50, 75, 90, 100]*']))
+    # Roof is next
+    if ('Roof area (sq ft)' in envelope or
+            'Roof area R value' in envelope or
+            'Cool Roof (Y/N)' in envelope or
+            'Roof condition' in envelope or
+            'Roof Construction' in envelope):
+        roofsystems = result['RoofSystems'] = createElement('RoofSystems')
+        roofsystem = createSubElement(roofsystems, 'RoofSystem')
+        ids.allocate(roofsystem, 'Roof1')
+        udfs = UDFAccumulator()
+        apply_rules(roof_plan, envelope, udfs, roofsystem)
+        udfs.emit(roofsystem)
+        roofid = createElement('RoofID')
+        ids.refer(roofid, roofsystem.attrib['ID'])
+        easymap(envelope, 'Roof area (sq ft)', 'RoofArea', roofid, f=str)
+        subsection.append(roofid)
+
+    # Make a ceiling system if needed
+    if 'Floor Construction' in envelope:
+        if ('Steel joist' in envelope['Floor Construction'] or
+                'Wood frame' in envelope['Floor Construction']):
+            value = []
+            if 'Steel joist' in envelope['Floor Construction']:
+                value = ['Steel joist']
+            if 'Wood frame' in envelope['Floor Construction']:
+                value.append('Wood frame')
+            value = ', '.join(value)
+            ceilingsystems = result['CeilingSystems'] = createElement('CeilingSystems')
+            ceilingsystem = createSubElement(ceilingsystems, 'CeilingSystem')
+            ids.allocate(ceilingsystem, 'Ceiling1')
+            addudf(ceilingsystem, 'ASHRAE Standard 211 Floor Construction',
+                   str(value))
+            ceilingid = createElement('CeilingID')
+            ids.refer(ceilingid, ceilingsystem.attrib['ID'])
+            subsection.append(ceilingid)
+
+    # Foundation systems
+    if ('Foundation Type' in envelope or
+            'Floor Construction' in envelope):
+        foundationsystems = result['FoundationSystems'] = createElement('FoundationSystems')
+        foundationsystem = createSubElement(foundationsystems, 'FoundationSystem')
+        ids.allocate(foundationsystem, 'Foundation1')
+        udfs = UDFAccumulator()
+        apply_rules(foundation_plan, envelope, udfs, foundationsystem)
+        udfs.emit(foundationsystem)
+        foundationid = createElement('FoundationID')
+        ids.refer(foundationid, foundationsystem.attrib['ID'])
+        subsection.append(foundationid)
+
+    # Map the UDFs from L2 - Envelope
+    udfs = UDFAccumulator()
+    for key in envelope_udf_keys:
+        if key in envelope:
+            udfs.add('ASHRAE Standard 211 ' + key, str(envelope[key]))
+    if udfs:
+        subsection.append(udfs.element())
+    return result
+
+
+def map_systems(hvac, inventory, lighting_plug_loads, ids=None):
+    """Map 'L2 - HVAC', 'L2 Equipment Inventory' and 'L2 - Lighting Elec & Plug Loads' to systems
+
+    :return: dictionary of HVACSystems, LightingSystems, DomesticHotWaterSystems, HeatRecoverySystems
+             and PlugLoads elements (or None)
+    """
+    if ids is None:
+        ids = IDRegistry()
+    hvacsystems = None
+    lightingsystems = None
+    dhwsystems = None
+    heatrecoverysystems = None
+    plugloads = None
+
+    # L2 - HVAC, make one system to represent all of it.
+    if len(hvac) > 0:
         hvacsystem = createElement('HVACSystem')
         # Plant stuff
         if 'Boiler Type' in hvac:
             el = createSubElement(hvacsystem, 'Plants')
             el = createSubElement(el, 'HeatingPlant')
             el = createSubElement(el, 'Boiler')
+            udfs = UDFAccumulator()
             for val in hvac['Boiler Type']:
-                addudf(el, 'ASHRAE Std 211 Boiler Type', val)
+                udfs.add('ASHRAE Std 211 Boiler Type', val)
+            udfs.emit(el)
         # HeatingAndCoolingSystems
         hvacsys = el = createElement('HeatingAndCoolingSystems')
         stuff = ['Heating Source', 'Heating Fuel']
@@ -1842,32 +2781,38 @@ def map_to_buildingsync(obj, groupspaces=False):
         if any([el in hvac for el in stuff]):
             el = createSubElement(hvacsys, 'HeatingSources')
             el = createSubElement(el, 'HeatingSource')
+            udfs = UDFAccumulator()
             for tag in stuff:
                 if tag in hvac:
                     for val in hvac[tag]:
-                        addudf(el, 'ASHRAE Std 211 %s' % tag, val)
+                        udfs.add('ASHRAE Std 211 %s' % tag, val)
+            udfs.emit(el)
         stuff = ['Cooling Source', 'Chiller Input', 'Compressor', 'Condenser']
         # Cooling Source related info
         if any([el in hvac for el in stuff]):
             el = createSubElement(hvacsys, 'CoolingSources')
             el = createSubElement(el, 'CoolingSource')
+            udfs = UDFAccumulator()
             for tag in stuff:
                 if tag in hvac:
                     for val in hvac[tag]:
-                        addudf(el, 'ASHRAE Std 211 %s' % tag, val)
+                        udfs.add('ASHRAE Std 211 %s' % tag, val)
+            udfs.emit(el)
         if len(hvacsys) > 0:
             hvacsystem.append(hvacsys)
 
         # Tags with nowhere to go
         stuff = ['Zone Controls', 'Central Plant Controls', 'Heat Recovery', 'Outside Air',
                  'Cooling Distribution Equipment Type', 'Heating Distribution Equipment Type']
+        udfs = UDFAccumulator()
         for tag in stuff:
             if tag in hvac:
                 for val in hvac[tag]:
-                    addudf(hvacsystem, 'ASHRAE Std 211 %s' % tag, val)
+                    udfs.add('ASHRAE Std 211 %s' % tag, val)
+        udfs.emit(hvacsystem)
 
         if len(hvacsystem) > 0:
-            hvacsystem.attrib['ID'] = 'Std211L2HVAC'
+            ids.allocate(hvacsystem, 'Std211L2HVAC')
             hvacsystems = createElement('HVACSystems')
             hvacsystems.append(hvacsystem)
 
@@ -1875,14 +2820,16 @@ def map_to_buildingsync(obj, groupspaces=False):
         if any([el in hvac for el in stuff]):
             dhwsystems = createElement('DomesticHotWaterSystems')
             dhw = createSubElement(dhwsystems, 'DomesticHotWaterSystem')
-            dhw.attrib['ID'] = 'Std211L2HVACDHW'
+            ids.allocate(dhw, 'Std211L2HVACDHW')
+            udfs = UDFAccumulator()
             for tag in stuff:
                 if tag in hvac:
                     for val in hvac[tag]:
-                        addudf(dhw, 'ASHRAE Std 211 %s' % tag, val)
+                        udfs.add('ASHRAE Std 211 %s' % tag, val)
+            udfs.emit(dhw)
 
     if inventory:
-        systems = map_equipment_inventory(inventory)
+        systems = map_equipment_inventory(inventory, ids)
         if systems['HVACSystem']:
             if not hvacsystems:
                 hvacsystems = createElement('HVACSystems')
@@ -1900,17 +2847,19 @@ def map_to_buildingsync(obj, groupspaces=False):
         sources = []
         for src_type, src in lighting_plug_loads['Lighting Source Type(s)'].items():
             source = createElement('LightingSystem')
-            source.attrib['ID'] = 'LightingSystem%d' % num
+            ids.allocate(source, 'LightingSystem%d' % num)
             num += 1
             source.append(bsync_lighting_system_lookup(src_type))
             easyremap(src, 'Ballast Type(s)', 'BallastType', source, bsync_ballast_lookup)
+            udfs = UDFAccumulator()
             control = bsync_lighting_control_lookup(src['Control(s)'])
             if control is None:
-                easymapudf(src, 'Control(s)', 'ASHRAE Std 211 Lighting Control', source)
+                udfs.map(src, 'Control(s)', 'ASHRAE Std 211 Lighting Control')
             else:
                 source.append(control)
-            easymapudf(src, 'Space Type(s)*', 'ASHRAE Std 211 Space Type', source)
-            easymapudf(src, 'Approx % Area Served', 'ASHRAE Std 211 Approx % Area Served', source, str)
+            udfs.map(src, 'Space Type(s)*', 'ASHRAE Std 211 Space Type')
+            udfs.map(src, 'Approx % Area Served', 'ASHRAE Std 211 Approx % Area Served', str)
+            udfs.emit(source)
             sources.append(source)
         if len(sources) > 0:
             lightingsystems = createElement('LightingSystems')
@@ -1919,222 +2868,51 @@ def map_to_buildingsync(obj, groupspaces=False):
 
     # Plug/process loads
     if 'Major Process/Plug Load Type(s)**' in lighting_plug_loads:
-        num = 1
         loads = []
         for ld_type, ld in lighting_plug_loads['Major Process/Plug Load Type(s)**'].items():
             load = createElement('PlugLoad')
-            addudf(load, 'ASHRAE Std 211 Major Process/Plug Load Type(s)', ld_type)
-            easymapudf(ld, 'Key Operational Details***', 'ASHRAE Std 211 Key Operational Details', load)
+            udfs = UDFAccumulator()
+            udfs.add('ASHRAE Std 211 Major Process/Plug Load Type(s)', ld_type)
+            udfs.map(ld, 'Key Operational Details***', 'ASHRAE Std 211 Key Operational Details')
+            udfs.emit(load)
             loads.append(load)
         if len(loads) > 0:
             plugloads = createElement('PlugLoads')
             for load in loads:
                 plugloads.append(load)
 
-    # Handle sides
-    if ('Total exposed above grade wall area (sq ft)' in envelope or
-            'Total exposed above grade wall area R value' in envelope or
-            'Glazing area, approx % of exposed wall area [10, 25, 50, 75, 90, 100]*' in envelope or
-            'Wall Constructions' in envelope or
-            'Fenestration Frame Types' in envelope or
-            'Fenestration Glass Types' in envelope or
-            'Fenestration Seal Condition' in envelope):
-        # Something is there to put in sides, make what we need
-        if subsection is None:
-            subsections = createSubElement(building, 'Subsections')
-            subsection = createSubElement(subsections, 'Subsection')
-        sides = createSubElement(subsection, 'Sides')
-        side = createSubElement(sides, 'Side')
-        # Make a wall system if needed
-        wallsystem = None
-        if ('Total exposed above grade wall area (sq ft)' in envelope or
-                'Total exposed above grade wall area R value' in envelope or
-                'Glazing area, approx % of exposed wall area [10, 25, 50, 75, 90, 100]*' in envelope or
-                'Wall Constructions' in envelope):
-            wallsystems = createElement('WallSystems')
-            wallsystem = createSubElement(wallsystems, 'WallSystem')
-            wallsystem.attrib['ID'] = 'Wall1'
-            easymap(envelope, 'Total exposed above grade wall area R value',
-                    'WallRValue', wallsystem, f=str)
-            easymapudf(envelope, 'Wall Constructions',
-                       'ASHRAE Standard 211 Wall Construction', wallsystem, f=lambda x: ', '.join(x))
-        # Make window stuff
-        fenestrationsystem = None
-        if ('Fenestration Frame Types' in envelope or
-                'Fenestration Glass Types' in envelope):
-            fenestrationsystems = createElement('FenestrationSystems')
-            fenestrationsystem = createSubElement(fenestrationsystems, 'FenestrationSystem')
-            fenestrationsystem.attrib['ID'] = 'Fenestration1'
-            easymapudf(envelope, 'Fenestration Frame Types',
-                       'ASHRAE Standard 211 Fenestration Frame Types',
-                       fenestrationsystem, f=lambda x: ', '.join(x))
-            easymapudf(envelope, 'Fenestration Glass Types',
-                       'ASHRAE Standard 211 Fenestration Glass Types',
-                       fenestrationsystem, f=lambda x: ', '.join(x))
-            easymapudf(envelope, 'Fenestration Seal Condition',
-                       'ASHRAE Standard 211 Fenestration Seal Condition',
-                       fenestrationsystem)
-            easymapudf(envelope, 'Description of Exterior doors**',
-                       'ASHRAE Standard 211 Description of Exterior doors',
-                       fenestrationsystem)
-        # Fill in the side information
-        if wallsystem is not None:
-            wallid = createSubElement(side, 'WallID')
-            wallid.attrib['IDref'] = wallsystem.attrib['ID']
-            if 'Total exposed above grade wall area (sq ft)' in envelope:
-                addel('WallArea', wallid,
-                      str(envelope['Total exposed above grade wall area (sq ft)']))
-        if fenestrationsystem is not None:
-            windowid = createSubElement(side, 'WindowID')
-            windowid.attrib['IDref'] = fenestrationsystem.attrib['ID']
-            if 'Glazing area, approx % of exposed wall area [10, 25, 50, 75, 90, 100]*' in envelope:
-                addel('WindowToWallRatio', windowid,
-                      str(envelope['Glazing area, approx % of exposed wall area [10, 25, 50, 75, 90, 100]*']))
-    # Roof is next
-    if ('Roof area (sq ft)' in envelope or
-            'Roof area R value' in envelope or
-            'Cool Roof (Y/N)' in envelope or
-            'Roof condition' in envelope or
-            'Roof Construction' in envelope):
-        roofsystems = createElement('RoofSystems')
-        roofsystem = createSubElement(roofsystems, 'RoofSystem')
-        roofsystem.attrib['ID'] = 'Roof1'
-        easymap(envelope, 'Roof area R value', 'RoofRValue',
-                roofsystem, f=str)
-        easymapudf(envelope, 'Cool Roof (Y/N)',
-                   'ASHRAE Standard 211 Cool Roof (Y/N)', roofsystem)
-        easymapudf(envelope, 'Roof condition',
-                   'ASHRAE Standard 211 Roof Condition', roofsystem)
-        easymapudf(envelope, 'Roof Construction',
-                   'ASHRAE Standard 211 Roof Construction',
-                   roofsystem, f=lambda x: ', '.join(x))
-        roofid = createSubElement(subsection, 'RoofID')
-        roofid.attrib['IDref'] = roofsystem.attrib['ID']
-        easymap(envelope, 'Roof area (sq ft)', 'RoofArea', roofid, f=str)
-
-    # Make a ceiling system if needed
-    if 'Floor Construction' in envelope:
-        if ('Steel joist' in envelope['Floor Construction'] or
-                'Wood frame' in envelope['Floor Construction']):
-            value = []
-            if 'Steel joist' in envelope['Floor Construction']:
-                value = ['Steel joist']
-            if 'Wood frame' in envelope['Floor Construction']:
-                value.append('Wood frame')
-            value = ', '.join(value)
-            ceilingsystems = createElement('CeilingSystems')
-            ceilingsystem = createSubElement(ceilingsystems, 'CeilingSystem')
-            ceilingsystem.attrib['ID'] = 'Ceiling1'
-            addudf(ceilingsystem, 'ASHRAE Standard 211 Floor Construction',
-                   str(value))
-            ceilingid = createSubElement(subsection, 'CeilingID')
-            ceilingid.attrib['IDref'] = ceilingsystem.attrib['ID']
+    return {'HVACSystems': hvacsystems,
+            'LightingSystems': lightingsystems,
+            'DomesticHotWaterSystems': dhwsystems,
+            'HeatRecoverySystems': heatrecoverysystems,
+            'PlugLoads': plugloads}
 
-    # Foundation systems
-    foundationsystem = None
-    if ('Foundation Type' in envelope or
-            'Floor Construction' in envelope):
-        foundationsystems = createElement('FoundationSystems')
-        foundationsystem = createSubElement(foundationsystems, 'FoundationSystem')
-        foundationsystem.attrib['ID'] = 'Foundation1'
-        easymapudf(envelope, 'Foundation Type',
-                   'ASHRAE Standard 211 Foundation Type',
-                   foundationsystem, f=lambda x: ', '.join(x))
-        easymapudf(envelope, 'Floor Construction',
-                   'ASHRAE Standard 211 Floor Construction',
-                   foundationsystem, f=lambda x: ', '.join(x))
-        foundationid = createSubElement(subsection, 'FoundationID')
-        foundationid.attrib['IDref'] = foundationsystem.attrib['ID']
-
-    # Map the UDFs from L2 - Envelope
-    udfs = createElement('UserDefinedFields')
-    appendudf(udfs, 'Below grade wall area (sq ft)', envelope, prefix='ASHRAE Standard 211 ')
-    appendudf(udfs, 'Below grade wall area (sq m)', envelope, prefix='ASHRAE Standard 211 ')
-    appendudf(udfs, 'Overall Enclosure Tightness Assessment', envelope, prefix='ASHRAE Standard 211 ')
-    appendudf(udfs, 'Description of Exterior doors**', envelope, prefix='ASHRAE Standard 211 ')
-    appendudf(udfs, 'Below grade wall area R value', envelope, prefix='ASHRAE Standard 211 ')
-    appendudf(udfs, 'Above grade wall common area with other conditioned buildings (ft2)', envelope,
-              prefix='ASHRAE Standard 211 ')
-    appendudf(udfs, 'Above grade wall common area with other conditioned buildings (m2)', envelope,
-              prefix='ASHRAE Standard 211 ')
-    # appendudf(udfs, 'Fenestration Seal Condition', envelope, prefix = 'ASHRAE Standard 211 ')
-
-    if len(udfs) > 0:
-        if subsection is None:
-            subsections = createSubElement(building, 'Subsections')
-            subsection = createSubElement(subsections, 'Subsection')
-        subsection.append(udfs)
-
-    thermalzones = []
-    if len(spaces) > 0:
-        if groupspaces:
-            # Group spaces by the principle HVAC type
-            thermalzones = createElement('ThermalZones')
-            for phvactype, spcs in phvac.items():
-                tz = createSubElement(thermalzones, 'ThermalZone')
-                tzspaces = createSubElement(tz, 'Spaces')
-                for space in spcs:
-                    tzspaces.append(space)
-            # Anything with nothing gets its own zone
-            for space in nohvac:
-                tz = createElement('ThermalZone')
-                tzspaces = createSubElement(tz, 'Spaces')
-                tzspaces.append(space)
-        else:
-            # Every space gets its own thermal zone
-            thermalzones = createElement('ThermalZones')
-            for space in spaces:
-                tz = createSubElement(thermalzones, 'ThermalZone')
-                tzspaces = createSubElement(tz, 'Spaces')
-                tzspaces.append(space)
-    if len(thermalzones) > 0:
-        if subsection is None:
-            subsections = createSubElement(building, 'Subsections')
-            subsection = createSubElement(subsections, 'Subsection')
-        subsection.append(thermalzones)
-
-    # Now for the UDFs from All - Building
-    easymapudf(allbuilding, 'Primary Building use type*',
-               'ASHRAE Standard 211 Primary Building Use Type', building)
-    easymapudf(allbuilding, 'Year Last Commissioned',
-               'ASHRAE Standard 211 Year Last Commissioned', building, f=str)
-    easymapudf(allbuilding, 'Percent owned (%)',
-               'ASHRAE Standard 211 Percent Owned', building, f=repercentage)
-    easymapudf(allbuilding, 'Percent leased (%)',
-               'ASHRAE Standard 211 Percent Leased', building, f=repercentage)
-    easymapudf(allbuilding, 'Total Number of Floors',
-               'ASHRAE Standard 211 Total Number of Floors', building, f=str)
-    if 'Excluded Spaces' in allbuilding:
-        allbuilding['Excluded Spaces'] = ', '.join(allbuilding['Excluded Spaces'])
-    easymapudf(allbuilding, 'Excluded Spaces',
-               'ASHRAE Standard 211 Excluded Spaces', building)
 
-    if 'Occupancy' in allbuilding:
-        easymapudf(allbuilding['Occupancy'],
-                   '% of Dwelling Units currently Occupied (Multifamily Only)',
-                   'ASHRAE Standard 211 Percent Dwelling Units Currently Occupied',
-                   building, f=repercentage)
+energy_source_plan = compile_rules([
+    udfrule('Energy Source', 'ASHRAE Standard 211 Energy Source'),
+    udfrule('Type', 'ASHRAE Standard 211 Type'),
+    udfrule('ID', 'ASHRAE Standard 211 ID', str),
+    udfrule('Rate schedule', 'ASHRAE Standard 211 Rate Schedule', str)])
 
-    # Wrap up for building
-    if len(building) == 0:
-        building = None
-        buildings = None
 
-    # Map energy sources, metered energy, and delivered energy to a report
-    report = createElement('Report')
-    scenario = None
-    resources = None
+def map_resource_uses(allbuilding, metered_energy, delivered_energy, tables, ids=None):
+    """Map energy sources, metered energy, and delivered energy to a ResourceUses element
 
-    if ('Energy Sources' in allbuilding
+    :param allbuilding: dictionary of 'All - Building' data
+    :param metered_energy: dictionary of 'All - Metered Energy' data, with defaults filled in
+    :param delivered_energy: dictionary of 'All - Delivered Energy' data, with defaults filled in
+    :param tables: dictionary of lookup tables
+    :return: ResourceUses element, or None if there is no energy information
+    """
+    if not ('Energy Sources' in allbuilding
             or 'Utility #1' in metered_energy
             or 'Utility #2' in metered_energy
             or 'Utility #3' in metered_energy
             or delivered_energy != {}):
-        scenarios = createSubElement(report, 'Scenarios')
-        scenario = createSubElement(scenarios, 'Scenario')
-        scenario.attrib['ID'] = 'ASHRAEStandard211Scenario'
-        addel('ScenarioName', scenario, 'ASHRAE Standard 211 Scenario')
-        resources = createSubElement(scenario, 'ResourceUses')
+        return None
+    if ids is None:
+        ids = IDRegistry()
+    resources = createElement('ResourceUses')
 
     #
     # Map the energy sources from 'All - Building', does this need to be
@@ -2149,12 +2927,9 @@ def map_to_buildingsync(obj, groupspaces=False):
             #    sub = createSubElement(resource, 'Utility')
             #    sub = createSubElement(sub, 'MeteringConfiguration')
             #    sub.text = el['Type']
-            easymapudf(el, 'Energy Source', 'ASHRAE Standard 211 Energy Source',
-                       resource)
-            easymapudf(el, 'Type', 'ASHRAE Standard 211 Type', resource)
-            easymapudf(el, 'ID', 'ASHRAE Standard 211 ID', resource, f=str)
-            easymapudf(el, 'Rate schedule', 'ASHRAE Standard 211 Rate Schedule',
-                       resource, f=str)
+            udfs = UDFAccumulator()
+            apply_rules(energy_source_plan, el, udfs, resource)
+            udfs.emit(resource)
             if len(resource) > 0:
                 resources.append(resource)
 
@@ -2162,37 +2937,27 @@ def map_to_buildingsync(obj, groupspaces=False):
     for name in ['Utility #1', 'Utility #2', 'Utility #3']:
         if name in metered_energy:
             resource = createElement('ResourceUse')
-            resource.attrib['ID'] = 'Std211ResourceUse' + name.replace(' #', '')
-            if metered_energy[name]['Definition']['Units'].startswith("=INDEX('Drop Down Lists'!"):
-                # Use default
-                metered_energy[name]['Definition']['Units'] = metered_energy_default_units[metered_energy[name]['Type']]
-            if metered_energy[name]['Definition']['kBtu/unit'].startswith('=IFERROR(INDEX(EnergyConversionRates,MATCH'):
-                # Use default
-                metered_energy[name]['Definition']['kBtu/unit'] = str(
-                    conversion_to_kBtu[metered_energy[name]['Definition']['Units']])
+            ids.allocate(resource, 'Std211ResourceUse' + name.replace(' #', ''))
+            udfs = UDFAccumulator()
             if metered_energy[name]['Type'] in metered_energy_type_lookup:
                 el = createSubElement(resource, 'EnergyResource')
                 el.text = metered_energy_type_lookup[metered_energy[name]['Type']]
             else:
                 el = createSubElement(resource, 'EnergyResource')
                 el.text = 'Other'
-                easymapudf(metered_energy[name], 'Type',
-                           'ASHRAE Standard 211 Energy Source', resource)
+                udfs.map(metered_energy[name], 'Type', 'ASHRAE Standard 211 Energy Source')
             el = createSubElement(resource, 'ResourceUnits')
-            el.text = metered_energy_bsync_units[metered_energy[name]['Type']]
+            el.text = tables['Metered Energy BuildingSync Units'][metered_energy[name]['Type']]
             el = createSubElement(resource, 'UtilityIDs')
             el = createSubElement(el, 'UtilityID')
-            el.attrib['IDref'] = 'Std211Metered' + name.replace(' #', '')
-            easymapudf(metered_energy[name]['Definition'], 'kBtu/unit', 'ASHRAE Standard 211 kBtu/unit', resource)
+            ids.refer(el, 'Std211Metered' + name.replace(' #', ''))
+            udfs.map(metered_energy[name]['Definition'], 'kBtu/unit', 'ASHRAE Standard 211 kBtu/unit', str)
+            udfs.emit(resource)
             resources.append(resource)
 
     if delivered_energy:
         resource = createElement('ResourceUse')
-        resource.attrib['ID'] = 'Std211ResourceUseDelivered1'
-        if delivered_energy['Definition']['Conversion to kBTU'].startswith("=IFERROR(INDEX("):
-            # Use default
-            delivered_energy['Definition']['Conversion to kBTU'] = str(
-                conversion_to_kBtu[delivered_energy['Definition']['Units']])
+        ids.allocate(resource, 'Std211ResourceUseDelivered1')
         el = createSubElement(resource, 'EnergyResource')
         fueltype = delivered_energy['Definition']['Delivered Energy Type (if applicable)']
         if fueltype == 'Oil':
@@ -2200,103 +2965,52 @@ def map_to_buildingsync(obj, groupspaces=False):
         el.text = fueltype
         el = createSubElement(resource, 'ResourceUnits')
         el.text = bsync_unit_lookup[delivered_energy['Definition']['Units']]
-        easymapudf(delivered_energy['Definition'], 'Conversion to kBTU', 'ASHRAE Standard 211 Conversion to kBTU',
-                   resource)
-        if 'Estimated Annual Use**' in delivered_energy['Definition']:
-            easymapudf(delivered_energy['Definition'], 'Estimated Annual Use**',
-                       'ASHRAE Standard 211 Estimated Annual Use', resource,
-                       str)
+        udfs = UDFAccumulator()
+        udfs.map(delivered_energy['Definition'], 'Conversion to kBTU', 'ASHRAE Standard 211 Conversion to kBTU', str)
+        udfs.map(delivered_energy['Definition'], 'Estimated Annual Use**', 'ASHRAE Standard 211 Estimated Annual Use',
+                 str)
+        udfs.emit(resource)
         resources.append(resource)
+    return resources
 
-    # Now the time series data
-    datapoints = []
 
-    keys = {'Utility #1': {'Use': 'Energy', 'Cost': 'Currency', 'Peak': 'Energy'},
-            'Utility #2': {'Use': 'Energy', 'Cost': 'Currency'},
-            'Utility #3': {'Use': 'Energy', 'Cost': 'Currency'}}
-
-    reading_type = {'Use': 'Total',
-                    'Cost': 'Total',
-                    'Peak': 'Peak'}
-
-    for name in ['Utility #1', 'Utility #2', 'Utility #3']:
-        if name in metered_energy:
-            refname = 'Std211ResourceUse' + name.replace(' #', '')
-            if 'Data' in metered_energy[name]:
-                for pt in metered_energy[name]['Data']:
-                    start = pt['Start Date']
-                    end = pt['End Date']
-                    # Compute the frequency, we don't handle 'Unknown'
-                    frequency = determine_frequency(start, end)
-                    for inkey, outkey in keys[name].items():
-                        ts = createElement('TimeSeries')
-                        el = createSubElement(ts, 'ReadingType')
-                        el.text = reading_type[inkey]
-                        el = createSubElement(ts, 'TimeSeriesReadingQuantity')
-                        el.text = outkey
-                        el = createSubElement(ts, 'StartTimeStamp')
-                        el.text = start.strftime('%Y-%m-%dT00:00:00')
-                        el = createSubElement(ts, 'EndTimeStamp')
-                        el.text = end.strftime('%Y-%m-%dT00:00:00')
-                        el = createSubElement(ts, 'IntervalFrequency')
-                        el.text = frequency
-                        el = createSubElement(ts, 'IntervalReading')
-                        el.text = str(pt[inkey])
-                        el = createSubElement(ts, 'ResourceUseID')
-                        el.attrib['IDref'] = refname
-                        datapoints.append(ts)
+def map_timeseries_data(metered_energy, delivered_energy, ids=None):
+    """Map the metered and delivered energy data to a TimeSeriesData element (or None if there's no data)"""
+    datapoints = map_timeseries(metered_energy, delivered_energy, ids)
+    first = next(datapoints, None)
+    if first is None:
+        return None
+    ts = createElement('TimeSeriesData')
+    ts.append(first)
+    ts.extend(datapoints)
+    return ts
 
-    if delivered_energy:
-        refname = 'Std211ResourceUseDelivered1'
-        if 'Data' in delivered_energy:
-            for pt in delivered_energy['Data']:
-                start = pt['Delivery date']
-                for inkey, outkey in {'Volume': 'Other', 'Cost': 'Currency'}.items():
-                    ts = createElement('TimeSeries')
-                    el = createSubElement(ts, 'ReadingType')
-                    el.text = 'Total'
-                    el = createSubElement(ts, 'TimeSeriesReadingQuantity')
-                    el.text = outkey
-                    el = createSubElement(ts, 'StartTimeStamp')
-                    el.text = start.strftime('%Y-%m-%dT00:00:00')
-                    el = createSubElement(ts, 'IntervalReading')
-                    el.text = str(pt[inkey])
-                    el = createSubElement(ts, 'ResourceUseID')
-                    el.attrib['IDref'] = refname
-                    datapoints.append(ts)
-
-    if len(datapoints) > 0:
-        ts = createSubElement(scenario, 'TimeSeriesData')
-        for pt in datapoints:
-            ts.append(pt)
-
-    if len(scenario) > 0 and (building is not None):
-        link = createSubElement(scenario, 'LinkedPremises')
-        el = createSubElement(link, 'Building')
-        el = createSubElement(el, 'LinkedBuildingID')
-        el.attrib['IDref'] = building.attrib['ID']
 
-    # Add the utility items
+def map_utilities(metered_energy, ids=None):
+    """Map the metered energy utilities to a Utilities element (or None if there are none)"""
+    if ids is None:
+        ids = IDRegistry()
     utilities = createElement('Utilities')
     for name in ['Utility #1', 'Utility #2', 'Utility #3']:
         if name in metered_energy:
             el = createSubElement(utilities, 'Utility')
-            el.attrib['ID'] = 'Std211Metered' + name.replace(' #', '')
+            ids.allocate(el, 'Std211Metered' + name.replace(' #', ''))
             el = createSubElement(el, 'UtilityName')
             el.text = name
     if len(utilities) > 0:
-        report.append(utilities)
+        return utilities
+    return None
 
-    if auditor is not None:
-        el = createSubElement(report, 'AuditorContactID')
-        el.attrib['IDref'] = auditor.attrib['ID']
 
-    easymapudf(allbuilding, 'Date of site visit(s)',
-               'ASHRAE Standard 211 Date of site visit(s)', report)
+def map_measures(summary, summary_L2, metered_energy, delivered_energy, ids=None):
+    """Map 'L1 - EEM Summary' and 'L2 - EEM Summary' to a Measures element
 
-    # Wrap up for report
-    if len(report) == 0:
-        report = None
+    :param summary: dictionary of 'L1 - EEM Summary' data
+    :param summary_L2: dictionary of 'L2 - EEM Summary' data
+    :param metered_energy: dictionary of 'All - Metered Energy' data, with defaults filled in
+    :param delivered_energy: dictionary of 'All - Delivered Energy' data, with defaults filled in
+    :return: Measures element
+    """
     #
     # L1 - EEM Summary
     #
@@ -2314,19 +3028,12 @@ def map_to_buildingsync(obj, groupspaces=False):
             measure = createSubElement(measures, 'Measure')
             el = createSubElement(measure, 'LongDescription')
             el.text = key
-            udfs = createSubElement(measure, 'UserDefinedFields')
+            udfs = UDFAccumulator()
             for field in fields:
                 if field in value:
-                    udf = createSubElement(udfs, 'UserDefinedField')
-                    udfname = createSubElement(udf, 'FieldName')
-                    udfname.text = field
-                    udfvalue = createSubElement(udf, 'FieldValue')
-                    udfvalue.text = value[field]
-            udf = createSubElement(udfs, 'UserDefinedField')
-            udfname = createSubElement(udf, 'FieldName')
-            udfname.text = 'ASHRAE Standard 211 L1 Measure Category'
-            udfvalue = createSubElement(udf, 'FieldValue')
-            udfvalue.text = 'Low-Cost and No-Cost Recommendations'
+                    udfs.add(field, value[field])
+            udfs.add('ASHRAE Standard 211 L1 Measure Category', 'Low-Cost and No-Cost Recommendations')
+            udfs.emit(measure)
     # Change that one thing...
     fields[1] = 'Impact on Occupant Comfort'
     if 'Potential Capital Recommendations' in summary:
@@ -2334,19 +3041,12 @@ def map_to_buildingsync(obj, groupspaces=False):
             measure = createSubElement(measures, 'Measure')
             el = createSubElement(measure, 'LongDescription')
             el.text = key
-            udfs = createSubElement(measure, 'UserDefinedFields')
+            udfs = UDFAccumulator()
             for field in fields:
                 if field in value:
-                    udf = createSubElement(udfs, 'UserDefinedField')
-                    udfname = createSubElement(udf, 'FieldName')
-                    udfname.text = field
-                    udfvalue = createSubElement(udf, 'FieldValue')
-                    udfvalue.text = value[field]
-            udf = createSubElement(udfs, 'UserDefinedField')
-            udfname = createSubElement(udf, 'FieldName')
-            udfname.text = 'ASHRAE Standard 211 L2 Measure Category'
-            udfvalue = createSubElement(udf, 'FieldValue')
-            udfvalue.text = 'Potential Capital Recommendations'
+                    udfs.add(field, value[field])
+            udfs.add('ASHRAE Standard 211 L2 Measure Category', 'Potential Capital Recommendations')
+            udfs.emit(measure)
 
     #
     # L2 - EEM Summary
@@ -2398,27 +3098,288 @@ def map_to_buildingsync(obj, groupspaces=False):
             easymap(value, 'Measure Life (years)', 'UsefulLife', measure, str)
             easymap(value, 'Measure Cost', 'MeasureTotalFirstCost', measure, str)
 
-            udfs = createSubElement(measure, 'UserDefinedFields')
+            udfs = UDFAccumulator()
             for field in udf_fields:
-                if field in value:
-                    if value[field]:
-                        udf = createSubElement(udfs, 'UserDefinedField')
-                        udfname = createSubElement(udf, 'FieldName')
-                        udfname.text = 'ASHRAE Std 211 ' + field
-                        udfvalue = createSubElement(udf, 'FieldValue')
-                        udfvalue.text = value[field]
-            udf = createSubElement(udfs, 'UserDefinedField')
-            udfname = createSubElement(udf, 'FieldName')
-            udfname.text = 'ASHRAE Standard 211 L2 Measure Category'
-            udfvalue = createSubElement(udf, 'FieldValue')
-            udfvalue.text = category
+                udfs.map(value, field, 'ASHRAE Std 211 ' + field)
+            udfs.add('ASHRAE Standard 211 L2 Measure Category', category)
+            udfs.emit(measure)
+    return measures
+
+
+def map_report(resources, timeseriesdata, utilities, allbuilding, building_id=None, auditor_id=None, ids=None):
+    """Put the report together from the mapped sections
+
+    :param resources: ResourceUses element (or None)
+    :param timeseriesdata: TimeSeriesData element (or None)
+    :param utilities: Utilities element (or None)
+    :param allbuilding: dictionary of 'All - Building' data
+    :param building_id: ID of the building the scenario applies to (or None)
+    :param auditor_id: ID of the energy auditor contact (or None)
+    :param ids: IDRegistry to record the IDs and IDrefs in (optional)
+    :return: Report element, or None if there is nothing to report
+    """
+    if ids is None:
+        ids = IDRegistry()
+    report = createElement('Report')
+    if resources is not None:
+        scenarios = createSubElement(report, 'Scenarios')
+        scenario = createSubElement(scenarios, 'Scenario')
+        ids.allocate(scenario, 'ASHRAEStandard211Scenario')
+        addel('ScenarioName', scenario, 'ASHRAE Standard 211 Scenario')
+        scenario.append(resources)
+        if timeseriesdata is not None:
+            scenario.append(timeseriesdata)
+        if building_id is not None:
+            link = createSubElement(scenario, 'LinkedPremises')
+            el = createSubElement(link, 'Building')
+            el = createSubElement(el, 'LinkedBuildingID')
+            ids.refer(el, building_id)
+
+    # Add the utility items
+    if utilities is not None:
+        report.append(utilities)
+
+    if auditor_id is not None:
+        el = createSubElement(report, 'AuditorContactID')
+        ids.refer(el, auditor_id)
+
+    udfs = UDFAccumulator()
+    udfs.map(allbuilding, 'Date of site visit(s)', 'ASHRAE Standard 211 Date of site visit(s)')
+    udfs.emit(report)
+
+    # Wrap up for report
+    if len(report) == 0:
+        return None
+    return report
+
+
+# Serialized results of the section mappers as (result, IDRegistry, size), keyed by mapper and a hash of
+# the input. The least recently used are dropped
+section_cache = collections.OrderedDict()
+# Total size in bytes of the results kept in section_cache. It is 0 (nothing is kept) unless a long-running
+# process turns it on with use_section_cache, a one-off translation has nothing to reuse
+section_cache_size = 0
+# Sections that are never kept, the time series are most of a big document and change with every new bill
+uncached_sections = {'TimeSeriesData'}
+
+
+class SectionXML(bytes):
+    """Serialized element in the result of a section mapper that ran in another process"""
+    pass
+
+
+def pack_section(result):
+    if isinstance(result, et._Element):
+        return SectionXML(et.tostring(result))
+    if isinstance(result, dict):
+        return {key: pack_section(value) for key, value in result.items()}
+    if isinstance(result, list):
+        return [pack_section(value) for value in result]
+    return result
+
+
+def unpack_section(result):
+    if isinstance(result, SectionXML):
+        return et.fromstring(result)
+    if isinstance(result, dict):
+        return {key: unpack_section(value) for key, value in result.items()}
+    if isinstance(result, list):
+        return [unpack_section(value) for value in result]
+    return result
+
+
+def map_section_xml(mapper, args):
+    """Run a section mapper and serialize the result so it can be sent back from another process"""
+    ids = IDRegistry()
+    return pack_section(mapper(*args, ids=ids)), ids
+
+
+def section_key(mapper, args):
+    sha = hashlib.sha1(mapper.__name__.encode('utf-8'))
+    sha.update(pickle.dumps(args, protocol=4))
+    return sha.hexdigest()
+
+
+def section_size(result):
+    """Get the size in bytes of the serialized elements in a packed section result"""
+    if isinstance(result, bytes):
+        return len(result)
+    if isinstance(result, dict):
+        return sum(section_size(value) for value in result.values())
+    if isinstance(result, list):
+        return sum(section_size(value) for value in result)
+    return 0
+
+
+def use_section_cache(size=64 * 1024 * 1024):
+    """Keep the results of the section mappers for reuse (see map_sections)
+
+    :param size: total size in bytes of the serialized results to keep (defaults to 64 MiB), 0 turns it off
+
+    This is for long-running processes (watch_workbooks, the translation server) that see revisions of
+    the same workbooks, a one-off translation only pays for working out the keys.
+    """
+    global section_cache_size
+    section_cache_size = size
+    trim_section_cache()
+
+
+def trim_section_cache():
+    total = sum(size for _, _, size in section_cache.values())
+    while section_cache and total > section_cache_size:
+        _, (_, _, size) = section_cache.popitem(last=False)
+        total -= size
+
+
+def map_sections(obj, groupspaces=False, timeseries=True, executor=None, ids=None):
+    """Map a dictionary of Standard 211 data into the BuildingSync sections.
+
+    :param obj: dictionary of Standard 211 data
+    :param groupspaces: Boolean determining if spaces should be combined by HVAC type (defaults to False)
+    :param timeseries: Boolean determining if the time series data is mapped (defaults to True)
+    :param executor: concurrent.futures executor to run the section mappers in (defaults to None, run them here)
+    :param ids: IDRegistry to add the IDs and IDrefs of the sections to (optional)
+    :return: dictionary of section results keyed by section name
+
+    Each section mapper only sees its slice of the data, so with use_section_cache the results are kept
+    (serialized, in memory) by a hash of that slice and reused when the same slice shows up again, e.g.
+    when a workbook is translated again after one sheet has changed. The time series aren't kept. The mappers that do have to run are independent of each other
+    and can be run concurrently by an executor, in which case the results come back serialized. Each
+    mapper records its IDs in a registry of its own, which is kept with the result.
+    """
+    allbuilding = obj['All - Building']
+    tables = obj.get('Lookup Tables', default_lookup_tables)
+    metered_energy, delivered_energy = resolve_energy_definitions(obj['All - Metered Energy'],
+                                                                  obj['All - Delivered Energy'], tables)
+    inputs = collections.OrderedDict()
+    inputs['Address'] = (map_address, (allbuilding,))
+    inputs['Contacts'] = (map_contacts, (allbuilding,))
+    inputs['Buildings'] = (map_building, (allbuilding,))
+    inputs['ThermalZones'] = (map_spaces, (obj['All - Space Functions'], groupspaces))
+    inputs['Envelope'] = (map_envelope, (obj['L2 - Envelope'],))
+    inputs['Systems'] = (map_systems, (obj['L2 - HVAC'], obj['L2 - Equipment Inventory'],
+                                       obj['L2 - Lighting Elec & Plug Loads']))
+    inputs['ResourceUses'] = (map_resource_uses, (allbuilding, metered_energy, delivered_energy, tables))
+    if timeseries:
+        inputs['TimeSeriesData'] = (map_timeseries_data, (metered_energy, delivered_energy))
+    inputs['Utilities'] = (map_utilities, (metered_energy,))
+    inputs['Measures'] = (map_measures, (obj['L1 - EEM Summary'], obj['L2 - EEM Summary'],
+                                         metered_energy, delivered_energy))
+    sections = {}
+    mapped = {}
+    futures = {}
+    for name, (mapper, args) in inputs.items():
+        key = None
+        if section_cache_size > 0 and name not in uncached_sections:
+            key = section_key(mapper, args)
+        if key in section_cache:
+            section_cache.move_to_end(key)
+            result, section_ids, _ = section_cache[key]
+            sections[name] = (unpack_section(result), section_ids)
+        elif executor is not None:
+            futures[name] = (key, executor.submit(map_section_xml, mapper, args))
+        else:
+            section_ids = IDRegistry()
+            mapped[name] = (key, (mapper(*args, ids=section_ids), section_ids))
+    for name, (key, future) in futures.items():
+        result, section_ids = future.result()
+        mapped[name] = (key, (unpack_section(result), section_ids))
+    for name, (key, section) in mapped.items():
+        if key is not None:
+            result = pack_section(section[0])
+            size = section_size(result)
+            if size <= section_cache_size:
+                section_cache[key] = (result, section[1], size)
+        sections[name] = section
+    trim_section_cache()
+    for name in inputs:
+        sections[name], section_ids = sections[name]
+        if ids is not None:
+            ids.update(section_ids)
+    return sections
+
+
+def map_to_buildingsync(obj, groupspaces=False, timeseries=True, executor=None, strict=False):
+    """Map a dictionary of Standard 211 data into the BuildingSync XML object.
+
+    :param obj: dictionary of Standard 211 data
+    :param groupspaces: Boolean determining if spaces should be combined by HVAC type (defaults to False)
+    :param timeseries: Boolean determining if the TimeSeries elements are included, if not an empty
+                       TimeSeriesData element marks where they go (defaults to True)
+    :param executor: concurrent.futures executor to run the section mappers in (defaults to None)
+    :param strict: Boolean determining if duplicate, invalid or dangling IDs raise InvalidIDs rather than
+                   issue an IDWarning (defaults to False)
+    :return: BuildingSync XML object (lxml.etree.ElemenTree)
+
+    Map a dictionary of Standard 211 data, as extracted using the read_std211_xlsx
+    function, into an XML object. The sections are mapped by map_sections and put
+    together here. The IDs and IDrefs are checked with check_ids once everything is
+    in place.
+    """
+    ids = IDRegistry()
+    sections = map_sections(obj, groupspaces=groupspaces, timeseries=timeseries, executor=executor, ids=ids)
+    allbuilding = obj['All - Building']
+    address = sections['Address']
+    contacts = sections['Contacts']
+    buildings = sections['Buildings']
+    envelope = sections['Envelope']
+    systems = sections['Systems']
+    measures = sections['Measures']
+
+    # Put the subsection together, the Subsections go in ahead of the building UDFs
+    building = buildings[0]
+    subsection = envelope['Subsection']
+    if sections['ThermalZones'] is not None:
+        subsection.append(sections['ThermalZones'])
+    if subsection:
+        subsections = createElement('Subsections')
+        el = createSubElement(subsections, 'Subsection')
+        el.extend(subsection)
+        udfs = building.find(qualify('UserDefinedFields'))
+        if udfs is None:
+            building.append(subsections)
+        else:
+            udfs.addprevious(subsections)
+
+    # Wrap up for building
+    if len(building) == 0:
+        building = None
+        buildings = None
+
+    if timeseries:
+        timeseriesdata = sections['TimeSeriesData']
+    else:
+        timeseriesdata = None
+        if next(map_timeseries(obj['All - Metered Energy'], obj['All - Delivered Energy']), None) is not None:
+            timeseriesdata = createElement('TimeSeriesData')
+
+    keycontact = None
+    if 'Key Contact' in allbuilding:
+        keycontact = 'KeyContact'
+    auditor = None
+    if 'Energy Auditor' in allbuilding:
+        auditor = 'EnergyAuditor'
+    report = map_report(sections['ResourceUses'], timeseriesdata, sections['Utilities'], allbuilding,
+                        building_id=building.attrib['ID'] if building is not None else None,
+                        auditor_id=auditor, ids=ids)
+
+    hvacsystems = systems['HVACSystems']
+    lightingsystems = systems['LightingSystems']
+    dhwsystems = systems['DomesticHotWaterSystems']
+    heatrecoverysystems = systems['HeatRecoverySystems']
+    plugloads = systems['PlugLoads']
+    wallsystems = envelope['WallSystems']
+    roofsystems = envelope['RoofSystems']
+    ceilingsystems = envelope['CeilingSystems']
+    fenestrationsystems = envelope['FenestrationSystems']
+    foundationsystems = envelope['FoundationSystems']
 
     #
     # Assemble the final result
     #
-    root_ns = et.QName("http://buildingsync.net/schemas/bedes-auc/2019", "BuildingSync")
+    root_ns = qualify('BuildingSync')
     attr_qname = et.QName("http://www.w3.org/2001/XMLSchema-instance", "schemaLocation")
-    nsmap = {None: "http://buildingsync.net/schemas/bedes-auc/2019",
+    nsmap = {None: tags211.namespace,
              'xsi': "http://www.w3.org/2001/XMLSchema-instance"}
     bsync = et.Element(root_ns,
                        {attr_qname: "http://buildingsync.net/schemas/bedes-auc/2019 https://github.com/BuildingSync/schema/releases/download/v1.0/BuildingSync.xsd"},
@@ -2440,7 +3401,7 @@ def map_to_buildingsync(obj, groupspaces=False):
             site.append(address)
         if keycontact is not None:
             pcid = createSubElement(site, 'PrimaryContactID')
-            pcid.text = keycontact.attrib['ID']
+            ids.refer(pcid, keycontact, text=True)
         if buildings is not None:
             site.append(buildings)
     # Second is Systems
@@ -2490,66 +3451,665 @@ def map_to_buildingsync(obj, groupspaces=False):
             facilities = createSubElement(bsync, 'Facilities')
             facility = createSubElement(facilities, 'Facility')
         facility.append(contacts)
+    check_ids(ids, strict=strict)
     # Done!
     return bsync
 
 
-def map_std211_xlsx_to_string(filename, verbose=False, groupspaces=False):
-    """Map a spreadsheet file into BuildingSync XML string.
+# A problem found by validate_buildingsync: the section and sheets that the element came from (None if
+# it isn't from any one section), the path to the element, and the schema's message
+SchemaProblem = collections.namedtuple('SchemaProblem', ['section', 'sheets', 'path', 'message'])
+
+# The section and sheets that elements with these names come from, the nearest one to an element wins
+section_sources = {
+    'Address': ('Address', ('All - Building',)),
+    'PrimaryContactID': ('Contacts', ('All - Building',)),
+    'Contacts': ('Contacts', ('All - Building',)),
+    'Buildings': ('Buildings', ('All - Building',)),
+    'Subsections': ('Envelope', ('L2 - Envelope',)),
+    'ThermalZones': ('ThermalZones', ('All - Space Functions',)),
+    'HVACSystems': ('Systems', ('L2 - HVAC', 'L2 - Equipment Inventory')),
+    'DomesticHotWaterSystems': ('Systems', ('L2 - HVAC',)),
+    'HeatRecoverySystems': ('Systems', ('L2 - Equipment Inventory',)),
+    'LightingSystems': ('Systems', ('L2 - Lighting Elec & Plug Loads',)),
+    'PlugLoads': ('Systems', ('L2 - Lighting Elec & Plug Loads',)),
+    'WallSystems': ('Envelope', ('L2 - Envelope',)),
+    'RoofSystems': ('Envelope', ('L2 - Envelope',)),
+    'CeilingSystems': ('Envelope', ('L2 - Envelope',)),
+    'FenestrationSystems': ('Envelope', ('L2 - Envelope',)),
+    'FoundationSystems': ('Envelope', ('L2 - Envelope',)),
+    'Measures': ('Measures', ('L1 - EEM Summary', 'L2 - EEM Summary')),
+    'ResourceUses': ('ResourceUses', ('All - Building', 'All - Metered Energy', 'All - Delivered Energy')),
+    'TimeSeriesData': ('TimeSeriesData', ('All - Metered Energy', 'All - Delivered Energy')),
+    'Utilities': ('Utilities', ('All - Metered Energy',)),
+    'Report': ('Report', ('All - Building',))}
+
+
+def element_source(element):
+    """Find where an element came from
+
+    :param element: element of a BuildingSync document
+    :return: section, sheets (both None if the element isn't from any one section) and the path to the
+             element with element names
+    """
+    section = None
+    sheets = None
+    names = []
+    while element is not None:
+        name = et.QName(element).localname
+        names.append(name)
+        if section is None and name in section_sources:
+            section, sheets = section_sources[name]
+        element = element.getparent()
+    return section, sheets, '/' + '/'.join(reversed(names))
+
+
+def validate_buildingsync(element, xsd=None):
+    """Validate BuildingSync XML against the schema
+
+    :param element: BuildingSync XML object, as returned by map_to_buildingsync
+    :param xsd: name of the XSD file (required unless $BUILDINGSYNC_XSD is set)
+    :return: list of SchemaProblem tuples, empty if the document is valid
+
+    The schema is compiled once per process (see schema211.load_schema), so validating a batch of
+    documents only pays for that once. Each problem says which section and sheets of the workbook the
+    offending element came from, and the path is given with element names.
+    """
+    schema = schema211.load_schema(xsd)
+    tree = element.getroottree()
+    if schema.validate(tree):
+        return []
+    problems = []
+    for error in schema.error_log:
+        found = tree.xpath(error.path) if error.path else []
+        if found:
+            section, sheets, path = element_source(found[0])
+        else:
+            section, sheets, path = None, None, error.path
+        problems.append(SchemaProblem(section, sheets, path, error.message))
+    return problems
+
+
+def write_empty_element(xf, fileobj, nsmap, element):
+    """Write an element with no text or children as a self-closing tag, the way lxml serializes it.
+
+    :param xf: incremental writer
+    :param fileobj: binary file object the incremental writer writes to
+    :param nsmap: namespaces declared by the document element
+    :param element: the element to write
+
+    The incremental writer always writes a start and an end tag, so the tag is serialized on its own
+    and written straight to the file. The namespaces are declared by the document element, so the
+    declarations are left out.
+    """
+    start = et.tostring(et.Element(element.tag, nsmap=nsmap))[:-2]
+    tag = et.tostring(et.Element(element.tag, element.attrib, nsmap=nsmap))
+    xf.flush()
+    fileobj.write(start.split(b' ', 1)[0] + tag[len(start):])
+
+
+def write_element(xf, element, write_empty):
+    """Write an element and everything in it to an incremental (lxml.etree.xmlfile) writer.
+
+    :param xf: incremental writer
+    :param element: the element to write
+    :param write_empty: function that writes an element with no content (see write_empty_element)
+    """
+    if element.text is None and len(element) == 0:
+        write_empty(element)
+        return
+    with xf.element(element.tag, element.attrib):
+        if element.text:
+            xf.write(element.text)
+        for child in element:
+            write_element(xf, child, write_empty)
+
+
+def stream_element(xf, element, timeseries, write_empty):
+    """Write an element to an incremental writer, releasing the children as they are written.
+
+    :param xf: incremental writer
+    :param element: the element to write
+    :param timeseries: iterable of TimeSeries elements to write into the TimeSeriesData element
+    :param write_empty: function that writes an element with no content (see write_empty_element)
+    """
+    if element.tag == qualify('TimeSeriesData'):
+        with xf.element(element.tag, element.attrib):
+            for ts in timeseries:
+                write_element(xf, ts, write_empty)
+        return
+    if element.text is None and len(element) == 0:
+        write_empty(element)
+        return
+    with xf.element(element.tag, element.attrib):
+        if element.text:
+            xf.write(element.text)
+        while len(element) > 0:
+            child = element[0]
+            stream_element(xf, child, timeseries, write_empty)
+            element.remove(child)
+
+
+def write_buildingsync_stream(obj, fileobj, groupspaces=False):
+    """Map a dictionary of Standard 211 data into BuildingSync XML and write it out incrementally.
+
+    :param obj: dictionary of Standard 211 data
+    :param fileobj: binary file object (or file name) to write the XML to
+    :param groupspaces: Boolean determining if spaces should be combined by HVAC type (defaults to False)
+
+    The TimeSeries elements, one per bill per quantity, are generated while they are written
+    instead of being collected in the tree, and each section (Sites, Systems, Measures, Report,
+    Contacts) is released once it has been written, so memory use does not grow with the number
+    of bills. The result is the same XML, byte for byte, as write_buildingsync gives for the
+    tree from map_to_buildingsync.
+    """
+    if isinstance(fileobj, str):
+        with open_output(fileobj) as fp:
+            return write_buildingsync_stream(obj, fp, groupspaces=groupspaces)
+    bsync = map_to_buildingsync(obj, groupspaces=groupspaces, timeseries=False)
+    timeseries = map_timeseries(obj['All - Metered Energy'], obj['All - Delivered Energy'])
+    fileobj.write(xml_declaration)
+    with et.xmlfile(fileobj, encoding='utf-8') as xf:
+        write_empty = functools.partial(write_empty_element, xf, fileobj, bsync.nsmap)
+        with xf.element(bsync.tag, bsync.attrib, nsmap=bsync.nsmap):
+            while len(bsync) > 0:
+                child = bsync[0]
+                stream_element(xf, child, timeseries, write_empty)
+                bsync.remove(child)
+
+
+def element_to_json(element):
+    """Convert an element into the structure that is written out as JSON
+
+    :param element: the element to convert
+    :return: None, a string or a dictionary
+
+    The conventions are the usual ones for XML in JSON: attributes are '@' keys, text that goes with
+    attributes or children is '#text', and a child element that appears more than once is a list. The
+    keys are in document order. Element names are not qualified, attributes in another namespace
+    (like xsi:schemaLocation) get their prefix.
+    """
+    result = {}
+    for key, value in element.attrib.items():
+        if key[0] == '{':
+            qname = et.QName(key)
+            prefixes = {uri: prefix for prefix, uri in element.nsmap.items()}
+            key = prefixes[qname.namespace] + ':' + qname.localname
+        result['@' + key] = value
+    for child in element:
+        name = et.QName(child).localname
+        value = element_to_json(child)
+        if name not in result:
+            result[name] = value
+        elif isinstance(result[name], list):
+            result[name].append(value)
+        else:
+            result[name] = [result[name], value]
+    if element.text:
+        if not result:
+            return element.text
+        result['#text'] = element.text
+    elif not result:
+        return None
+    return result
+
+
+# Stands in for the TimeSeries while the rest of the JSON is encoded
+json_timeseries_marker = '\x00TimeSeries\x00'
+
+
+def iter_json_timeseries(timeseries, indent=None):
+    """Generate the JSON for the TimeSeries elements, indented to go where the marker was
+
+    :param timeseries: iterator of TimeSeries elements (with at least one element)
+    :param indent: number of spaces the marker's line is indented by, or None for compact output
+    :return: generator of JSON strings
+    """
+    first = next(timeseries)
+    second = next(timeseries, None)
+    if indent is None:
+        if second is None:
+            yield json.dumps(element_to_json(first), ensure_ascii=False, separators=(',', ':'))
+            return
+        yield '['
+        separator = ''
+        for ts in itertools.chain((first, second), timeseries):
+            yield separator + json.dumps(element_to_json(ts), ensure_ascii=False, separators=(',', ':'))
+            separator = ','
+        yield ']'
+        return
+    if second is None:
+        yield json.dumps(element_to_json(first), ensure_ascii=False, indent=2).replace('\n', '\n' + ' ' * indent)
+        return
+    newline = '\n' + ' ' * (indent + 2)
+    yield '['
+    separator = newline
+    for ts in itertools.chain((first, second), timeseries):
+        yield separator + json.dumps(element_to_json(ts), ensure_ascii=False, indent=2).replace('\n', newline)
+        separator = ',' + newline
+    yield '\n' + ' ' * indent + ']'
+
+
+def write_buildingsync_json(obj, fileobj, groupspaces=False, pretty=False):
+    """Map a dictionary of Standard 211 data into BuildingSync and write it out as JSON.
+
+    :param obj: dictionary of Standard 211 data
+    :param fileobj: binary file object (or file name) to write the JSON to
+    :param groupspaces: Boolean determining if spaces should be combined by HVAC type (defaults to False)
+    :param pretty: Boolean determining if the output is indented (defaults to False)
+
+    The JSON is converted from the mapped elements (see element_to_json), so there is no XML to write
+    out and parse again. The namespace declarations are '@xmlns' keys of the root. As with
+    write_buildingsync_stream, the TimeSeries elements are generated as they are written rather than
+    collected in the tree: the rest of the document is encoded with a marker where they go, and they
+    are written in between.
+    """
+    if isinstance(fileobj, str):
+        with open_output(fileobj) as fp:
+            return write_buildingsync_json(obj, fp, groupspaces=groupspaces, pretty=pretty)
+    bsync = map_to_buildingsync(obj, groupspaces=groupspaces, timeseries=False)
+    root = {}
+    for prefix, uri in bsync.nsmap.items():
+        root['@xmlns' if prefix is None else '@xmlns:' + prefix] = uri
+    root.update(element_to_json(bsync))
+    timeseriesdata = bsync.find('.//' + qualify('TimeSeriesData'))
+    if timeseriesdata is not None:
+        # The placeholder is empty, so the path to it is all dictionaries
+        path = []
+        el = timeseriesdata
+        while el is not bsync:
+            path.append(et.QName(el).localname)
+            el = el.getparent()
+        parent = root
+        for name in reversed(path[1:]):
+            parent = parent[name]
+        parent[path[0]] = {'TimeSeries': json_timeseries_marker}
+    if pretty:
+        text = json.dumps({et.QName(bsync).localname: root}, ensure_ascii=False, indent=2) + '\n'
+    else:
+        text = json.dumps({et.QName(bsync).localname: root}, ensure_ascii=False, separators=(',', ':'))
+    marker = json.dumps(json_timeseries_marker)
+    if timeseriesdata is None or marker not in text:
+        fileobj.write(text.encode('utf-8'))
+        return
+    head, tail = text.split(marker, 1)
+    indent = None
+    if pretty:
+        line = head[head.rindex('\n') + 1:]
+        indent = len(line) - len(line.lstrip(' '))
+    fileobj.write(head.encode('utf-8'))
+    timeseries = map_timeseries(obj['All - Metered Energy'], obj['All - Delivered Energy'])
+    chunks = []
+    size = 0
+    for chunk in iter_json_timeseries(timeseries, indent):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > 65536:
+            fileobj.write(''.join(chunks).encode('utf-8'))
+            chunks = []
+            size = 0
+    chunks.append(tail)
+    fileobj.write(''.join(chunks).encode('utf-8'))
+
+
+def map_std211_xlsx_to_bytes(filename, verbose=False, groupspaces=False, cache=True, lowmem=False, pretty=False):
+    """Map a spreadsheet file into UTF-8 encoded BuildingSync XML.
 
     :param filename: name of input Excel file
     :param verbose: Boolean flag controlling output during translation (defaults to False)
     :param groupspaces: Boolean determining if spaces should be combined by HVAC type (defaults to False)
-    :return: BuildingSync XML as a string
+    :param cache: Boolean determining if the cache of workbook data is used (defaults to True)
+    :param lowmem: Boolean determining if the workbook is loaded one sheet at a time (defaults to False)
+    :param pretty: Boolean determining if the output is pretty-printed (defaults to False)
+    :return: BuildingSync XML as bytes
     """
     if not os.path.exists(filename):
         raise Exception('File "%s" does not exist' % filename)
-    if verbose:
-        wb = loadxl.load_workbook(filename)
-    else:
-        warnings.simplefilter("ignore")
-        wb = loadxl.load_workbook(filename)
-        warnings.simplefilter("default")
-    std211 = read_std211_xlsx(wb)
+    std211 = load_std211(filename, verbose=verbose, cache=cache, lowmem=lowmem)
     bsync = map_to_buildingsync(std211, groupspaces=groupspaces)
-    return '<?xml version="1.0" encoding="UTF-8"?>' + et.tostring(bsync, encoding='utf-8').decode('utf-8')
+    fp = BytesIO()
+    write_buildingsync(bsync, fp, pretty=pretty)
+    return fp.getvalue()
+
+
+def map_std211_xlsx_to_canonical(filename, groupspaces=False, cache=True, lowmem=False):
+    """Map a spreadsheet file into canonical BuildingSync XML and its digest.
+
+    :param filename: name of input Excel file
+    :param groupspaces: Boolean determining if spaces should be combined by HVAC type (defaults to False)
+    :param cache: Boolean determining if the cache of workbook data is used (defaults to True)
+    :param lowmem: Boolean determining if the workbook is loaded one sheet at a time (defaults to False)
+    :return: canonical BuildingSync XML as bytes and its hex SHA-256 digest
+    """
+    if not os.path.exists(filename):
+        raise Exception('File "%s" does not exist' % filename)
+    std211 = load_std211(filename, cache=cache, lowmem=lowmem)
+    bsync = map_to_buildingsync(std211, groupspaces=groupspaces)
+    fp = BytesIO()
+    digest = write_buildingsync_canonical(bsync, fp)
+    return fp.getvalue(), digest
+
+
+def map_std211_xlsx_to_string(filename, verbose=False, groupspaces=False, cache=True, lowmem=False):
+    """Map a spreadsheet file into BuildingSync XML string.
+
+    :param filename: name of input Excel file
+    :param verbose: Boolean flag controlling output during translation (defaults to False)
+    :param groupspaces: Boolean determining if spaces should be combined by HVAC type (defaults to False)
+    :param cache: Boolean determining if the cache of workbook data is used (defaults to True)
+    :param lowmem: Boolean determining if the workbook is loaded one sheet at a time (defaults to False)
+    :return: BuildingSync XML as a string
+    """
+    return map_std211_xlsx_to_bytes(filename, verbose=verbose, groupspaces=groupspaces, cache=cache,
+                                    lowmem=lowmem).decode('utf-8')
 
 
-def map_std211_xlsx_to_prettystring(filename, verbose=False, groupspaces=False):
+def map_std211_xlsx_to_prettystring(filename, verbose=False, groupspaces=False, cache=True, lowmem=False):
     """Map a spreadsheet file into a pretty-printed BuildingSync XML string.
 
         :param filename: name of input Excel file
         :param verbose: Boolean flag controlling output during translation (defaults to False)
         :param groupspaces: Boolean determining if spaces should be combined by HVAC type (defaults to False)
+        :param cache: Boolean determining if the cache of workbook data is used (defaults to True)
+        :param lowmem: Boolean determining if the workbook is loaded one sheet at a time (defaults to False)
         :return: BuildingSync XML as a pretty-printed string
         """
-    if not os.path.exists(filename):
-        raise Exception('File "%s" does not exist' % filename)
-    if verbose:
-        wb = loadxl.load_workbook(filename)
-    else:
-        warnings.simplefilter("ignore")
-        wb = loadxl.load_workbook(filename)
-        warnings.simplefilter("default")
-    std211 = read_std211_xlsx(wb)
-    bsync = map_to_buildingsync(std211, groupspaces=groupspaces)
-    return prettystring(bsync).decode('utf-8')
+    return map_std211_xlsx_to_bytes(filename, verbose=verbose, groupspaces=groupspaces, cache=cache,
+                                    lowmem=lowmem, pretty=True).decode('utf-8')
+
+
+# Extensions of the workbooks picked up from directories
+workbook_extensions = ('.xlsx', '.xlsm')
+
+
+def find_workbooks(paths, manifest=None):
+    """Make a list of the workbooks to translate
+
+    :param paths: list of workbook file names, directories and glob patterns
+    :param manifest: name of a file that lists more of them, one to a line (optional)
+    :return: list of workbook file names, without repeats
+
+    Directories are searched all the way down for .xlsx and .xlsm files. Blank lines and lines starting
+    with # in the manifest are skipped, and relative names in it are relative to the manifest. Excel's
+    lock files (~$name.xlsx) are left out.
+    """
+    paths = list(paths)
+    if manifest is not None:
+        base = os.path.dirname(manifest)
+        with open(manifest) as fp:
+            for line in fp:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    paths.append(os.path.join(base, line))
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, subdirs, files in os.walk(path):
+                subdirs.sort()
+                found.extend(os.path.join(directory, name) for name in sorted(files)
+                             if os.path.splitext(name)[1].lower() in workbook_extensions)
+        elif glob.has_magic(path):
+            found.extend(sorted(glob.glob(path, recursive=True)))
+        else:
+            found.append(path)
+    return [name for name in dict.fromkeys(found) if not os.path.basename(name).startswith('~$')]
+
+
+def batch_output_name(infile, output_dir=None, format='xml', compression=None):
+    """Get the output file name for a workbook in a batch
+
+    :param infile: name of the workbook
+    :param output_dir: directory for the output (defaults to None, next to the workbook)
+    :param format: 'xml' or 'json' (defaults to 'xml')
+    :param compression: compression as for open_output (defaults to None)
+    :return: the output file name, the workbook name with the extension for the format
+    """
+    name = os.path.splitext(infile)[0] + '.' + format
+    if compression is not None:
+        name += {v: k for k, v in compression_extensions.items()}[compression]
+    if output_dir is not None:
+        name = os.path.join(output_dir, os.path.basename(name))
+    return name
+
+
+# The outcome of translating one workbook in a batch: the file names, the error message (None if it
+# worked) and the time taken in seconds
+BatchResult = collections.namedtuple('BatchResult', ['infile', 'outfile', 'error', 'seconds'])
+
+
+def translate_file(infile, outfile, format='xml', pretty=False, groupspaces=False, compression=None, cache=True,
+                   stream=False):
+    """Translate one workbook to a file, catching any errors
+
+    :param infile: name of the workbook
+    :param outfile: name of the output file
+    :param format: 'xml' or 'json' (defaults to 'xml')
+    :param pretty: Boolean determining if the output is pretty-printed (defaults to False)
+    :param groupspaces: Boolean determining if spaces should be combined by HVAC type (defaults to False)
+    :param compression: compression as for open_output (defaults to None)
+    :param cache: Boolean determining if the cache of workbook data is used (defaults to True)
+    :param stream: Boolean determining if XML is written incrementally (defaults to False)
+    :return: BatchResult
+
+    The output is written atomically (see open_output).
+    """
+    start = time.perf_counter()
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            std211 = load_std211(infile, cache=cache)
+        with open_output(outfile, compression, atomic=True) as fp:
+            if format == 'json':
+                write_buildingsync_json(std211, fp, groupspaces=groupspaces, pretty=pretty)
+            elif stream:
+                write_buildingsync_stream(std211, fp, groupspaces=groupspaces)
+            else:
+                write_buildingsync(map_to_buildingsync(std211, groupspaces=groupspaces), fp, pretty=pretty)
+    except Exception as exc:
+        return BatchResult(infile, outfile, '%s: %s' % (type(exc).__name__, exc), time.perf_counter() - start)
+    return BatchResult(infile, outfile, None, time.perf_counter() - start)
+
+
+def translate_batch(infiles, output_dir=None, jobs=None, format='xml', compression=None, **kwargs):
+    """Translate a number of workbooks, each to its own file
+
+    :param infiles: list of workbook file names (see find_workbooks)
+    :param output_dir: directory for the output (defaults to None, next to each workbook)
+    :param jobs: number of worker processes (defaults to None, one per CPU), 1 translates them here
+    :param format: 'xml' or 'json' (defaults to 'xml')
+    :param compression: compression as for open_output (defaults to None)
+    :param kwargs: other arguments for translate_file
+    :return: generator of BatchResult, in the order the translations finish
+
+    A workbook that can't be translated doesn't stop the others, its error is in its result. The workers
+    are started once for the whole batch, so the interpreter, openpyxl and lxml start up once per worker
+    and not once per workbook.
+    """
+    outfiles = [batch_output_name(infile, output_dir, format, compression) for infile in infiles]
+    repeats = [name for name, count in collections.Counter(outfiles).items() if count > 1]
+    if repeats:
+        raise ValueError('More than one workbook would be written to %s' % ', '.join(repeats))
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    if jobs == 1 or len(infiles) < 2:
+        for infile, outfile in zip(infiles, outfiles):
+            yield translate_file(infile, outfile, format=format, compression=compression, **kwargs)
+        return
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    # Where the workers are forked, they get openpyxl already imported
+    loadxl.preload()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(translate_file, infile, outfile, format=format, compression=compression,
+                                   **kwargs)
+                   for infile, outfile in zip(infiles, outfiles)]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+class WorkbookWatcher:
+    """Keep track of the workbooks in some directories and tell when they are ready to translate
+
+    :param directories: list of directories to watch (searched all the way down)
+    :param settle: seconds a workbook must go unchanged before it is ready (defaults to 2)
+
+    Each poll is one os.scandir walk, comparing the modification time and size of each workbook with the
+    last poll. A workbook that is still being copied in or saved keeps changing, so it is only ready once
+    it has settled. Excel's lock files (~$name.xlsx) are ignored.
+    """
+
+    def __init__(self, directories, settle=2.0):
+        self.directories = list(directories)
+        self.settle = settle
+        # Path to (signature, time it was first seen with that signature) for workbooks waiting to settle
+        self.pending = {}
+        # Path to signature for workbooks that have been handed out (or were already up to date)
+        self.done = {}
+
+    def scan(self):
+        """Find the workbooks and their signatures
+
+        :return: dictionary of path to (modification time in ns, size)
+        """
+        found = {}
+        stack = list(self.directories)
+        while stack:
+            try:
+                it = os.scandir(stack.pop())
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            stack.append(entry.path)
+                        elif (os.path.splitext(entry.name)[1].lower() in workbook_extensions
+                              and not entry.name.startswith('~$')):
+                            st = entry.stat()
+                            found[entry.path] = (st.st_mtime_ns, st.st_size)
+                    except OSError:
+                        # Gone between the listing and the stat
+                        continue
+        return found
+
+    def poll(self, now=None):
+        """Look for workbooks that are new or changed and have settled
+
+        :param now: time.monotonic() time of the poll (defaults to None, now)
+        :return: sorted list of workbook paths that are ready, each is only returned once per change
+        """
+        if now is None:
+            now = time.monotonic()
+        current = self.scan()
+        ready = []
+        for path, signature in current.items():
+            if self.done.get(path) == signature:
+                continue
+            pending = self.pending.get(path)
+            if pending is None or pending[0] != signature:
+                self.pending[path] = (signature, now)
+            elif now - pending[1] >= self.settle:
+                del self.pending[path]
+                self.done[path] = signature
+                ready.append(path)
+        for table in (self.pending, self.done):
+            for path in [path for path in table if path not in current]:
+                del table[path]
+        return sorted(ready)
+
+
+def watch_workbooks(directories, output_dir=None, interval=1.0, settle=2.0, format='xml', compression=None,
+                    **kwargs):
+    """Translate workbooks as they arrive or change in some directories
+
+    :param directories: list of directories to watch (searched all the way down)
+    :param output_dir: directory for the output (defaults to None, next to each workbook)
+    :param interval: seconds between looks at the directories (defaults to 1)
+    :param settle: seconds a workbook must go unchanged before it is translated (defaults to 2)
+    :param format: 'xml' or 'json' (defaults to 'xml')
+    :param compression: compression as for open_output (defaults to None)
+    :param kwargs: other arguments for translate_file
+    :return: generator of BatchResult, one for each translation, that never ends
+
+    Workbooks whose output is already newer than they are are left alone at the start. Everything runs in
+    this process, so the modules are loaded once and the caches stay warm from one workbook to the next.
+    Outputs are written atomically (see translate_file).
+    """
+    watcher = WorkbookWatcher(directories, settle=settle)
+    use_section_cache()
+    for path, signature in watcher.scan().items():
+        try:
+            if os.stat(batch_output_name(path, output_dir, format, compression)).st_mtime_ns >= signature[0]:
+                watcher.done[path] = signature
+        except OSError:
+            pass
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    while True:
+        for path in watcher.poll():
+            yield translate_file(path, batch_output_name(path, output_dir, format, compression), format=format,
+                                 compression=compression, **kwargs)
+        time.sleep(interval)
+
+
+def peak_rss():
+    """Get the peak resident set size of the process.
+
+    :return: peak resident set size in bytes, or None if it isn't available on this platform
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
 
 
 def argument_parser():
     import argparse
 
     parser = argparse.ArgumentParser(description='Translate an ASHRAE Std. 211 Workbook into BuildingSync XML.')
-    parser.add_argument('infile', metavar='INFILE', help='input Excel spreadsheet file name')
+    parser.add_argument('infiles', metavar='INFILE', nargs='*',
+                        help='input Excel spreadsheet file name (or, for a batch, more of them, directories or globs)')
     parser.add_argument('-p', '--pretty', dest='pretty', action='store_true',
-                        help='output pretty xml')
+                        help='output pretty xml (or indented json)')
     parser.add_argument('-o', '--output', dest='outfile', action='store',
-                        default='std211.xml',
-                        help='file to save BuildingSync XML output in')
+                        default=None,
+                        help='file to save BuildingSync output in (defaults to std211.xml or std211.json)')
+    parser.add_argument('-f', '--format', dest='format', choices=['xml', 'json'], default='xml',
+                        help='output format (defaults to xml)')
+    parser.add_argument('-z', '--compress', dest='compression', choices=['gzip', 'bz2', 'xz', 'zstd'],
+                        default=None,
+                        help='compress the output (defaults to the compression for the output file extension)')
+    parser.add_argument('-c', '--canonical', dest='canonical', action='store_true',
+                        help='write canonical XML and print its SHA-256 digest')
+    parser.add_argument('-d', '--diff', dest='previous', action='store', default=None,
+                        help='write only the differences from a previous output (or workbook)')
+    parser.add_argument('--validate', dest='validate', action='store_true',
+                        help='validate the output against the BuildingSync schema')
+    parser.add_argument('--xsd', dest='xsd', action='store', default=None,
+                        help='BuildingSync schema file to validate with (required unless $BUILDINGSYNC_XSD is set)')
     parser.add_argument('-g', '--groupspaces', dest='group', action='store_true',
                         help='group spaces into zones by principal HVAC type')
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
                         help='operate verbosely')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='do not use or update the cache of workbook data')
+    parser.add_argument('-s', '--stream', dest='stream', action='store_true',
+                        help='write the XML out incrementally instead of building it all in memory')
+    parser.add_argument('--low-memory', dest='lowmem', action='store_true',
+                        help='load the workbook one sheet at a time and report peak memory use')
+    parser.add_argument('-m', '--manifest', dest='manifest', action='store', default=None,
+                        help='translate the workbooks listed in a file, one to a line')
+    parser.add_argument('-j', '--jobs', dest='jobs', action='store', type=int, default=None,
+                        help='number of worker processes for a batch (defaults to one per CPU)')
+    parser.add_argument('-w', '--watch', dest='watch', action='store_true',
+                        help='keep translating workbooks as they arrive or change in the INFILE directories')
+    parser.add_argument('--settle', dest='settle', action='store', type=float, default=2.0,
+                        help='seconds a watched workbook must go unchanged before it is translated (defaults to 2)')
+    parser.add_argument('--output-dir', dest='output_dir', action='store', default=None,
+                        help='directory for the output of a batch (defaults to next to each workbook)')
     return parser
 
 
@@ -2557,24 +4117,125 @@ if __name__ == '__main__':
     parser = argument_parser()
     args = parser.parse_args()
 
+    if not args.infiles and args.manifest is None:
+        parser.error('no input files')
+    if args.stream and args.pretty and args.format == 'xml':
+        parser.error('streamed output cannot be pretty printed')
+
+    if (args.watch or len(args.infiles) != 1 or args.manifest is not None or args.jobs is not None
+            or args.output_dir is not None or os.path.isdir(args.infiles[0]) or glob.has_magic(args.infiles[0])):
+        # A batch, each workbook goes to its own file
+        if args.outfile is not None:
+            parser.error('use --output-dir for the output of a batch')
+        if args.canonical or args.previous or args.validate or args.lowmem or args.verbose:
+            parser.error('--canonical, --diff, --validate, --low-memory and --verbose are for one workbook')
+        if args.jobs is not None and args.jobs < 1:
+            parser.error('--jobs must be at least 1')
+        if args.compression == 'zstd' and zstandard is None:
+            parser.error('zstd compression needs the zstandard package')
+        if args.watch:
+            if args.manifest is not None or args.jobs is not None:
+                parser.error('--manifest and --jobs are not used with --watch')
+            for directory in args.infiles:
+                if not os.path.isdir(directory):
+                    parser.error('"%s" is not a directory to watch' % directory)
+            try:
+                for result in watch_workbooks(args.infiles, output_dir=args.output_dir, settle=args.settle,
+                                              format=args.format, compression=args.compression,
+                                              pretty=args.pretty, groupspaces=args.group, cache=args.cache,
+                                              stream=args.stream):
+                    if result.error is None:
+                        print('ok      %s -> %s (%.2f s)' % (result.infile, result.outfile, result.seconds),
+                              flush=True)
+                    else:
+                        print('FAILED  %s: %s' % (result.infile, result.error), flush=True)
+            except KeyboardInterrupt:
+                sys.exit(0)
+        infiles = find_workbooks(args.infiles, args.manifest)
+        if not infiles:
+            parser.error('no workbooks found')
+        failed = 0
+        start = time.perf_counter()
+        try:
+            for result in translate_batch(infiles, output_dir=args.output_dir, jobs=args.jobs, format=args.format,
+                                          compression=args.compression, pretty=args.pretty, groupspaces=args.group,
+                                          cache=args.cache, stream=args.stream):
+                if result.error is None:
+                    print('ok      %s -> %s (%.2f s)' % (result.infile, result.outfile, result.seconds))
+                else:
+                    failed += 1
+                    print('FAILED  %s: %s' % (result.infile, result.error))
+        except ValueError as exc:
+            parser.error(str(exc))
+        print('%d translated, %d failed in %.2f s' % (len(infiles) - failed, failed, time.perf_counter() - start))
+        sys.exit(1 if failed else 0)
+
+    args.infile = args.infiles[0]
     if not os.path.exists(args.infile):
         raise Exception('File "%s" does not exist' % args.infile)
-
-    if args.verbose:
-        wb = loadxl.load_workbook(args.infile)
-    else:
-        warnings.simplefilter("ignore")
-        wb = loadxl.load_workbook(args.infile)
-        warnings.simplefilter("default")
-
-    std211 = read_std211_xlsx(wb)
-    bsync = map_to_buildingsync(std211, groupspaces=args.group)
-    if args.verbose:
-        print(prettystring(bsync).decode('utf-8'))
-    fp = open(args.outfile, 'w')
-    if args.pretty:
-        fp.write(prettystring(bsync).decode('utf-8'))
-    else:
-        fp.write('<?xml version="1.0" encoding="UTF-8"?>')
-        fp.write(et.tostring(bsync, encoding='utf-8').decode('utf-8'))
-    fp.close()
+    if args.canonical and (args.pretty or args.stream or args.format != 'xml'):
+        parser.error('canonical output is only written as unformatted XML')
+    if args.previous is not None and (args.stream or args.canonical or args.format != 'xml'):
+        parser.error('differences are only written as XML')
+    if args.previous is not None and not os.path.exists(args.previous):
+        parser.error('File "%s" does not exist' % args.previous)
+    if args.outfile is None:
+        args.outfile = 'std211.' + args.format
+        if args.compression is not None:
+            args.outfile += {v: k for k, v in compression_extensions.items()}[args.compression]
+    if (args.compression or output_compression(args.outfile)) == 'zstd' and zstandard is None:
+        parser.error('zstd compression needs the zstandard package')
+
+    if args.validate:
+        try:
+            schema211.load_schema(args.xsd)
+        except (schema211.SchemaNotFound, et.XMLSchemaParseError) as exc:
+            parser.error(str(exc))
+
+    previous = None
+    if args.previous is not None:
+        # Read before the output is opened, the previous output may be the file that is written
+        previous = read_buildingsync(args.previous, groupspaces=args.group, cache=args.cache)
+    std211 = load_std211(args.infile, verbose=args.verbose, cache=args.cache, lowmem=args.lowmem)
+    bsync = None
+    # A run that fails part way leaves the previous output as it was
+    with open_output(args.outfile, args.compression, atomic=True) as fp:
+        if args.format == 'json':
+            write_buildingsync_json(std211, fp, groupspaces=args.group, pretty=args.pretty)
+        elif args.stream:
+            write_buildingsync_stream(std211, fp, groupspaces=args.group)
+        elif args.previous is not None:
+            bsync = map_to_buildingsync(std211, groupspaces=args.group)
+            changes = write_buildingsync_diff(previous, bsync, fp, pretty=args.pretty)
+            counts = collections.Counter(change.kind for change in changes)
+            sys.stderr.write('%d added, %d changed, %d removed\n'
+                             % (counts['Added'], counts['Changed'], counts['Removed']))
+        elif args.canonical:
+            bsync = map_to_buildingsync(std211, groupspaces=args.group)
+            print('%s  %s' % (write_buildingsync_canonical(bsync, fp), args.outfile))
+        else:
+            bsync = map_to_buildingsync(std211, groupspaces=args.group)
+            pretty = None
+            if args.verbose:
+                pretty = prettystring(bsync)
+                print(pretty.decode('utf-8'))
+            if args.pretty and pretty is not None:
+                fp.write(pretty)
+            else:
+                write_buildingsync(bsync, fp, pretty=args.pretty)
+    if args.lowmem:
+        rss = peak_rss()
+        if rss is not None:
+            sys.stderr.write('Peak RSS: %.1f MiB\n' % (rss / 1048576))
+    if args.validate:
+        if bsync is None:
+            # The streamed output was never all in memory, map it again to check it
+            bsync = map_to_buildingsync(std211, groupspaces=args.group)
+        problems = validate_buildingsync(bsync, args.xsd)
+        for problem in problems:
+            where = problem.path
+            if problem.section is not None:
+                where = '%s (%s) %s' % (problem.section, ', '.join(problem.sheets), problem.path)
+            sys.stderr.write('%s: %s\n' % (where, problem.message))
+        if problems:
+            sys.exit(1)
@@ -34,18 +34,47 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import unittest
+import datetime
+import ast
+import bz2
+import copy
+import json
+import gzip
+import http.client
+import hashlib
+import lzma
 import read211
 import loadxl
+import cache211
+import diff211
+import schema211
+import server211
+import tags211
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import warnings
+import zipfile
+import urllib.error
 import urllib.request
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 from lxml import etree
 from io import BytesIO, StringIO
 
-# Test only version 1.0
-remote_file = urllib.request.urlopen('https://raw.githubusercontent.com/BuildingSync/schema/v1.0/BuildingSync.xsd')
-tree_data = remote_file.read()
-tree = etree.parse(BytesIO(tree_data))
-schema = etree.XMLSchema(tree)
+# Test only version 1.0, use a local copy of the schema if there is one
+if os.environ.get('BUILDINGSYNC_XSD'):
+    schema = schema211.load_schema()
+else:
+    remote_file = urllib.request.urlopen('https://raw.githubusercontent.com/BuildingSync/schema/v1.0/BuildingSync.xsd')
+    tree_data = remote_file.read()
+    tree = etree.parse(BytesIO(tree_data))
+    schema = etree.XMLSchema(tree)
 
 remote_file = urllib.request.urlopen('https://raw.githubusercontent.com/BuildingSync/schema/v1.0/examples/Golden%20Test%20File.xml')
 tree_data = remote_file.read()
@@ -62,10 +91,40 @@ def validate(filename, schema, instance):
 
 test_files = ['examples/std211_example.xlsx']
 
+# A schema that takes anything in a facility except Measures
+no_measures_xsd = b'''<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" elementFormDefault="qualified"
+    xmlns:auc="http://buildingsync.net/schemas/bedes-auc/2019" targetNamespace="http://buildingsync.net/schemas/bedes-auc/2019">
+  <xs:complexType name="Anything">
+    <xs:sequence><xs:any processContents="skip" minOccurs="0" maxOccurs="unbounded"/></xs:sequence>
+    <xs:anyAttribute processContents="skip"/>
+  </xs:complexType>
+  <xs:element name="BuildingSync">
+    <xs:complexType>
+      <xs:sequence>
+        <xs:element name="Facilities"><xs:complexType><xs:sequence>
+          <xs:element name="Facility"><xs:complexType><xs:sequence>
+            <xs:element name="Sites" type="auc:Anything" minOccurs="0"/>
+            <xs:element name="Systems" type="auc:Anything" minOccurs="0"/>
+            <xs:element name="Report" type="auc:Anything" minOccurs="0"/>
+            <xs:element name="Contacts" type="auc:Anything" minOccurs="0"/>
+          </xs:sequence></xs:complexType></xs:element>
+        </xs:sequence></xs:complexType></xs:element>
+      </xs:sequence>
+      <xs:anyAttribute processContents="skip"/>
+    </xs:complexType>
+  </xs:element>
+</xs:schema>'''
+
 
 class TestStd211Translation(unittest.TestCase):
     def setUp(self):
         self.maxDiff = None
+        # Keep the on-disk cache of each test to itself, and out of the real one
+        cachedir = tempfile.TemporaryDirectory()
+        self.addCleanup(cachedir.cleanup)
+        patcher = mock.patch.dict(os.environ, {'STD211_CACHE_DIR': cachedir.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_main_style_call(self):
         for file in test_files:
@@ -89,6 +148,627 @@ class TestStd211Translation(unittest.TestCase):
             bsync = etree.parse(BytesIO(txt.encode('utf-8')))
             self.assertEqual(validate(file, schema, bsync), '')
 
+    def test_map_std211_xlsx_to_bytes(self):
+        for file in test_files:
+            data = read211.map_std211_xlsx_to_bytes(file)
+            self.assertTrue(data.startswith(b'<?xml version="1.0" encoding="UTF-8"?><BuildingSync'))
+            self.assertEqual(data.decode('utf-8'), read211.map_std211_xlsx_to_string(file))
+            pretty = read211.map_std211_xlsx_to_bytes(file, pretty=True)
+            self.assertEqual(pretty.decode('utf-8'), read211.map_std211_xlsx_to_prettystring(file))
+            bsync = etree.parse(BytesIO(data))
+            self.assertEqual(validate(file, schema, bsync), '')
+
+    def test_cached_formula_values(self):
+        warnings.simplefilter("ignore")
+        wb = loadxl.load_workbook(test_files[0])
+        warnings.simplefilter("default")
+        std211 = read211.read_std211_xlsx(wb)
+        definition = std211['All - Metered Energy']['Utility #1']['Definition']
+        self.assertEqual(definition['Units'], 'kWh')
+        self.assertEqual(definition['kBtu/unit'], 3.412)
+        self.assertEqual(std211['All - Delivered Energy']['Definition']['Conversion to kBTU'], 139)
+        # Errors aren't values, the formula is used instead
+        sheet = wb['All - Building']
+        sheet['A1'] = '=VLOOKUP(B1,C1:D2,2,FALSE)'
+        sheet['A2'] = '=1+1'
+        sheettree = etree.fromstring(('<worksheet xmlns="%s"><sheetData><row r="1">'
+                                      '<c r="A1" t="e"><f>VLOOKUP(B1,C1:D2,2,FALSE)</f><v>#N/A</v></c>'
+                                      '</row><row r="2"><c r="A2"><f>1+1</f><v>2</v></c></row></sheetData></worksheet>')
+                                     % loadxl.ns['s'])
+        sheet.cached_values = loadxl.read_cached_values(sheet, sheettree)
+        self.assertEqual(sheet.cached_values, {(2, 1): 2})
+        self.assertEqual(read211.cellvalue(sheet['A1']), '=VLOOKUP(B1,C1:D2,2,FALSE)')
+        self.assertEqual(read211.cellvalue(sheet['A2']), 2)
+
+    def test_lookup_tables(self):
+        warnings.simplefilter("ignore")
+        wb = loadxl.load_workbook(test_files[0])
+        warnings.simplefilter("default")
+        tables = read211.read_lookup_tables(wb)
+        self.assertEqual(tables['Metered Energy Default Units'], read211.metered_energy_default_units)
+        self.assertEqual(tables['Metered Energy BuildingSync Units'], read211.metered_energy_bsync_units)
+        self.assertEqual(tables['Conversion to kBtu']['therms'], 100)
+        fingerprint = read211.template_fingerprint(wb)
+        self.assertIsNotNone(fingerprint)
+        self.assertIs(read211.get_lookup_tables(wb), read211.get_lookup_tables(wb))
+        self.assertNotIn('Delivered Energy Default Units', tables)
+        # Only the template counts, not what was entered
+        wb.part_crcs[wb.sheet_parts['All - Building']] ^= 1
+        wb.part_crcs['xl/sharedStrings.xml'] ^= 1
+        self.assertEqual(read211.template_fingerprint(wb), fingerprint)
+        units = wb.defined_names['EnergyUnits']
+        units.attr_text = units.attr_text.replace('28', '29')
+        self.assertNotEqual(read211.template_fingerprint(wb), fingerprint)
+        fingerprint = read211.template_fingerprint(wb)
+        wb.part_crcs[wb.sheet_parts['Drop Down Lists']] ^= 1
+        self.assertNotEqual(read211.template_fingerprint(wb), fingerprint)
+        with mock.patch.object(read211, 'template_lookup_tables_size', 1):
+            read211.get_lookup_tables(wb)
+            self.assertEqual(list(read211.template_lookup_tables), [read211.template_fingerprint(wb)])
+
+    def test_std211_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with mock.patch.dict(os.environ, {'STD211_CACHE_DIR': tmpdir}):
+                std211 = read211.load_std211(test_files[0])
+                key = read211.std211_cache_key(test_files[0])
+                self.assertTrue(os.path.exists(os.path.join(tmpdir, 'std211', key)))
+                self.assertEqual(read211.load_std211(test_files[0]), std211)
+                self.assertEqual(cache211.prune('std211', size=0), 1)
+                self.assertIsNone(cache211.load('std211', key))
+                # A new reader version gives a different key
+                with mock.patch.object(read211, 'reader_version', read211.reader_version + 1):
+                    self.assertNotEqual(read211.std211_cache_key(test_files[0]), key)
+
+    def test_sheet_crcs(self):
+        crcs = loadxl.sheet_crcs(test_files[0])
+        with zipfile.ZipFile(test_files[0]) as source:
+            parts = loadxl.find_sheet_parts(source)
+            used = {name: set(int(index) for index in loadxl.shared_string_cell_re.findall(source.read(part)))
+                    for name, part in parts.items()}
+            strings = list(loadxl.shared_string_re.finditer(source.read('xl/sharedStrings.xml')))
+            # A shared string that only 'All - Building' uses
+            index = min(used['All - Building'].difference(*[indices for name, indices in used.items()
+                                                             if name != 'All - Building']))
+            with tempfile.TemporaryDirectory() as tmpdir:
+                def changed(partname, change):
+                    filename = os.path.join(tmpdir, 'std211.xlsx')
+                    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as target:
+                        for info in source.infolist():
+                            data = source.read(info.filename)
+                            if info.filename == partname:
+                                data = change(data)
+                            # writestr updates the ZipInfo it is given
+                            target.writestr(copy.copy(info), data)
+                    new = loadxl.sheet_crcs(filename)
+                    return sorted(name for name in crcs if new[name] != crcs[name])
+
+                # Only the sheet that uses an edited shared string has changed
+                match = strings[index]
+                self.assertEqual(changed('xl/sharedStrings.xml',
+                                         lambda data: data[:match.end() - 9] + b'X' + data[match.end() - 9:]),
+                                 ['All - Building'])
+                # The named ranges count for every sheet
+                self.assertEqual(changed('xl/workbook.xml', lambda data: data.replace(b'$Z$28', b'$Z$29')),
+                                 sorted(crcs))
+
+    def test_incremental_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with mock.patch.dict(os.environ, {'STD211_CACHE_DIR': tmpdir}):
+                filename = os.path.join(tmpdir, 'std211.xlsx')
+                with open(test_files[0], 'rb') as fp:
+                    content = fp.read()
+                with open(filename, 'wb') as fp:
+                    fp.write(content)
+                std211 = read211.load_std211(filename)
+                # Resubmit with a change to one sheet that doesn't change the data
+                with zipfile.ZipFile(test_files[0]) as source:
+                    part = loadxl.find_sheet_parts(source)['All - Metered Energy']
+                    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as target:
+                        for info in source.infolist():
+                            data = source.read(info.filename)
+                            if info.filename == part:
+                                data += b'\n'
+                            target.writestr(info, data)
+                with mock.patch.object(loadxl, 'load_workbook', wraps=loadxl.load_workbook) as load_workbook:
+                    self.assertEqual(read211.load_std211(filename), std211)
+                load_workbook.assert_called_once_with(filename, sheets=['All - Metered Energy'])
+
+    def test_low_memory(self):
+        std211 = read211.load_std211(test_files[0], cache=False)
+        peaks = {}
+        for lowmem in [False, True]:
+            tracemalloc.start()
+            try:
+                self.assertEqual(read211.load_std211(test_files[0], cache=False, lowmem=lowmem), std211)
+                peaks[lowmem] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        # Only one sheet is loaded at a time
+        self.assertLess(peaks[True], 0.75 * peaks[False])
+        with mock.patch.object(loadxl, 'load_workbook', wraps=loadxl.load_workbook) as load_workbook:
+            read211.read_std211_by_sheet(test_files[0], sections=['All - Building', 'Lookup Tables'])
+        self.assertEqual(load_workbook.call_args_list, [mock.call(test_files[0], sheets=['All - Building']),
+                                                        mock.call(test_files[0], sheets=['Drop Down Lists'])])
+
+    def test_tag_registry(self):
+        # Every element name written out in the mapping code has to be in the registry
+        builders = {'createSubElement': 1, 'createElement': 0, 'qualify': 0, 'addel': 0, 'easymap': 2,
+                    'easyremap': 2}
+        with open(read211.__file__) as fp:
+            tree = ast.parse(fp.read())
+        checked = 0
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Call) and getattr(node.func, 'id', None) in builders:
+                # literal_eval works for string literals on every Python version (ast.Str before 3.8)
+                try:
+                    name = ast.literal_eval(node.args[builders[node.func.id]])
+                except ValueError:
+                    continue
+                self.assertIn(name, tags211.tags)
+                checked += 1
+        # Make sure the walk found the calls at all
+        self.assertGreater(checked, 100)
+        self.assertEqual(read211.qualify('Site'), '{http://buildingsync.net/schemas/bedes-auc/2019}Site')
+        with self.assertRaises(KeyError):
+            read211.createElement('Sight')
+        with self.assertRaises(ValueError):
+            tags211.build_registry(['Site', 'Site'])
+
+    def test_stream(self):
+        std211 = read211.load_std211(test_files[0], cache=False)
+        bsync = read211.map_to_buildingsync(copy.deepcopy(std211))
+        fp = BytesIO()
+        read211.write_buildingsync_stream(std211, fp)
+        streamed = etree.parse(BytesIO(fp.getvalue()))
+        self.assertEqual(etree.tostring(streamed, method='c14n'),
+                         etree.tostring(bsync.getroottree(), method='c14n'))
+        # Byte for byte the same as the output of the usual writer, empty elements and all
+        written = BytesIO()
+        read211.write_buildingsync(bsync, written)
+        self.assertIn(b'/>', fp.getvalue())
+        self.assertEqual(fp.getvalue(), written.getvalue())
+
+    def test_timeseries(self):
+        start = datetime.datetime(2019, 1, 1)
+        end = datetime.datetime(2019, 2, 1)
+        stamps = read211.format_timestamps([start, end, start])
+        self.assertEqual(stamps, {start: '2019-01-01T00:00:00', end: '2019-02-01T00:00:00'})
+        metered = {'Utility #2': {'Data': [{'Start Date': start, 'End Date': end, 'Use': 10, 'Cost': 2.5}]}}
+        delivered = {'Data': [{'Delivery date': end, 'Volume': 3, 'Cost': 4}]}
+        series = list(read211.map_timeseries(metered, delivered))
+        self.assertEqual(len(series), 4)
+        q = read211.qualify
+        self.assertEqual([el.tag for el in series[0]],
+                         [q('ReadingType'), q('TimeSeriesReadingQuantity'), q('StartTimeStamp'), q('EndTimeStamp'),
+                          q('IntervalFrequency'), q('IntervalReading'), q('ResourceUseID')])
+        self.assertEqual(series[0].findtext(q('IntervalFrequency')), 'Month')
+        self.assertEqual(series[1].findtext(q('IntervalReading')), '2.5')
+        self.assertEqual(series[1].findtext(q('TimeSeriesReadingQuantity')), 'Currency')
+        self.assertEqual([el.text for el in series[2]], ['Total', 'Other', '2019-02-01T00:00:00', '3', None])
+        self.assertEqual(series[3].find(q('ResourceUseID')).attrib['IDref'], 'Std211ResourceUseDelivered1')
+        # The copies don't share anything
+        series[0][0].text = 'Peak'
+        self.assertEqual(series[1][0].text, 'Total')
+
+    def test_canonical(self):
+        canonical, digest = read211.map_std211_xlsx_to_canonical(test_files[0])
+        self.assertEqual(digest, hashlib.sha256(canonical).hexdigest())
+        self.assertFalse(canonical.startswith(b'<?xml'))
+        self.assertEqual(read211.map_std211_xlsx_to_canonical(test_files[0], cache=False), (canonical, digest))
+        # The same document written another way canonicalizes to the same bytes
+        bsync = etree.fromstring(read211.map_std211_xlsx_to_prettystring(test_files[0]).encode('utf-8'),
+                                 etree.XMLParser(remove_blank_text=True))
+        self.assertEqual(read211.write_buildingsync_canonical(bsync), digest)
+        self.assertEqual(read211.format_value(datetime.datetime(2015, 7, 4, 0, 0, 0, 999)), '2015-07-04 00:00:00')
+        # Just short of midnight is midnight, not a day early
+        self.assertEqual(read211.format_value(datetime.datetime(2018, 1, 1, 23, 59, 59, 999136)),
+                         '2018-01-02 00:00:00')
+        self.assertEqual(read211.format_value(datetime.datetime(2018, 1, 1, 12, 0, 0, 499999)),
+                         '2018-01-01 12:00:00')
+        self.assertEqual(read211.format_value(-0.0), '0.0')
+        self.assertEqual(read211.format_value(0.1 + 0.2), '0.30000000000000004')
+
+    def test_diff(self):
+        bsync = read211.map_to_buildingsync(read211.load_std211(test_files[0]))
+        self.assertEqual(diff211.diff_elements(bsync, copy.deepcopy(bsync)), [])
+        previous = copy.deepcopy(bsync)
+        previous.findall('.//' + read211.qualify('IntervalReading'))[3].text = '1'
+        measures = previous.find('.//' + read211.qualify('Measures'))
+        measures.remove(measures[1])
+        extra = etree.SubElement(measures, read211.qualify('Measure'))
+        etree.SubElement(extra, read211.qualify('LongDescription')).text = 'Dropped'
+        changes = diff211.diff_elements(previous, bsync)
+        self.assertEqual([change.kind for change in changes], ['Removed', 'Added', 'Changed'])
+        self.assertTrue(changes[0].path.endswith('/Measures/Measure[LongDescription="Dropped"]'))
+        self.assertIs(changes[1].new, bsync.find('.//' + read211.qualify('Measures'))[1])
+        self.assertIn('/TimeSeries[ResourceUseID/@IDref="Std211ResourceUseUtility1"]', changes[2].path)
+        self.assertTrue(changes[2].path.endswith('[StartTimeStamp="2010-02-01T00:00:00"]'
+                                                 '[EndTimeStamp="2010-03-01T00:00:00"]/IntervalReading'))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'previous.xml.gz')
+            read211.write_buildingsync(previous, filename, pretty=True)
+            fp = BytesIO()
+            self.assertEqual(len(read211.write_buildingsync_diff(read211.read_buildingsync(filename), bsync, fp)), 3)
+        diff = etree.fromstring(fp.getvalue())
+        self.assertEqual(diff.tag, '{%s}BuildingSyncDiff' % diff211.namespace)
+        self.assertEqual([el.tag for el in diff], ['{%s}%s' % (diff211.namespace, kind)
+                                                   for kind in ('Removed', 'Added', 'Changed')])
+        self.assertEqual(diff[1][0].tag, read211.qualify('Measure'))
+        self.assertEqual(len(diff[0]), 0)
+        self.assertEqual(diff211.quote('Cost'), '"Cost"')
+        self.assertEqual(diff211.quote('2" pipe'), "'2\" pipe'")
+        self.assertEqual(diff211.quote('2" pipe\'s'), 'concat("2", \'"\', " pipe\'s")')
+        self.assertEqual(etree.XPath('string(%s)' % diff211.quote('2" pipe\'s'))(diff), '2" pipe\'s')
+        self.assertEqual(etree.QName(diff[1][0]).localname, 'Measure')
+        self.assertEqual(diff[2][0].text, bsync.findall('.//' + read211.qualify('IntervalReading'))[3].text)
+
+    def test_batch(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.mkdir(os.path.join(tmpdir, 'sub'))
+            for name in ('a.xlsx', os.path.join('sub', 'b.xlsx')):
+                with open(test_files[0], 'rb') as src, open(os.path.join(tmpdir, name), 'wb') as dst:
+                    dst.write(src.read())
+            with open(os.path.join(tmpdir, '~$a.xlsx'), 'wb') as fp:
+                fp.write(b'lock')
+            with open(os.path.join(tmpdir, 'bad.xlsx'), 'wb') as fp:
+                fp.write(b'not a workbook')
+            manifest = os.path.join(tmpdir, 'manifest.txt')
+            with open(manifest, 'w') as fp:
+                fp.write('# workbooks\na.xlsx\n\nsub/b.xlsx\n')
+            found = read211.find_workbooks([tmpdir])
+            self.assertEqual([os.path.relpath(name, tmpdir) for name in found],
+                             ['a.xlsx', 'bad.xlsx', os.path.join('sub', 'b.xlsx')])
+            self.assertEqual(read211.find_workbooks([os.path.join(tmpdir, '*.xlsx')]), found[:2])
+            self.assertEqual(read211.find_workbooks([], manifest), [found[0], found[2]])
+            self.assertEqual(read211.batch_output_name(found[2], compression='gzip'),
+                             os.path.join(tmpdir, 'sub', 'b.xml.gz'))
+            results = {os.path.basename(result.infile): result
+                       for result in read211.translate_batch(found, jobs=2)}
+            self.assertIn('BadZipFile', results['bad.xlsx'].error)
+            expected = read211.map_std211_xlsx_to_bytes(test_files[0])
+            for name in ('a.xlsx', 'b.xlsx'):
+                self.assertIsNone(results[name].error)
+                with open(results[name].outfile, 'rb') as fp:
+                    self.assertEqual(fp.read(), expected)
+            output_dir = os.path.join(tmpdir, 'out')
+            results = list(read211.translate_batch(found[:1], output_dir=output_dir, format='json', jobs=1))
+            self.assertEqual(results[0].outfile, os.path.join(output_dir, 'a.json'))
+            self.assertTrue(os.path.exists(results[0].outfile))
+            with self.assertRaises(ValueError):
+                list(read211.translate_batch([found[0], found[0]], output_dir=output_dir))
+
+    def test_watch(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            watcher = read211.WorkbookWatcher([tmpdir], settle=2)
+            self.assertEqual(watcher.poll(now=0), [])
+            workbook = os.path.join(tmpdir, 'a.xlsx')
+            with open(test_files[0], 'rb') as src, open(workbook, 'wb') as dst:
+                dst.write(src.read(1000))
+            with open(os.path.join(tmpdir, '~$a.xlsx'), 'wb') as fp:
+                fp.write(b'lock')
+            self.assertEqual(watcher.poll(now=1), [])
+            # Still being written, so it hasn't settled
+            with open(test_files[0], 'rb') as src, open(workbook, 'wb') as dst:
+                dst.write(src.read())
+            self.assertEqual(watcher.poll(now=2), [])
+            self.assertEqual(watcher.poll(now=3), [])
+            self.assertEqual(watcher.poll(now=4), [workbook])
+            self.assertEqual(watcher.poll(now=10), [])
+            result = read211.translate_file(workbook, os.path.join(tmpdir, 'a.xml.gz'))
+            self.assertIsNone(result.error)
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['a.xlsx', 'a.xml.gz', '~$a.xlsx'])
+            with gzip.open(result.outfile) as fp:
+                self.assertEqual(fp.read(), read211.map_std211_xlsx_to_bytes(workbook))
+            os.utime(workbook, ns=(0, 0))
+            self.assertEqual(watcher.poll(now=11), [])
+            self.assertEqual(watcher.poll(now=13), [workbook])
+            os.remove(workbook)
+            self.assertEqual(watcher.poll(now=14), [])
+            self.assertEqual(watcher.done, {})
+
+    def test_server(self):
+        with open(test_files[0], 'rb') as fp:
+            workbook = fp.read()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with mock.patch.dict(os.environ, {'STD211_CACHE_DIR': tmpdir}):
+                self.assertEqual(server211.translate_bytes(workbook, workdir=tmpdir),
+                                 read211.map_std211_xlsx_to_bytes(test_files[0], cache=False))
+                # Nothing is kept by the path of the upload, and the upload is gone
+                self.assertEqual([name for name in os.listdir(tmpdir) if name not in ('std211', 'tables')], [])
+        server = server211.TranslationServer(('127.0.0.1', 0), max_upload=1 << 20)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/' % server.server_address[1]
+            with open(test_files[0], 'rb') as fp:
+                workbook = fp.read()
+            with urllib.request.urlopen(urllib.request.Request(url, data=workbook)) as response:
+                self.assertEqual(response.headers['Content-Type'], 'application/xml')
+                self.assertEqual(response.read(), read211.map_std211_xlsx_to_bytes(test_files[0]))
+            with urllib.request.urlopen(urllib.request.Request(url + 'translate?format=json', data=workbook)) as response:
+                self.assertIn('BuildingSync', json.loads(response.read().decode('utf-8')))
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                urllib.request.urlopen(urllib.request.Request(url, data=b'not a workbook'))
+            self.assertEqual(cm.exception.code, 422)
+            # Turned away on the headers, before any of the body is read
+            connection = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+            connection.putrequest('POST', '/')
+            connection.putheader('Content-Length', str((1 << 20) + 1))
+            connection.endheaders()
+            self.assertEqual(connection.getresponse().status, 413)
+            connection.close()
+            with urllib.request.urlopen(url + 'health') as response:
+                self.assertEqual(response.read(), b'ok\n')
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+    def test_server_workers_failing(self):
+        class BrokenServer:
+            closed = False
+
+            def serve_forever(self):
+                raise MemoryError
+
+            def server_close(self):
+                self.closed = True
+
+        server = BrokenServer()
+        handler = signal.getsignal(signal.SIGTERM)
+        try:
+            with mock.patch.object(server211, 'respawn_delay', 0.01):
+                with mock.patch('time.sleep', wraps=time.sleep) as sleep:
+                    with self.assertRaises(server211.WorkersFailing):
+                        server211.serve(server, workers=1)
+        finally:
+            signal.signal(signal.SIGTERM, handler)
+        # Each replacement waited twice as long as the one before
+        self.assertEqual([call[0][0] for call in sleep.call_args_list],
+                         [0.01 * 2 ** n for n in range(server211.max_startup_failures - 1)])
+        self.assertTrue(server.closed)
+
+    def test_lazy_imports(self):
+        # The modules that are only needed to read workbooks, compress, write JSON or use the cache are
+        # imported when they are first used (gzip isn't in the list, lxml imports it anyway)
+        result = subprocess.run([sys.executable, '-c', 'import read211, sys; print(" ".join(sys.modules))'],
+                                cwd=os.path.dirname(os.path.abspath(read211.__file__)),
+                                stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        imported = set(result.stdout.split())
+        self.assertIn('read211', imported)
+        for name in ['openpyxl', 'zipfile', 'bz2', 'lzma', 'json', 'pickle', 'zstandard']:
+            self.assertNotIn(name, imported)
+        # The stand-ins stay in loadxl; everyone else importing these gets the real modules
+        code = ('import read211, sys, types, zipfile, openpyxl, xml.etree.ElementTree\n'
+                'names = ["zipfile", "openpyxl", "xml.etree.ElementTree"]\n'
+                'sys.exit(any(type(sys.modules[name]) is not types.ModuleType for name in names))')
+        subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(read211.__file__)),
+                       check=True)
+
+    def test_json(self):
+        q = read211.qualify
+        system = read211.createElement('LightingSystem')
+        system.attrib['ID'] = 'L1'
+        read211.createSubElement(system, 'BallastType').text = 'Electronic'
+        read211.createSubElement(read211.createSubElement(system, 'LampType'), 'CompactFluorescent')
+        for name in ['A', 'B']:
+            read211.addudf(system, name, name.lower())
+        self.assertEqual(read211.element_to_json(system),
+                         {'@ID': 'L1', 'BallastType': 'Electronic', 'LampType': {'CompactFluorescent': None},
+                          'UserDefinedFields': {'UserDefinedField': [{'FieldName': 'A', 'FieldValue': 'a'},
+                                                                     {'FieldName': 'B', 'FieldValue': 'b'}]}})
+        std211 = read211.load_std211(test_files[0])
+        bsync = read211.map_to_buildingsync(copy.deepcopy(std211))
+        for pretty in [False, True]:
+            fp = BytesIO()
+            read211.write_buildingsync_json(std211, fp, pretty=pretty)
+            document = json.loads(fp.getvalue().decode('utf-8'))
+            root = document['BuildingSync']
+            self.assertEqual(root['@xmlns'], tags211.namespace)
+            del root['@xmlns'], root['@xmlns:xsi']
+            # The streamed TimeSeries are the same as the ones in the tree
+            self.assertEqual(root, read211.element_to_json(bsync))
+        series = bsync.findall('.//' + q('TimeSeries'))
+        self.assertEqual(len(root['Facilities']['Facility']['Report']['Scenarios']['Scenario']['TimeSeriesData']
+                             ['TimeSeries']), len(series))
+
+    def test_compressed_output(self):
+        bsync = read211.map_to_buildingsync(read211.load_std211(test_files[0]))
+        fp = BytesIO()
+        read211.write_buildingsync(bsync, fp)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for extension, module in [('.gz', gzip), ('.bz2', bz2), ('.xz', lzma)]:
+                filename = os.path.join(tmpdir, 'std211.xml' + extension)
+                read211.write_buildingsync(bsync, filename)
+                with module.open(filename, 'rb') as compressed:
+                    self.assertEqual(compressed.read(), fp.getvalue())
+            # No timestamp, so the same output gives the same file
+            with open(filename[:-3] + '.gz', 'rb') as compressed:
+                first = compressed.read()
+            with mock.patch('time.time', return_value=0):
+                read211.write_buildingsync(bsync, filename[:-3] + '.gz')
+            with open(filename[:-3] + '.gz', 'rb') as compressed:
+                self.assertEqual(compressed.read(), first)
+            # The compression can be given for any file name
+            filename = os.path.join(tmpdir, 'std211.out')
+            with read211.open_output(filename, 'gzip') as out:
+                read211.write_buildingsync(bsync, out)
+            with gzip.open(filename, 'rb') as compressed:
+                self.assertEqual(compressed.read(), fp.getvalue())
+            with self.assertRaises(ValueError):
+                with read211.open_output(filename, 'zip'):
+                    pass
+            # An atomic write that fails leaves the file that was there
+            with self.assertRaises(RuntimeError):
+                with read211.open_output(filename, 'gzip', atomic=True) as out:
+                    out.write(b'partial')
+                    raise RuntimeError
+            with gzip.open(filename, 'rb') as compressed:
+                self.assertEqual(compressed.read(), fp.getvalue())
+            # and one that succeeds writes the same bytes as a direct one (the gzip header has the real name)
+            with open(filename, 'rb') as written:
+                direct = written.read()
+            with read211.open_output(filename, 'gzip', atomic=True) as out:
+                read211.write_buildingsync(bsync, out)
+            with open(filename, 'rb') as written:
+                self.assertEqual(written.read(), direct)
+            with read211.open_output(filename, atomic=True) as out:
+                out.write(b'complete')
+            with open(filename, 'rb') as written:
+                self.assertEqual(written.read(), b'complete')
+            self.assertEqual(sorted(name for name in os.listdir(tmpdir) if name.endswith('.tmp')), [])
+
+    def test_prettystring(self):
+        std211 = read211.load_std211(test_files[0])
+        bsync = read211.map_to_buildingsync(copy.deepcopy(std211))
+        txt = read211.prettystring(bsync)
+        self.assertEqual(txt, read211.prettystring(read211.map_to_buildingsync(copy.deepcopy(std211))))
+        lines = txt.decode('utf-8').splitlines()
+        self.assertEqual(lines[0], '<?xml version="1.0" encoding="utf-8"?>')
+        self.assertTrue(lines[2].startswith('  <Facilities>'))
+        parser = etree.XMLParser(remove_blank_text=True)
+        self.assertEqual(etree.tostring(etree.fromstring(txt, parser)), etree.tostring(bsync))
+
+    def test_map_sections(self):
+        std211 = read211.load_std211(test_files[0])
+        original = copy.deepcopy(std211)
+        read211.section_cache.clear()
+        txt = etree.tostring(read211.map_to_buildingsync(std211))
+        self.assertEqual(std211, original)
+        # Nothing is kept unless it is turned on
+        self.assertEqual(len(read211.section_cache), 0)
+        with mock.patch.object(read211, 'section_cache_size', 0):
+            read211.use_section_cache()
+            self.assertEqual(etree.tostring(read211.map_to_buildingsync(std211)), txt)
+            count = len(read211.section_cache)
+            self.assertEqual(etree.tostring(read211.map_to_buildingsync(std211)), txt)
+            self.assertEqual(len(read211.section_cache), count)
+            # Everything but the time series is kept
+            self.assertEqual(count, len(read211.map_sections(std211)) - 1)
+            # Only the sections that use the changed sheet are mapped again
+            std211['L2 - HVAC']['Boiler Type'] = ['Steam']
+            read211.map_to_buildingsync(std211)
+            self.assertEqual(len(read211.section_cache), count + 1)
+            # The cache is bounded by the size of the results
+            sizes = [size for _, _, size in read211.section_cache.values()]
+            read211.use_section_cache(sum(sizes) - 1)
+            self.assertLess(len(read211.section_cache), count + 1)
+            self.assertLess(sum(size for _, _, size in read211.section_cache.values()), sum(sizes))
+            read211.use_section_cache(0)
+            self.assertEqual(len(read211.section_cache), 0)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            bsync = read211.map_to_buildingsync(original, executor=executor)
+        self.assertEqual(etree.tostring(bsync), txt)
+
+    def test_mapping_rules(self):
+        with self.assertRaises(KeyError):
+            read211.compile_rules([read211.maprule('Roof area R value', 'RoofRvalue', str)])
+        data = {'Description': 'Economizer', 'Rated efficiency (as applicable)': 0.7,
+                'Approx Year Installed': 2001, 'Units': '', 'Type': 'Heat Recovery Type'}
+        systems = read211.map_equipment_inventory({'HR1': data, 'Boiler1': {'Type': 'Boiler Type', 'Units': 'tons',
+                                                                            'Output Capacity': 5}})
+        recovery = systems['HeatRecoverySystem'][0]
+        self.assertEqual(recovery.attrib['ID'], 'HR1')
+        self.assertEqual(recovery.findtext(read211.qualify('HeatRecoveryEfficiency')), '0.7')
+        self.assertEqual(recovery.findtext(read211.qualify('YearInstalled')), '2001')
+        self.assertEqual(len(recovery.findall('.//' + read211.qualify('UserDefinedField'))), 1)
+        boiler = systems['HVACSystem'][0].find('.//' + read211.qualify('Boiler'))
+        self.assertEqual(boiler.findtext(read211.qualify('OutputCapacity')), '5')
+        self.assertEqual(boiler.findtext(read211.qualify('CapacityUnits')), 'Cooling ton')
+
+    def test_enumerated_lookups(self):
+        q = read211.qualify
+        lamp = read211.bsync_lighting_system_lookup('Metal halide')
+        self.assertEqual(lamp.findtext('%s/%s' % (q('HighIntensityDischarge'), q('LampLabel'))), 'Metal Halide')
+        self.assertEqual(read211.bsync_lighting_system_lookup('Other')[0].tag, q('Unknown'))
+        # Changing what comes back doesn't change the prototype
+        lamp[0][0].text = 'Changed'
+        self.assertEqual(etree.tostring(read211.bsync_lighting_system_lookup('Metal halide')),
+                         etree.tostring(read211.lamp_type_prototypes['Metal halide']))
+        control = read211.bsync_lighting_control_lookup('Photocell')
+        self.assertEqual(control.tag, q('LightingControlTypeDaylighting'))
+        self.assertEqual(control.text, 'Unknown')
+        self.assertIsNone(read211.bsync_lighting_control_lookup('BAS'))
+        self.assertEqual(read211.bsync_capacity_units_lookup('Tons'), 'Cooling ton')
+        self.assertEqual(read211.bsync_condition_lookup('GOOD'), 'Good')
+        self.assertEqual(read211.bsync_condition_lookup('broken'), 'Other')
+
+    def test_id_registry(self):
+        ids = read211.IDRegistry()
+        system = read211.createElement('HVACSystem')
+        ids.allocate(system, 'HVAC1')
+        self.assertEqual(system.attrib['ID'], 'HVAC1')
+        ref = read211.createElement('LinkedBuildingID')
+        ids.refer(ref, 'Building')
+        self.assertEqual(ref.attrib['IDref'], 'Building')
+        other = read211.IDRegistry()
+        other.allocate(read211.createElement('LightingSystem'), 'HVAC1')
+        other.allocate(read211.createElement('Building'), 'Building')
+        self.assertEqual(ids.problems(), ['IDref "Building" of LinkedBuildingID does not match any ID'])
+        ids.update(other)
+        self.assertEqual(ids.problems(), ['ID "HVAC1" of LightingSystem is already used by HVACSystem'])
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEqual(len(read211.check_ids(ids)), 1)
+        self.assertTrue(issubclass(caught[0].category, read211.IDWarning))
+        with self.assertRaises(read211.InvalidIDs):
+            read211.check_ids(ids, strict=True)
+        # Inventory IDs come straight from the workbook
+        std211 = copy.deepcopy(read211.load_std211(test_files[0]))
+        std211['L2 - Equipment Inventory'] = {'Wall1': {'Type': 'Boiler Type'}, 'AHU 1': {'Type': 'DX System Type'}}
+        with self.assertRaises(read211.InvalidIDs) as context:
+            read211.map_to_buildingsync(std211, strict=True)
+        self.assertIn('ID "Wall1" of HVACSystem is already used by WallSystem', str(context.exception))
+        self.assertIn('ID "AHU 1" of HVACSystem is not a valid XML ID', str(context.exception))
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', read211.IDWarning)
+            read211.map_to_buildingsync(read211.load_std211(test_files[0]), strict=True)
+
+    def test_udf_accumulator(self):
+        udfs = read211.UDFAccumulator()
+        self.assertIsNone(udfs.element())
+        udfs.add('A', 'a')
+        udfs.map({'B': 2, 'C': ''}, 'B', 'B', str)
+        udfs.map({'B': 2, 'C': ''}, 'C', 'C')
+        parent = read211.createElement('PlugLoad')
+        udfs.emit(parent)
+        self.assertEqual(len(parent), 1)
+        names = [el.text for el in parent.iter(read211.qualify('FieldName'))]
+        values = [el.text for el in parent.iter(read211.qualify('FieldValue'))]
+        self.assertEqual(names, ['A', 'B'])
+        self.assertEqual(values, ['a', '2'])
+        # The UDFs go last even when they are collected before other elements
+        metered = {'Utility #1': {'Type': 'Steam', 'Definition': {'kBtu/unit': 1.2}}}
+        tables = {'Metered Energy BuildingSync Units': {'Steam': 'kBtu'}}
+        resources = read211.map_resource_uses({}, metered, {}, tables)
+        resource = resources[0]
+        self.assertEqual(resource[-1].tag, read211.qualify('UserDefinedFields'))
+        self.assertEqual(len(resource[-1]), 2)
+
+    def test_validate(self):
+        bsync = read211.map_to_buildingsync(read211.load_std211(test_files[0]))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            xsd = os.path.join(tmpdir, 'BuildingSync.xsd')
+            with open(xsd, 'wb') as fp:
+                fp.write(no_measures_xsd)
+            with mock.patch.dict(os.environ, {'BUILDINGSYNC_XSD': xsd}):
+                self.assertIs(schema211.load_schema(), schema211.load_schema(xsd))
+                problems = read211.validate_buildingsync(bsync)
+            self.assertEqual(len(problems), 1)
+            self.assertEqual(problems[0].section, 'Measures')
+            self.assertEqual(problems[0].sheets, ('L1 - EEM Summary', 'L2 - EEM Summary'))
+            self.assertIn('Measures', problems[0].message)
+            bsync.find('.//' + read211.qualify('Measures')).getparent().remove(
+                bsync.find('.//' + read211.qualify('Measures')))
+            self.assertEqual(read211.validate_buildingsync(bsync, xsd), [])
+            with self.assertRaises(schema211.SchemaNotFound):
+                schema211.load_schema(os.path.join(tmpdir, 'missing.xsd'))
+            # There's no schema to fall back on
+            with mock.patch.dict(os.environ, {'BUILDINGSYNC_XSD': ''}):
+                with self.assertRaises(schema211.SchemaNotFound):
+                    schema211.load_schema()
+
     def test_legit(self):
         self.assertTrue(schema.validate(legit))
 
@@ -0,0 +1,79 @@
+# BuildingSync(R), Copyright (c) 2015-2020, Alliance for Sustainable Energy, LLC.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# (1) Redistributions of source code must retain the above copyright notice, this
+#     list of conditions and the following disclaimer.
+#
+# (2) Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# (3) Neither the name of the copyright holder nor the names of any contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission from the respective party.
+#
+# (4) Other than as required in clauses (1) and (2), distributions in any form of
+#     modifications or other derivative works may not use the "BuildingSync"
+#     trademark or any other confusingly similar designation without specific
+#     prior written permission from Alliance for Sustainable Energy, LLC.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDER(S) AND ANY CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER(S), ANY CONTRIBUTORS, THE
+# UNITED STATES GOVERNMENT, OR THE UNITED STATES DEPARTMENT OF ENERGY, NOR ANY
+# OF THEIR EMPLOYEES, BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import lxml.etree as et
+
+# Compiled schemas, keyed by file name and modification time
+schemas = {}
+
+
+class SchemaNotFound(Exception):
+    pass
+
+
+def xsd_path(path=None):
+    """Find the BuildingSync schema file
+
+    :param path: name of the XSD file (optional)
+    :return: the file name
+
+    Without a path, the BUILDINGSYNC_XSD environment variable is used. The schema doesn't come with the
+    translator, so one of the two is needed. Nothing is downloaded, so validation works offline.
+    """
+    if path is None:
+        path = os.environ.get('BUILDINGSYNC_XSD')
+    if not path:
+        raise SchemaNotFound('No BuildingSync schema given, use --xsd or set BUILDINGSYNC_XSD to the XSD file')
+    if not os.path.isfile(path):
+        raise SchemaNotFound('BuildingSync schema "%s" does not exist, set BUILDINGSYNC_XSD to the XSD file' % path)
+    return path
+
+
+def load_schema(path=None):
+    """Get the compiled BuildingSync schema
+
+    :param path: name of the XSD file (optional, see xsd_path)
+    :return: lxml.etree.XMLSchema
+
+    Compiling the schema takes a while, so each file is compiled once and the result is kept for the
+    rest of the process. A file that has changed since it was compiled is compiled again.
+    """
+    path = os.path.realpath(xsd_path(path))
+    key = (path, os.stat(path).st_mtime_ns)
+    schema = schemas.get(key)
+    if schema is None:
+        schema = schemas[key] = et.XMLSchema(et.parse(path))
+    return schema
@@ -0,0 +1,301 @@
+# BuildingSync(R), Copyright (c) 2015-2020, Alliance for Sustainable Energy, LLC.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# (1) Redistributions of source code must retain the above copyright notice, this
+#     list of conditions and the following disclaimer.
+#
+# (2) Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# (3) Neither the name of the copyright holder nor the names of any contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission from the respective party.
+#
+# (4) Other than as required in clauses (1) and (2), distributions in any form of
+#     modifications or other derivative works may not use the "BuildingSync"
+#     trademark or any other confusingly similar designation without specific
+#     prior written permission from Alliance for Sustainable Energy, LLC.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDER(S) AND ANY CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER(S), ANY CONTRIBUTORS, THE
+# UNITED STATES GOVERNMENT, OR THE UNITED STATES DEPARTMENT OF ENERGY, NOR ANY
+# OF THEIR EMPLOYEES, BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import loadxl
+import read211
+import schema211
+import http.server
+import os
+import signal
+import sys
+import tempfile
+import time
+import urllib.parse
+from io import BytesIO
+
+# Content types of the output formats
+content_types = {'xml': 'application/xml',
+                 'json': 'application/json'}
+
+# A worker that exits within this many seconds of being started failed to start
+startup_time = 5.0
+# Seconds to wait before replacing a worker that failed to start, doubled for each failure in a row
+respawn_delay = 0.1
+# Number of workers in a row that may fail to start before the server gives up
+max_startup_failures = 5
+
+
+class TranslationFailed(Exception):
+    pass
+
+
+class WorkersFailing(Exception):
+    pass
+
+
+def translate_bytes(data, format='xml', pretty=False, groupspaces=False, validate=False, xsd=None, workdir=None):
+    """Translate the bytes of a workbook into BuildingSync
+
+    :param data: contents of the Excel file
+    :param format: 'xml' or 'json' (defaults to 'xml')
+    :param pretty: Boolean determining if the output is pretty-printed (defaults to False)
+    :param groupspaces: Boolean determining if spaces should be combined by HVAC type (defaults to False)
+    :param validate: Boolean determining if the XML is validated against the schema (defaults to False)
+    :param xsd: name of the XSD file to validate with (optional, see schema211.xsd_path)
+    :param workdir: directory to make the private directory for the workbook in while it is read (defaults
+                    to the temporary directory)
+    :return: the BuildingSync document as bytes
+
+    Each workbook is written to a new private directory, and uploads from different clients are not
+    revisions of one workbook, so the sheets read by path (see read211.load_std211_incremental) are not
+    reused. A workbook sent again unchanged still comes straight from the cache, which is keyed by the
+    content. Validation problems raise TranslationFailed.
+    """
+    with tempfile.TemporaryDirectory(prefix='std211-upload-', dir=workdir) as tmpdir:
+        path = os.path.join(tmpdir, 'upload.xlsx')
+        with open(path, 'xb') as fp:
+            fp.write(data)
+        std211 = read211.load_std211(path, incremental=False)
+    fp = BytesIO()
+    if format == 'json':
+        read211.write_buildingsync_json(std211, fp, groupspaces=groupspaces, pretty=pretty)
+        return fp.getvalue()
+    bsync = read211.map_to_buildingsync(std211, groupspaces=groupspaces)
+    if validate:
+        problems = read211.validate_buildingsync(bsync, xsd)
+        if problems:
+            raise TranslationFailed('\n'.join('%s: %s' % (problem.path, problem.message) for problem in problems))
+    read211.write_buildingsync(bsync, fp, pretty=pretty)
+    return fp.getvalue()
+
+
+class TranslationHandler(http.server.BaseHTTPRequestHandler):
+    """Translate workbooks POSTed to / (or /translate)
+
+    The body of the request is the Excel file. The query can have format=json, pretty=1 and groupspaces=1.
+    The response is the BuildingSync document, or a plain text error: 411 without a Content-Length, 413 for
+    a body over the server's max_upload, and 422 for a workbook that can't be translated. GET /health
+    answers 200 so that a front end can tell the server is up.
+    """
+    server_version = 'std211-translator/' + read211.__version__
+    # Seconds to wait on a slow client before giving up, so one can't hold a worker forever
+    timeout = 60
+
+    def send_body(self, status, body, content_type='text/plain; charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path == '/health':
+            self.send_body(200, b'ok\n')
+        else:
+            self.send_body(404, b'Not found\n')
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path not in ('/', '/translate'):
+            self.send_body(404, b'Not found\n')
+            return
+        query = urllib.parse.parse_qs(url.query)
+        format = query.get('format', ['xml'])[0]
+        if format not in content_types:
+            self.send_body(400, b'Unknown format\n')
+            return
+        length = self.headers.get('Content-Length')
+        if length is None or not length.isdigit():
+            self.send_body(411, b'Content-Length is required\n')
+            return
+        length = int(length)
+        if length > self.server.max_upload:
+            self.close_connection = True
+            self.send_body(413, b'Workbook is too large\n')
+            return
+        data = self.rfile.read(length)
+        try:
+            output = translate_bytes(data, format=format,
+                                     pretty=query.get('pretty', ['0'])[0] not in ('0', ''),
+                                     groupspaces=query.get('groupspaces', ['0'])[0] not in ('0', ''),
+                                     validate=self.server.validate, xsd=self.server.xsd)
+        except Exception as exc:
+            self.send_body(422, ('%s: %s\n' % (type(exc).__name__, exc)).encode('utf-8'))
+            return
+        self.send_body(200, output, content_types[format])
+
+
+class TranslationServer(http.server.HTTPServer):
+    """HTTP server for TranslationHandler
+
+    :param address: (host, port) to listen on
+    :param queue: number of connections that can wait for a worker (defaults to 64)
+    :param max_upload: largest workbook accepted in bytes (defaults to 64 MiB)
+    :param validate: Boolean determining if outputs are validated (defaults to False)
+    :param xsd: name of the XSD file to validate with (optional, see schema211.xsd_path)
+    """
+
+    def __init__(self, address, queue=64, max_upload=64 * 1024 * 1024, validate=False, xsd=None):
+        self.request_queue_size = queue
+        self.max_upload = max_upload
+        self.validate = validate
+        self.xsd = xsd
+        super().__init__(address, TranslationHandler)
+
+
+def warm_up(validate=False, xsd=None):
+    """Do the one-time setup before the workers are started, so each of them has it already
+
+    :param validate: Boolean determining if the schema is compiled (defaults to False)
+    :param xsd: name of the XSD file (optional, see schema211.xsd_path)
+
+    The workers live for a while and see revisions of the same workbooks, so the section results are
+    kept for reuse (see read211.use_section_cache).
+    """
+    loadxl.preload()
+    read211.use_section_cache()
+    if validate:
+        schema211.load_schema(xsd)
+
+
+def serve(server, workers=None):
+    """Serve translations from pre-forked worker processes
+
+    :param server: TranslationServer, already listening
+    :param workers: number of worker processes (defaults to None, one per CPU)
+
+    Each worker handles one request at a time, so the number of workers is the limit on concurrent
+    translations and further connections wait in the listen queue. The workers all accept on the one
+    socket, and one that dies is replaced. A worker that dies right after it starts (see startup_time) is
+    replaced after a delay that doubles each time, and once max_startup_failures have done that in a
+    row WorkersFailing is raised. Where there is no fork (Windows), the requests are served one at a
+    time in this process.
+    """
+    if not hasattr(os, 'fork'):
+        server.serve_forever()
+        return
+    if workers is None:
+        workers = os.cpu_count() or 1
+    # Start time of each worker by process ID
+    children = {}
+
+    def start():
+        pid = os.fork()
+        if pid == 0:
+            # In the worker: the parent handles the signals and stops the workers
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children[pid] = time.monotonic()
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    failures = 0
+    try:
+        for _ in range(workers):
+            start()
+        while True:
+            pid, _ = os.wait()
+            if pid in children:
+                if time.monotonic() - children.pop(pid) < startup_time:
+                    failures += 1
+                    if failures >= max_startup_failures:
+                        raise WorkersFailing('%d workers in a row exited right after starting' % failures)
+                    time.sleep(respawn_delay * 2 ** (failures - 1))
+                else:
+                    failures = 0
+                start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        server.server_close()
+
+
+def argument_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve ASHRAE Std. 211 Workbook to BuildingSync translations over HTTP.')
+    parser.add_argument('--host', dest='host', action='store', default='127.0.0.1',
+                        help='address to listen on (defaults to 127.0.0.1)')
+    parser.add_argument('--port', dest='port', action='store', type=int, default=8211,
+                        help='port to listen on (defaults to 8211)')
+    parser.add_argument('-j', '--workers', dest='workers', action='store', type=int, default=None,
+                        help='number of worker processes (defaults to one per CPU)')
+    parser.add_argument('--queue', dest='queue', action='store', type=int, default=64,
+                        help='number of connections that can wait for a worker (defaults to 64)')
+    parser.add_argument('--max-upload', dest='max_upload', action='store', type=int, default=64,
+                        help='largest workbook accepted in MiB (defaults to 64)')
+    parser.add_argument('--validate', dest='validate', action='store_true',
+                        help='validate each output against the BuildingSync schema')
+    parser.add_argument('--xsd', dest='xsd', action='store', default=None,
+                        help='BuildingSync schema file to validate with (required unless $BUILDINGSYNC_XSD is set)')
+    return parser
+
+
+if __name__ == '__main__':
+    parser = argument_parser()
+    args = parser.parse_args()
+    if args.workers is not None and args.workers < 1:
+        parser.error('--workers must be at least 1')
+    try:
+        warm_up(validate=args.validate, xsd=args.xsd)
+    except (schema211.SchemaNotFound, read211.et.XMLSchemaParseError) as exc:
+        parser.error(str(exc))
+    try:
+        server = TranslationServer((args.host, args.port), queue=args.queue, max_upload=args.max_upload * 1048576,
+                                   validate=args.validate, xsd=args.xsd)
+    except OSError as exc:
+        parser.error('cannot listen on %s:%d: %s' % (args.host, args.port, exc))
+    sys.stderr.write('Listening on http://%s:%d/\n' % server.server_address[:2])
+    try:
+        serve(server, workers=args.workers)
+    except WorkersFailing as exc:
+        sys.stderr.write('%s, giving up\n' % exc)
+        sys.exit(1)
@@ -0,0 +1,225 @@
+# BuildingSync(R), Copyright (c) 2015-2020, Alliance for Sustainable Energy, LLC.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# (1) Redistributions of source code must retain the above copyright notice, this
+#     list of conditions and the following disclaimer.
+#
+# (2) Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions and the following disclaimer in the documentation
+#     and/or other materials provided with the distribution.
+#
+# (3) Neither the name of the copyright holder nor the names of any contributors
+#     may be used to endorse or promote products derived from this software
+#     without specific prior written permission from the respective party.
+#
+# (4) Other than as required in clauses (1) and (2), distributions in any form of
+#     modifications or other derivative works may not use the "BuildingSync"
+#     trademark or any other confusingly similar designation without specific
+#     prior written permission from Alliance for Sustainable Energy, LLC.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDER(S) AND ANY CONTRIBUTORS "AS
+# IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER(S), ANY CONTRIBUTORS, THE
+# UNITED STATES GOVERNMENT, OR THE UNITED STATES DEPARTMENT OF ENERGY, NOR ANY
+# OF THEIR EMPLOYEES, BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import re
+
+namespace = "http://buildingsync.net/schemas/bedes-auc/2019"
+
+# Every BuildingSync element that the translator emits, anything else is a mistake
+element_names = ('Address',
+                 'AnnualSavingsByFuel',
+                 'AnnualSavingsByFuels',
+                 'AnnualSavingsNativeUnits',
+                 'AuditorContactID',
+                 'BallastType',
+                 'Boiler',
+                 'Building',
+                 'BuildingAutomationSystem',
+                 'BuildingSync',
+                 'Buildings',
+                 'Capacity',
+                 'CapacityUnits',
+                 'CeilingID',
+                 'CeilingSystem',
+                 'CeilingSystems',
+                 'City',
+                 'CompactFluorescent',
+                 'ConditionedFloorsAboveGrade',
+                 'ConditionedFloorsBelowGrade',
+                 'Contact',
+                 'ContactName',
+                 'ContactRole',
+                 'Contacts',
+                 'CoolingPlant',
+                 'CoolingPlantCondition',
+                 'CoolingSource',
+                 'CoolingSourceType',
+                 'CoolingSources',
+                 'DX',
+                 'Delivery',
+                 'DomesticHotWaterSystem',
+                 'DomesticHotWaterSystems',
+                 'EndTimeStamp',
+                 'EnergyResource',
+                 'Facilities',
+                 'Facility',
+                 'FenestrationSystem',
+                 'FenestrationSystems',
+                 'FieldName',
+                 'FieldValue',
+                 'FloorArea',
+                 'FloorAreaCustomName',
+                 'FloorAreaType',
+                 'FloorAreaValue',
+                 'FloorAreas',
+                 'FootprintShape',
+                 'FoundationID',
+                 'FoundationSystem',
+                 'FoundationSystems',
+                 'FundingFromIncentives',
+                 'HVACSystem',
+                 'HVACSystems',
+                 'Halogen',
+                 'HeatRecoveryEfficiency',
+                 'HeatRecoverySystem',
+                 'HeatRecoverySystems',
+                 'HeatingAndCoolingSystems',
+                 'HeatingPlant',
+                 'HeatingPlantCondition',
+                 'HeatingSource',
+                 'HeatingSources',
+                 'HighIntensityDischarge',
+                 'HistoricalLandmark',
+                 'Induction',
+                 'IntervalFrequency',
+                 'IntervalReading',
+                 'LampLabel',
+                 'LampType',
+                 'LightingControlTypeDaylighting',
+                 'LightingControlTypeManual',
+                 'LightingControlTypeOccupancy',
+                 'LightingControlTypeTimer',
+                 'LightingSystem',
+                 'LightingSystems',
+                 'LinearFluorescent',
+                 'LinkedBuildingID',
+                 'LinkedPremises',
+                 'LongDescription',
+                 'Measure',
+                 'MeasureSavingsAnalysis',
+                 'MeasureTotalFirstCost',
+                 'Measures',
+                 'NumberOfUnits',
+                 'OccupancyLevel',
+                 'OccupancyLevels',
+                 'OccupantQuantity',
+                 'OutputCapacity',
+                 'Plants',
+                 'PlugLoad',
+                 'PlugLoads',
+                 'PostalCode',
+                 'PostalCodePlus4',
+                 'PremisesName',
+                 'PremisesNotes',
+                 'PrimaryContactID',
+                 'ReadingType',
+                 'Report',
+                 'ResourceUnits',
+                 'ResourceUse',
+                 'ResourceUseID',
+                 'ResourceUses',
+                 'RoofArea',
+                 'RoofID',
+                 'RoofRValue',
+                 'RoofSystem',
+                 'RoofSystems',
+                 'Scenario',
+                 'ScenarioName',
+                 'Scenarios',
+                 'Side',
+                 'Sides',
+                 'Simplified',
+                 'Site',
+                 'Sites',
+                 'SolidStateLighting',
+                 'Space',
+                 'Spaces',
+                 'SpatialUnitType',
+                 'SpatialUnits',
+                 'StartTimeStamp',
+                 'State',
+                 'StreetAddress',
+                 'StreetAddressDetail',
+                 'Subsection',
+                 'Subsections',
+                 'Systems',
+                 'ThermalEfficiency',
+                 'ThermalZone',
+                 'ThermalZones',
+                 'TimeSeries',
+                 'TimeSeriesData',
+                 'TimeSeriesReadingQuantity',
+                 'TypicalOccupantUsage',
+                 'TypicalOccupantUsageUnits',
+                 'TypicalOccupantUsageValue',
+                 'TypicalOccupantUsages',
+                 'Unknown',
+                 'UsefulLife',
+                 'UserDefinedField',
+                 'UserDefinedFields',
+                 'Utilities',
+                 'Utility',
+                 'UtilityID',
+                 'UtilityIDs',
+                 'UtilityName',
+                 'WallArea',
+                 'WallID',
+                 'WallRValue',
+                 'WallSystem',
+                 'WallSystems',
+                 'WindowID',
+                 'WindowToWallRatio',
+                 'YearInstalled',
+                 'YearOfConstruction',
+                 'YearOfLastEnergyAudit',
+                 'YearOfLastMajorRemodel')
+
+ncname = re.compile(r'[A-Za-z_][A-Za-z0-9_.-]*')
+
+
+def clark(name):
+    """Get the Clark notation ({namespace}name) tag for a BuildingSync element name"""
+    return '{%s}%s' % (namespace, name)
+
+
+def build_registry(names):
+    """Build the dictionary of Clark notation tags for a list of element names
+
+    :param names: the list of element names
+    :return: dictionary of tags keyed by element name
+
+    Names that can't be XML element names or are listed twice raise a ValueError.
+    """
+    tags = {}
+    for name in names:
+        if not ncname.fullmatch(name):
+            raise ValueError('"%s" is not a valid BuildingSync element name' % name)
+        if name in tags:
+            raise ValueError('BuildingSync element name "%s" is listed more than once' % name)
+        tags[name] = clark(name)
+    return tags
+
+
+tags = build_registry(element_names)